@@ -0,0 +1,273 @@
+"""Archive module that contains:
+                                 Chapter archives (.cbz) that pages are streamed straight into
+
+                                 Pages are stored (not recompressed) as they arrive and listed
+                                 in page order, an interrupted archive keeps its .part suffix and
+                                 its finished pages are recovered when the download resumes"""
+import shutil
+import struct
+import zipfile
+import zlib
+
+from os import (path, remove, replace)
+from tempfile import SpooledTemporaryFile
+from threading import Lock
+from typing import NoReturn
+
+import config
+
+
+LOCAL_HEADER = struct.Struct("<4sHHHHHIIIHH")
+LOCAL_SIGNATURE = b"PK\x03\x04"
+
+
+def archive_file(chapter_folder : str) -> str:
+    """Returns the archive a chapter is written to in cbz mode"""
+    return f"{chapter_folder.rstrip('/')}.cbz"
+
+
+def page_entry(index : int, image : str) -> str:
+    """Returns a page's name inside the archive (zero padded so name order is page order)"""
+    return f"{index:04d}{path.splitext(image)[1]}"
+
+
+def entry_path(archive_path : str, entry : str) -> str:
+    """Returns the path a page inside an archive is recorded under (the archive as its folder)"""
+    return f"{archive_path}/{entry}"
+
+
+def split_entry(page_file : str) -> tuple:
+    """Returns the archive and entry of a recorded page (archive is None for a page file)"""
+
+    archive_path, entry = path.split(page_file)
+    if archive_path.endswith(".cbz"):
+        return archive_path, entry
+    return None, page_file
+
+
+def reopen_without(archive_path : str, names : set) -> NoReturn:
+    """Turn a finished archive back into an interrupted one (.part) without the named pages
+
+    The next download of the chapter recovers the other pages and only fetches the named ones
+    """
+    part_path = f"{archive_path}.part"
+
+    with zipfile.ZipFile(archive_path) as source:
+        with zipfile.ZipFile(part_path, "w", compression=zipfile.ZIP_STORED) as target:
+            for info in source.infolist():
+                if info.filename not in names:
+                    target.writestr(info, source.read(info))
+
+    remove(archive_path)
+
+
+def recover(part_file : str) -> tuple:
+    """Read the pages an interrupted archive finished writing
+
+    Returns the recovered entries and the offset where the intact data ends
+    (anything after it is a partly written page)
+    """
+    entries = []
+    end = 0
+
+    with open(part_file, "rb") as archive:
+        while True:
+            header = archive.read(LOCAL_HEADER.size)
+            if len(header) < LOCAL_HEADER.size:
+                break
+
+            (signature, _, flags, method, mod_time, mod_date,
+             crc, compress_size, file_size, name_length, extra_length) = LOCAL_HEADER.unpack(header)
+
+            if signature != LOCAL_SIGNATURE or method != zipfile.ZIP_STORED:
+                break
+
+            name = archive.read(name_length)
+            extra = archive.read(extra_length)
+            data = archive.read(compress_size)
+
+            # Sizes and crc are filled in after the page is written, so a partly
+            # written page fails one of these checks
+            if (not file_size or len(data) != compress_size
+                    or compress_size != file_size or zlib.crc32(data) != crc):
+                break
+
+            date_time = ((mod_date >> 9) + 1980, (mod_date >> 5) & 0xF, mod_date & 0x1F,
+                         mod_time >> 11, (mod_time >> 5) & 0x3F, (mod_time & 0x1F) * 2)
+
+            info = zipfile.ZipInfo(name.decode("utf-8" if flags & 0x800 else "cp437"), date_time)
+            info.flag_bits = flags
+            info.compress_type = method
+            info.CRC = crc
+            info.compress_size = compress_size
+            info.file_size = file_size
+            info.header_offset = end
+            info.extra = extra
+
+            entries.append(info)
+            end = archive.tell()
+
+    return entries, end
+
+
+class ChapterArchive():
+    """Threadsafe .cbz writer for a single chapter"""
+
+    def __init__(self, archive_path : str):
+
+        self.archive_path = archive_path
+        self.part_path = f"{archive_path}.part"
+        self.mutex = Lock()
+
+        entries, end = recover(self.part_path) if path.isfile(self.part_path) else ([], 0)
+
+        # Reopen an interrupted archive after its last intact page
+        self.fp = open(self.part_path, "r+b" if entries else "wb")
+        self.fp.seek(end)
+        self.fp.truncate()
+
+        self.zip = zipfile.ZipFile(self.fp, "w", compression=zipfile.ZIP_STORED)
+        for info in entries:
+            self.zip.filelist.append(info)
+            self.zip.NameToInfo[info.filename] = info
+
+        self.recovered = len(entries)
+
+
+    def has(self, name : str) -> bool:
+        """Returns whether a page is already in the archive"""
+
+        with self.mutex:
+            return name in self.zip.NameToInfo
+
+
+    def count(self) -> int:
+        """Returns the number of pages in the archive"""
+
+        with self.mutex:
+            return len(self.zip.NameToInfo)
+
+
+    def write(self, name : str, source) -> NoReturn:
+        """Copy a finished page from a file object into the archive"""
+
+        source.seek(0)
+        with self.mutex:
+            with self.zip.open(name, "w") as entry:
+                shutil.copyfileobj(source, entry, config.CHUNK_SIZE)
+
+
+    def close(self, complete : bool) -> NoReturn:
+        """Write the page listing and, if every page is in, give the archive its final name"""
+
+        with self.mutex:
+            # Readers list pages in central directory order, which is sorted back into page order
+            self.zip.filelist.sort(key=lambda info: info.filename)
+            self.zip.close()
+            self.fp.close()
+
+            if complete:
+                replace(self.part_path, self.archive_path)
+
+
+class BufferMemory():
+    """Threadsafe count of the page bytes that every page buffer holds in memory"""
+
+    def __init__(self):
+
+        self.held = 0
+        self.peak = 0
+        self.spilled = 0 # Buffers moved to a temporary file because memory was full
+        self.mutex = Lock()
+
+
+    def reserve(self, size : int) -> bool:
+        """Returns whether size more bytes fit in memory (they are counted if they do)"""
+
+        with self.mutex:
+            if self.held + size > config.WRITE_QUEUE_BYTES:
+                self.spilled += 1
+                return False
+
+            self.held += size
+            self.peak = max(self.peak, self.held)
+            return True
+
+
+    def release(self, size : int) -> NoReturn:
+        """Give back the memory of a buffer that spilled or closed"""
+
+        with self.mutex:
+            self.held -= size
+
+
+    def stats(self) -> dict:
+        """Returns the most page bytes held in memory at once and the buffers that spilled"""
+
+        with self.mutex:
+            return {"peak_bytes":self.peak, "spilled":self.spilled}
+
+
+BUFFER_MEMORY = BufferMemory()
+
+
+class PageBuffer(SpooledTemporaryFile):
+    """A page held in memory while it fits (in PAGE_SPOOL_BYTES and in the memory all buffers share)
+
+    Otherwise it spills to an anonymous temporary file, so the pages being downloaded or
+    waiting for a writer never hold more than WRITE_QUEUE_BYTES of memory together
+    """
+
+    def __init__(self):
+
+        super().__init__(max_size=config.PAGE_SPOOL_BYTES)
+        self.held = 0 # Bytes counted in BUFFER_MEMORY
+        self.in_memory = True
+
+
+    def write(self, data : bytes) -> int:
+        """Append to the page, it spills once memory can't hold the new bytes"""
+
+        if self.in_memory:
+            if BUFFER_MEMORY.reserve(len(data)):
+                self.held += len(data)
+            else:
+                self.rollover()
+
+        return super().write(data)
+
+
+    def rollover(self) -> NoReturn:
+        """Move the page to a temporary file"""
+
+        super().rollover()
+        self.in_memory = False
+        self.free()
+
+
+    def close(self) -> NoReturn:
+        """Discard the page"""
+
+        super().close()
+        self.free()
+
+
+    def __exit__(self, *exc) -> NoReturn:
+        """Discard the page (the base class would only close the file it wraps)"""
+        self.close()
+
+
+    def free(self) -> NoReturn:
+        """Stop counting the buffer's bytes as held in memory"""
+
+        BUFFER_MEMORY.release(self.held)
+        self.held = 0
+
+
+def page_buffer() -> PageBuffer:
+    """Returns a buffer for a downloaded page on its way to its file or archive
+
+    Nothing is written into the output folder, a page that doesn't fit in memory
+    spills to an anonymous temporary file
+    """
+    return PageBuffer()
@@ -0,0 +1,649 @@
+"""Asyncio download engine:
+                            One event loop and one http client for every manga
+
+                            A single concurrency limit shared by all manga,
+                            chapter info and image requests"""
+import asyncio
+import hashlib
+import json
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from os import makedirs
+from threading import Lock
+from typing import NoReturn
+from urllib.parse import urlparse
+
+try:
+    import aiohttp
+except ImportError: # Optional dependency, the thread engine is used without it
+    aiohttp = None
+
+import config
+import feed
+
+from archive import ChapterArchive
+from flight import ASYNC_API_FLIGHTS
+from hedge import (server_health, PageRace, TRACKER)
+from integrity import (content_length, page_problem)
+from metrics import (request_done, PAGE_RETRIES, PAGE_SECONDS, PAGES_DAMAGED, PAGES_FAILED)
+from retry import (backoff, PageError)
+from selection import ChapterSelection
+from state import DownloadState
+from throttle import (host_limit, retry_after, AdaptiveLimit)
+from tracing import (request_trace, tracer)
+from writer import (disk_writer, WriteGroup)
+from downloader import (drop_sink, page_sink, response_cache, MangaDownloader)
+
+
+def available() -> bool:
+    """Returns whether the async engine can be used (requires aiohttp)"""
+    return aiohttp is not None
+
+
+IO_POOL = None
+m_io_pool = Lock()
+
+
+def io_pool() -> ThreadPoolExecutor:
+    """Returns the threads the async engine's blocking sqlite and file calls run on"""
+
+    global IO_POOL
+
+    if IO_POOL is None:
+        with m_io_pool:
+            if IO_POOL is None:
+                IO_POOL = ThreadPoolExecutor(max_workers=config.ASYNC_IO_THREADS, thread_name_prefix="async-io")
+
+    return IO_POOL
+
+
+async def blocking(function, *args):
+    """Run a blocking call (sqlite commit, file or archive I/O) off the event loop, returns its result"""
+
+    return await asyncio.get_running_loop().run_in_executor(io_pool(), function, *args)
+
+
+class AsyncHostLimit():
+    """A host's adaptive (AIMD) limit awaited on the event loop
+
+    The limit itself is the one the thread engine uses (throttle.host_limit), so both
+    engines share its slots, Retry-After blocks and statistics
+    """
+
+    def __init__(self, limit : AdaptiveLimit):
+
+        self.limit = limit
+        self.freed = asyncio.Event()
+
+
+    async def acquire(self) -> NoReturn:
+        """Wait for a free slot on the host (and for any Retry-After to pass)"""
+
+        while True:
+            wait = self.limit.try_acquire()
+            if wait == 0:
+                return
+
+            self.freed.clear()
+            try:
+                await asyncio.wait_for(self.freed.wait(), wait or config.ASYNC_HOST_POLL)
+            except asyncio.TimeoutError:
+                pass
+
+
+    def release(self, status : int, latency : float, wait : float = 0.0) -> NoReturn:
+        """Free a slot and adjust the limit from the request's outcome (see AdaptiveLimit.release)"""
+
+        self.limit.release(status, latency, wait)
+        self.freed.set()
+
+
+    def cancel(self) -> NoReturn:
+        """Free the slot of a cancelled request"""
+
+        self.limit.cancel()
+        self.freed.set()
+
+
+ASYNC_HOSTS = {} # Host -> AsyncHostLimit on the running event loop
+
+
+def async_host_limit(url : str) -> AsyncHostLimit:
+    """Returns the awaitable adaptive limit of a url's host (only used on the event loop thread)"""
+
+    limit = host_limit(url)
+    if limit.host not in ASYNC_HOSTS:
+        ASYNC_HOSTS[limit.host] = AsyncHostLimit(limit)
+
+    return ASYNC_HOSTS[limit.host]
+
+
+class AsyncMangaDownloader(MangaDownloader):
+    """Download manager that downloads a manga on a shared event loop"""
+
+    def __init__(self,
+                 url         : str,
+                 client      : "aiohttp.ClientSession",
+                 limit       : asyncio.Semaphore,
+                 datasaver   : bool = True,
+                 language    : str = "English",
+                 language_id : str = "gb",
+                 state       : DownloadState = None,
+                 sync        : bool = False,
+                 output      : str = config.OUTPUT_FORMAT,
+                 selection   : ChapterSelection = None):
+
+        super().__init__(
+                         url,
+                         threaded=True,
+                         datasaver=datasaver,
+                         language=language,
+                         language_id=language_id,
+                         state=state,
+                         sync=sync,
+                         output=output,
+                         selection=selection)
+
+        self.client = client
+        self.limit  = limit
+        self.setup_limit = None
+
+
+    async def fetch_text(self, url : str, ttl : float) -> str:
+        """Retrieve a MangaDex api response (identical requests in flight at the same time are made once)"""
+
+        return await ASYNC_API_FLIGHTS.do((url, ttl), self.fetch_api_text, url, ttl)
+
+
+    async def fetch_api_text(self, url : str, ttl : float) -> str:
+        """Retrieve a MangaDex api response (through the response cache)"""
+
+        cache = response_cache()
+        body, headers, entry = await blocking(cache.lookup, url, ttl) if cache else (None, {}, None)
+
+        attempt = 0
+        while body is None:
+            trace = request_trace(url)
+            size = 0
+            status = None
+            wait = 0.0
+
+            # The api host's own limit first, so a throttled host never holds a shared slot
+            host = async_host_limit(url)
+            await host.acquire()
+            try:
+                async with self.limit:
+                    start = time.perf_counter()
+
+                    if trace:
+                        trace.phase("queue")
+
+                    try:
+                        async with self.client.get(url, headers=headers, trace_request_ctx=trace) as response:
+                            if trace:
+                                trace.phase("ttfb")
+
+                            body = await response.text()
+                            size = response.content.total_bytes
+                            status = response.status
+                            received = response.headers
+                            wait = retry_after(response.headers.get("Retry-After"))
+
+                            if status == 429 or status >= 500:
+                                body = None
+                            elif not cache and status != 200:
+                                body = None
+
+                    except (aiohttp.ClientError, asyncio.TimeoutError):
+                        status = None
+                        wait = 0.0
+
+            except BaseException: # Cancelled
+                host.cancel()
+                raise
+
+            host.release(status, time.perf_counter() - start, wait)
+            request_done(urlparse(url).netloc, status, time.perf_counter() - start)
+            if trace:
+                trace.done(status, size)
+
+            # Stored (or revalidated) once the request limit is released
+            if cache and body is not None:
+                body = await blocking(cache.complete, url, status, body, received, entry)
+
+            if body is not None:
+                break
+
+            # Retry with backoff, outside the request limit
+            error = PageError(status, wait)
+            attempt += 1
+            if not error.retryable or status == 200 or attempt >= config.RETRY_MAX_ATTEMPTS:
+                break
+            await asyncio.sleep(backoff(attempt, error.wait))
+
+        if body is None:
+            raise Exception(f"Failed to initialize '{self.name}'")
+
+        return body
+
+
+    async def fetch_json(self, url : str, ttl : float) -> dict:
+        """Retrieve and decode a MangaDex api response"""
+
+        return json.loads(await self.fetch_text(url, ttl))
+
+
+    async def async_image_urls(self, chapter_id : int) -> dict:
+        """Retrieve the list of image urls for a chapter"""
+
+        # Chapter info has its own limit so it can't queue ahead of every image download
+        async with self.setup_limit:
+            body = await self.fetch_text(self.chapter_api_url(chapter_id), self.chapter_ttl())
+
+        return self.add_chapter(self.read_chapter(chapter_id, body))
+
+
+    async def async_chapter_info(self) -> list:
+        """Retrieve the manga's chapter list (see chapter_info and feed_chapter_list)"""
+
+        if self.api != "v5":
+            body = await self.fetch_text(self.manga_api_url(), config.CACHE_TTL["manga"])
+            return await blocking(self.parse_chapter_list, body)
+
+        feed.check_manga_id(self.manga_id)
+        ttl = config.CACHE_TTL["manga"]
+
+        manga, first_page = await asyncio.gather(
+                                                 self.fetch_json(feed.manga_url(self.manga_id), ttl),
+                                                 self.fetch_json(feed.feed_url(self.manga_id, self.language_id, 0,
+                                                                               self.selection), ttl))
+
+        feed_pages = await asyncio.gather(*(self.fetch_json(feed.feed_url(self.manga_id, self.language_id, offset,
+                                                                          self.selection), ttl)
+                                            for offset in feed.feed_offsets(first_page)))
+
+        # Sync mode reads the chapters finished in earlier runs from the download state
+        return await blocking(self.choose_chapters, feed.manga_title(manga),
+                              feed.select_feed([first_page, *feed_pages], self.selection))
+
+
+    async def async_refresh_servers(self, curr_chapter : dict) -> NoReturn:
+        """Look up a chapter's image server again before its failed pages are retried (see refresh_servers)"""
+
+        if self.api != "v5":
+            return
+
+        try:
+            body = await self.fetch_text(self.chapter_api_url(curr_chapter["id"]), 0)
+        except Exception: # The pages are retried on the servers they had
+            return
+
+        self.update_servers(curr_chapter, self.read_chapter(curr_chapter["id"], body))
+
+
+    async def async_pipeline(self, chapter_id : int) -> NoReturn:
+        """Download a chapter as soon as its img urls arrive"""
+
+        curr_chapter = await self.async_image_urls(chapter_id)
+
+        await self.async_chapter(self.chapter_folder(curr_chapter), curr_chapter)
+
+
+    async def async_image(
+                          self,
+                          image_file   : str,
+                          curr_chapter : dict,
+                          image        : str,
+                          archive      : ChapterArchive,
+                          writes       : WriteGroup) -> NoReturn:
+        """Downloads an image into a specified file (or archive entry)"""
+
+        if await blocking(self.page_done, curr_chapter, image, archive, image_file):
+            return
+
+        if await blocking(self.reuse_page, curr_chapter, image, image_file, archive):
+            return
+
+        await self.async_download_page({"chapter":curr_chapter, "image":image, "file":image_file, "attempts":0, "writes":writes}, archive)
+
+
+    async def async_download_page(self, page : dict, archive : ChapterArchive) -> bool:
+        """Downloads a page, a failed page is deferred to the retry queue (see download_page)"""
+
+        try:
+            size, digest, sink = await self.async_fetch_page(page["chapter"], page["image"])
+        except PageError as error:
+            if self.retries.defer(page, error):
+                PAGE_RETRIES.inc()
+            else:
+                PAGES_FAILED.inc()
+                self.progress.page_failed()
+            return False
+
+        # Only waits (off the event loop) while the disk writer's queue is full
+        args = (page["writes"], size, self.save_page, page, archive, sink, size, digest)
+        if not disk_writer().submit(*args, block=False):
+            await asyncio.get_running_loop().run_in_executor(None, lambda: disk_writer().submit(*args))
+        return True
+
+
+    async def async_retry_pages(self) -> NoReturn:
+        """Retry the deferred pages as they come due, after the main pass (see retry_pages)"""
+
+        while len(self.retries):
+            await asyncio.sleep(self.retries.delay())
+
+            chapters = {}
+            for page in self.retries.due():
+                chapters.setdefault(page["chapter"]["id"], []).append(page)
+
+            await asyncio.gather(*(self.async_refresh_servers(chapter_pages[0]["chapter"])
+                                   for chapter_pages in chapters.values()))
+
+            archives = {}
+            writes = WriteGroup()
+            try:
+                pages = []
+                for chapter_id, chapter_pages in chapters.items():
+                    curr_chapter = chapter_pages[0]["chapter"]
+                    archives[chapter_id] = await blocking(self.open_archive, self.chapter_folder(curr_chapter),
+                                                          curr_chapter)
+
+                    for page in chapter_pages:
+                        page["writes"] = writes
+                        pages.append(self.async_download_page(page, archives[chapter_id]))
+
+                await asyncio.gather(*pages)
+
+            finally:
+                await asyncio.get_running_loop().run_in_executor(None, writes.wait)
+                for chapter_id, chapter_pages in chapters.items():
+                    await blocking(self.close_archive, archives.get(chapter_id), chapter_pages[0]["chapter"])
+                    await blocking(self.record_chapter, chapter_pages[0]["chapter"])
+
+
+    async def async_fetch_page(self, curr_chapter : dict, image : str) -> tuple:
+        """Downloads a page, hedged and failed over like the thread engine (see fetch_page)"""
+
+        race = PageRace(curr_chapter["servers"])
+        pending = {} # Task -> attempt
+        chapter = self.chapter_label(curr_chapter)
+
+        def launch() -> NoReturn:
+            attempt, server = race.launch()
+            url = f"{server}{curr_chapter['hash']}/{image}"
+            pending[asyncio.ensure_future(self.async_attempt(url, server, race, attempt, chapter))] = attempt
+
+        launch()
+
+        try:
+            while pending:
+                done, _ = await asyncio.wait(list(pending), timeout=race.timeout(), return_when=asyncio.FIRST_COMPLETED)
+
+                for task in done:
+                    del pending[task]
+                    result = task.result()
+                    if result:
+                        return result
+
+                if race.another(bool(done), list(pending.values())):
+                    launch()
+
+        finally:
+            race.abandon()
+            for task in pending:
+                task.cancel()
+
+        raise race.error
+
+
+    async def async_attempt(
+                            self,
+                            url        : str,
+                            server     : str,
+                            race       : PageRace,
+                            attempt    : int,
+                            chapter    : str = None) -> tuple:
+        """Streams one request for a page (see page_attempt)"""
+
+        health = server_health(server)
+        sink = None # Only opened once the page starts arriving
+        trace = request_trace(url, chapter)
+        status = None
+        wait = 0.0
+        written = 0
+        start = None
+
+        host = async_host_limit(url)
+        held = False # Whether the attempt holds a slot of the host's limit
+
+        try:
+            await host.acquire()
+            held = True
+
+            async with self.limit:
+                race.sent(attempt)
+                start = time.perf_counter()
+
+                if trace:
+                    trace.phase("queue")
+
+                async with self.client.get(url, trace_request_ctx=trace) as response:
+                    status = response.status
+
+                    if trace:
+                        trace.phase("ttfb")
+
+                    if response.status != 200:
+                        wait = retry_after(response.headers.get("Retry-After"))
+                        health.failed()
+                        race.fail(response.status, wait)
+                        return None
+
+                    sink = page_sink()
+                    digest = hashlib.sha256()
+
+                    async for chunk in response.content.iter_chunked(config.CHUNK_SIZE):
+                        if race.over(): # Another attempt delivered the page
+                            drop_sink(sink)
+                            return None
+
+                        sink.write(chunk)
+                        digest.update(chunk)
+                        written += len(chunk)
+
+                    problem = page_problem(url, written, digest.hexdigest(), content_length(response.headers))
+                    if problem:
+                        PAGES_DAMAGED.inc()
+                        health.failed()
+                        race.fail(reason=problem)
+                        drop_sink(sink)
+                        return None
+
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError):
+            health.failed()
+            race.fail()
+            drop_sink(sink)
+            return None
+
+        except BaseException: # Cancelled, another attempt delivered the page
+            drop_sink(sink)
+            status = status or "cancelled"
+            raise
+
+        finally:
+            elapsed = time.perf_counter() - start if start is not None else 0.0
+
+            if held:
+                if status == "cancelled":
+                    host.cancel()
+                else:
+                    host.release(status, elapsed, wait)
+
+            if start is not None:
+                request_done(urlparse(url).netloc, status, elapsed)
+            if trace:
+                trace.done(status, written)
+
+        latency = time.perf_counter() - start
+        health.succeeded(latency)
+        TRACKER.record(latency)
+        PAGE_SECONDS.observe(latency)
+
+        if not race.claim(attempt):
+            drop_sink(sink)
+            return None
+
+        return written, digest.hexdigest(), sink
+
+
+    async def async_chapter(self, chapter_folder : str, curr_chapter : dict) -> NoReturn:
+        """Downloads every image in a chapter concurrently"""
+
+        archive = await blocking(self.open_archive, chapter_folder, curr_chapter)
+        if self.output == "cbz" and archive is None:
+            return
+
+        if not archive:
+            await blocking(disk_writer().make_folder, chapter_folder)
+
+        # Same page naming as the thread engine (based on 1, 2, 3, etc.)
+        writes = WriteGroup()
+        pages = []
+        for index, image in enumerate(curr_chapter["images"]):
+            image_file = self.page_target(chapter_folder, index, image, archive)
+            pages.append(self.async_image(image_file, curr_chapter, image, archive, writes))
+
+        try:
+            await asyncio.gather(*pages)
+        finally:
+            await asyncio.get_running_loop().run_in_executor(None, writes.wait)
+            await blocking(self.close_archive, archive, curr_chapter)
+
+        await blocking(self.record_chapter, curr_chapter)
+
+
+    async def async_initialize(self) -> int:
+        """Get chapter ids and img urls for each chapter, then download every image (returns 1 if every page finished)"""
+
+        try:
+            chapter_list = await self.async_chapter_info()
+
+            if not chapter_list:
+                if self.sync:
+                    self.progress.note(f"Already up to date        : '{self.name}'")
+                else:
+                    self.progress.note(f"Failed to initialize      : '{self.name}'")
+                return int(self.sync) # Nothing new counts as finished
+
+            makedirs(self.name, exist_ok=True)
+
+            self.setup_limit = asyncio.Semaphore(config.MAX_CHAPTER_THREADS)
+            results = await asyncio.gather(
+                                           *(self.async_pipeline(chapter) for chapter in chapter_list),
+                                           return_exceptions=True)
+
+            # A failed chapter doesn't stop the rest of the manga
+            for result in results:
+                if isinstance(result, Exception):
+                    self.chapter_failed(result)
+
+            await self.async_retry_pages()
+
+            if self.report_unfinished():
+                return 0 # Not finished, a later run downloads the missing pages and chapters
+
+        except Exception as error:
+            self.progress.note(f"Download failed           : {error}")
+            return 0
+
+        finally:
+            self.progress.finish()
+
+        return 1
+
+
+def trace_config() -> "aiohttp.TraceConfig":
+    """Returns an aiohttp trace config that adds dns lookups and new connections to request traces"""
+
+    def started(name : str):
+        async def record(session, context, params) -> NoReturn:
+            setattr(context, name, time.perf_counter())
+        return record
+
+    def ended(name : str):
+        async def record(session, context, params) -> NoReturn:
+            if context.trace_request_ctx:
+                context.trace_request_ctx.span(name, getattr(context, name), time.perf_counter())
+        return record
+
+    config_trace = aiohttp.TraceConfig()
+    config_trace.on_dns_resolvehost_start.append(started("dns"))
+    config_trace.on_dns_resolvehost_end.append(ended("dns"))
+    config_trace.on_connection_create_start.append(started("connect"))
+    config_trace.on_connection_create_end.append(ended("connect"))
+    return config_trace
+
+
+async def download_all(
+                       url_list    : list,
+                       datasaver   : bool,
+                       language    : str,
+                       language_id : str,
+                       state       : DownloadState = None,
+                       sync        : bool = False,
+                       output      : str = config.OUTPUT_FORMAT,
+                       selection   : ChapterSelection = None) -> list:
+    """Download every manga in the list using one client and one concurrency limit
+
+    Returns whether each manga finished (1 or 0, in list order)
+    """
+
+    limit = asyncio.Semaphore(config.MAX_ASYNC_REQUESTS)
+    connector = aiohttp.TCPConnector(
+                                     limit=config.MAX_ASYNC_REQUESTS,
+                                     limit_per_host=config.MAX_ASYNC_REQUESTS)
+
+    trace_configs = [trace_config()] if tracer() else []
+
+    # Same connect and read timeouts as the thread engine, no limit on a whole (large) page
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=config.CONNECT_TIMEOUT, sock_read=config.READ_TIMEOUT)
+
+    async with aiohttp.ClientSession(connector=connector, trace_configs=trace_configs, timeout=timeout) as client:
+        downloads = []
+        for url in url_list:
+            manga = AsyncMangaDownloader(
+                                         url,
+                                         client,
+                                         limit,
+                                         datasaver=datasaver,
+                                         language=language,
+                                         language_id=language_id,
+                                         state=state,
+                                         sync=sync,
+                                         output=output,
+                                         selection=selection)
+            downloads.append(manga.async_initialize())
+
+        return await asyncio.gather(*downloads)
+
+
+def start(
+          url_list    : list,
+          datasaver   : bool,
+          language    : str,
+          language_id : str,
+          state       : DownloadState = None,
+          sync        : bool = False,
+          output      : str = config.OUTPUT_FORMAT,
+          selection   : ChapterSelection = None) -> list:
+    """Run every manga download on a single event loop, returns whether each manga finished"""
+
+    ASYNC_HOSTS.clear() # Their events belong to the last event loop
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(
+                                       download_all(url_list, datasaver, language, language_id, state, sync, output, selection))
+    finally:
+        loop.close()
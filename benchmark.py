@@ -0,0 +1,522 @@
+"""Benchmark module that contains:
+                                   An offline end to end benchmark of MangaDownloader
+
+                                   Runs the downloader against a local mock server (mock_server.py)
+                                   and reports throughput, page latency, peak memory and threads"""
+import argparse
+import asyncio
+import json
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zipfile
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from os import (chdir, getcwd, path, walk)
+from typing import NoReturn
+
+import async_downloader
+import config
+import dedup
+import hedge
+import mock_server
+import postprocess
+import tracing
+
+from chapters import select_chapters
+from downloader import MangaDownloader
+from progress import PROGRESS
+
+
+SCRIPT_DIR = path.dirname(path.abspath(__file__))
+
+PAGE_LATENCIES = []
+m_latency = threading.Lock()
+
+
+def record_latency(seconds : float) -> NoReturn:
+    with m_latency:
+        PAGE_LATENCIES.append(seconds)
+
+
+def timed(method):
+    """Wraps a page download method to record how long each page took"""
+
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            record_latency(time.perf_counter() - start)
+
+    return wrapper
+
+
+def timed_async(method):
+    """Wraps an async page download method to record how long each page took"""
+
+    @wraps(method)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await method(*args, **kwargs)
+        finally:
+            record_latency(time.perf_counter() - start)
+
+    return wrapper
+
+
+class Sampler():
+    """Samples the process thread count on a background thread"""
+
+    def __init__(self, interval : float = 0.01):
+
+        self.interval = interval
+        self.peak_threads = threading.active_count()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+
+    def run(self) -> NoReturn:
+        while self.running:
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+            time.sleep(self.interval)
+
+
+    def __enter__(self) -> "Sampler":
+        self.thread.start()
+        return self
+
+
+    def __exit__(self, *args) -> NoReturn:
+        self.running = False
+        self.thread.join()
+
+
+def percentile(values : list, fraction : float) -> float:
+    """Returns the value at a percentile of a list (0.0 if the list is empty)"""
+
+    if not values:
+        return 0.0
+
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def peak_rss_mb() -> float:
+    """Returns the peak resident memory of this process in MB"""
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes everywhere else
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def git_commit() -> str:
+    """Returns the current git commit (None outside a git checkout)"""
+
+    try:
+        return subprocess.run(
+                              ["git", "rev-parse", "--short", "HEAD"],
+                              cwd=SCRIPT_DIR,
+                              capture_output=True,
+                              text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def start_mock(args : argparse.Namespace) -> tuple:
+    """Start the mock server in its own process, returns (process, api url of the benchmarked api)
+
+    A separate process keeps the server's memory and threads out of the measurements
+    """
+    command = [sys.executable, path.join(SCRIPT_DIR, "mock_server.py"), "--port", "0"]
+    for name in ("chapters", "pages", "page_bytes", "groups", "shared_pages", "languages",
+                 "latency", "bandwidth", "error_rate", "error_status", "seed", "slow_rate", "slow_latency",
+                 "corrupt_rate"):
+        command += [f"--{name.replace('_', '-')}", str(getattr(args, name))]
+    if args.png or args.postprocess:
+        command.append("--png")
+
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline().strip()
+
+    if not line.startswith("Serving "):
+        process.kill()
+        raise Exception("Failed to start the mock server")
+
+    return process, line.split()[1] + mock_server.API_PATHS[args.api]
+
+
+def run_threaded(url_list : list, threaded : bool, datasaver : bool, output : str) -> NoReturn:
+    """Download every manga with the thread engine"""
+
+    MangaDownloader.threaded_image = timed(MangaDownloader.threaded_image)
+
+    with ThreadPoolExecutor(max_workers=config.MAX_MANGA_THREADS) as executor:
+        for url in url_list:
+            manga = MangaDownloader(url, threaded=threaded, datasaver=datasaver, output=output)
+            executor.submit(manga.initialize)
+
+
+def run_async(url_list : list, datasaver : bool, output : str) -> NoReturn:
+    """Download every manga with the async engine"""
+
+    async_downloader.AsyncMangaDownloader.async_image = timed_async(
+                                                        async_downloader.AsyncMangaDownloader.async_image)
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(async_downloader.download_all(url_list, datasaver, "English", "gb", output=output))
+    finally:
+        loop.close()
+
+
+def output_size(output_dir : str) -> tuple:
+    """Returns the number of output files (pages or archives) and their total size in an output folder"""
+
+    files = 0
+    size = 0
+    for root, folders, names in walk(output_dir):
+        # Skip the state, cache and page store
+        folders[:] = [folder for folder in folders if not folder.startswith("mdd_")]
+        for name in names:
+            if name.startswith("mdd_"):
+                continue
+            files += 1
+            size += path.getsize(path.join(root, name))
+
+    return files, size
+
+
+def pages_done() -> tuple:
+    """Returns the number of pages downloaded and their total size (from the progress counters)"""
+
+    pages = sum(progress.pages_done for progress in PROGRESS.manga)
+    size = sum(progress.bytes_done for progress in PROGRESS.manga)
+    return pages, size
+
+
+def run(args : argparse.Namespace) -> dict:
+    """Run one benchmark and return its parameters and results"""
+
+    process, api_url = start_mock(args)
+    config.API_BACKEND = args.api
+    config.API_URL = api_url
+    config.USE_PAGE_STORE = args.dedup
+    config.HEDGE = args.hedge
+    config.POSTPROCESS = args.postprocess.split(",") if args.postprocess else []
+
+    if args.trace:
+        config.TRACE = True
+        config.TRACE_FILE = path.abspath(args.trace) # The run changes into a temporary directory
+
+    url_list = [mock_server.title_url(manga_id, args.api) for manga_id in range(1, args.manga + 1)]
+
+    cwd = getcwd()
+    with tempfile.TemporaryDirectory() as output_dir:
+        chdir(output_dir)
+        try:
+            cpu_start = time.process_time()
+            with Sampler() as sampler:
+                time_start = time.perf_counter()
+
+                if args.engine == "async":
+                    run_async(url_list, args.datasaver, args.format)
+                else:
+                    run_threaded(url_list, args.threaded, args.datasaver, args.format)
+
+                postprocess.wait_post_processing()
+                elapsed = time.perf_counter() - time_start
+            cpu = time.process_time() - cpu_start
+
+            pages, size = pages_done()
+            files, output_bytes = output_size(output_dir)
+            store = dedup.STORE.stats() if dedup.STORE else {"reused":0, "bytes_saved":0, "bytes_linked":0}
+        finally:
+            chdir(cwd)
+            process.terminate()
+            process.wait()
+
+    return {
+            "commit":git_commit(),
+            "label":args.label,
+            "parameters":{
+                          "api":args.api,
+                          "engine":args.engine,
+                          "threaded":args.threaded,
+                          "datasaver":args.datasaver,
+                          "format":args.format,
+                          "manga":args.manga,
+                          "chapters":args.chapters,
+                          "pages":args.pages,
+                          "page_bytes":args.page_bytes,
+                          "groups":args.groups,
+                          "shared_pages":args.shared_pages,
+                          "dedup":args.dedup,
+                          "postprocess":args.postprocess,
+                          "hedge":args.hedge,
+                          "trace":bool(args.trace),
+                          "slow_rate":args.slow_rate,
+                          "slow_latency":args.slow_latency,
+                          "languages":args.languages,
+                          "latency":args.latency,
+                          "bandwidth":args.bandwidth,
+                          "error_rate":args.error_rate,
+                          "corrupt_rate":args.corrupt_rate,
+                          },
+            "results":{
+                       "seconds":round(elapsed, 3),
+                       "pages":pages,
+                       "bytes":size,
+                       "files":files,
+                       "output_bytes":output_bytes,
+                       "pages_per_s":round(pages / elapsed, 2),
+                       "mb_per_s":round(size / elapsed / (1024 * 1024), 2),
+                       "p50_ms":round(percentile(PAGE_LATENCIES, 0.50) * 1000, 2),
+                       "p99_ms":round(percentile(PAGE_LATENCIES, 0.99) * 1000, 2),
+                       "cpu_seconds":round(cpu, 3),
+                       "peak_rss_mb":round(peak_rss_mb(), 1),
+                       "peak_threads":sampler.peak_threads,
+                       "requests_saved":store["reused"],
+                       "bytes_saved":store["bytes_saved"], # Not downloaded (filled from the store)
+                       "bytes_linked":store["bytes_linked"], # Downloaded, then replaced by a link
+                       "hedges":hedge.TRACKER.hedges,
+                      },
+            }
+
+
+def output_pages(output_dir : str) -> int:
+    """Returns the number of pages in an output folder (cbz archives are opened and counted)"""
+
+    pages = 0
+    for root, folders, names in walk(output_dir):
+        folders[:] = [folder for folder in folders if not folder.startswith("mdd_")]
+        for name in names:
+            if name.endswith(".cbz"):
+                with zipfile.ZipFile(path.join(root, name)) as archive:
+                    pages += len(archive.namelist())
+            elif not name.startswith("mdd_"):
+                pages += 1
+
+    return pages
+
+
+def run_workers(args : argparse.Namespace) -> dict:
+    """Run one benchmark with the manga spread over worker processes (main.py ledger mode)
+
+    The run is measured from the outside, latency percentiles aren't available and
+    peak memory is that of the largest worker
+    """
+    process, api_url = start_mock(args)
+
+    command = [
+               sys.executable, path.join(SCRIPT_DIR, "main.py"),
+               "--ledger", "mdd_ledger.sqlite3",
+               "--workers", str(args.workers),
+               "--api", args.api,
+               "--api-url", api_url,
+               "--engine", args.engine,
+               "--format", args.format,
+               "--no-check"]
+    if not args.threaded:
+        command.append("--no-threaded")
+    if not args.datasaver:
+        command.append("--no-datasaver")
+    if args.dedup:
+        command.append("--dedup")
+    if args.postprocess:
+        command += ["--postprocess", args.postprocess]
+    command += [mock_server.title_url(manga_id, args.api) for manga_id in range(1, args.manga + 1)]
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        try:
+            usage_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+            time_start = time.perf_counter()
+
+            subprocess.run(command, cwd=output_dir, stdout=subprocess.DEVNULL, check=True)
+
+            elapsed = time.perf_counter() - time_start
+            usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+            pages = output_pages(output_dir)
+            files, output_bytes = output_size(output_dir)
+        finally:
+            process.terminate()
+            process.wait()
+
+    cpu = usage.ru_utime + usage.ru_stime - usage_start.ru_utime - usage_start.ru_stime
+    # ru_maxrss is in bytes on macOS and kilobytes everywhere else
+    peak = usage.ru_maxrss / (1024 * 1024) if sys.platform == "darwin" else usage.ru_maxrss / 1024
+
+    return {
+            "commit":git_commit(),
+            "label":args.label,
+            "parameters":{
+                          "api":args.api,
+                          "engine":args.engine,
+                          "workers":args.workers,
+                          "threaded":args.threaded,
+                          "datasaver":args.datasaver,
+                          "format":args.format,
+                          "manga":args.manga,
+                          "chapters":args.chapters,
+                          "pages":args.pages,
+                          "page_bytes":args.page_bytes,
+                          "dedup":args.dedup,
+                          "postprocess":args.postprocess,
+                          "latency":args.latency,
+                          "bandwidth":args.bandwidth,
+                          "error_rate":args.error_rate,
+                          },
+            "results":{
+                       "seconds":round(elapsed, 3),
+                       "pages":pages,
+                       "files":files,
+                       "output_bytes":output_bytes,
+                       "pages_per_s":round(pages / elapsed, 2),
+                       "mb_per_s":round(output_bytes / elapsed / (1024 * 1024), 2),
+                       "cpu_seconds":round(cpu, 3),
+                       "peak_rss_mb":round(peak, 1),
+                      },
+            }
+
+
+def decode_chapters(body : str, language_id : str) -> list:
+    """The chapter list parse select_chapters replaced (decodes the whole response), for reference"""
+
+    selected = {}
+    for chapter in json.loads(body)["data"]["chapters"]:
+        if chapter["language"] != language_id:
+            continue
+
+        number = chapter["chapter"] or "0"
+        if number not in selected or selected[number]["views"] < chapter["views"]:
+            selected[number] = chapter
+
+    return [chapter["id"] for chapter in selected.values()]
+
+
+def measure_parse(parse, body : str, language_id : str) -> tuple:
+    """Returns the seconds and peak MB of memory a chapter list parse takes"""
+
+    time_start = time.perf_counter()
+    parse(body, language_id)
+    elapsed = time.perf_counter() - time_start
+
+    # Traced separately, tracing slows the parse down
+    tracemalloc.start()
+    parse(body, language_id)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return elapsed, peak / 1024 / 1024
+
+
+def run_parse(args : argparse.Namespace) -> dict:
+    """Benchmark parsing a synthetic chapter list (no server or downloads)"""
+
+    languages = args.languages.split(",")
+    catalog = mock_server.Catalog(chapters=args.chapters, groups=args.groups, languages=languages)
+    body = json.dumps(catalog.manga(1))
+    entries = args.chapters * args.groups * len(languages)
+
+    streamed, streamed_mb = measure_parse(select_chapters, body, languages[0])
+    decoded, decoded_mb = measure_parse(decode_chapters, body, languages[0])
+
+    return {
+            "label":args.label,
+            "commit":git_commit(),
+            "parameters":{
+                          "chapters":args.chapters,
+                          "groups":args.groups,
+                          "languages":args.languages,
+                          "entries":entries,
+                          "body_mb":round(len(body) / 1024 / 1024, 1),
+                         },
+            "results":{
+                       "parse_s":round(streamed, 3),
+                       "parse_peak_mb":round(streamed_mb, 1),
+                       "decode_s":round(decoded, 3),
+                       "decode_peak_mb":round(decoded_mb, 1),
+                      },
+            }
+
+
+def print_results(result : dict, baseline : dict = None) -> NoReturn:
+    """Display benchmark results (and the change from a baseline result)"""
+
+    print(f"Benchmark {result['label'] or ''} (commit {result['commit']})")
+
+    for name, value in result["results"].items():
+        line = f"    {name:<14}: {value}"
+
+        if baseline and name in baseline["results"] and baseline["results"][name]:
+            old = baseline["results"][name]
+            line += f"    ({(value - old) / old * 100:+.1f}% vs {old})"
+
+        print(line)
+
+
+def main() -> NoReturn:
+    """Run the benchmark from the command line"""
+
+    parser = argparse.ArgumentParser(description="Offline MangaDex Downloader benchmark")
+    parser.add_argument("--engine", choices=config.ENGINES, default=config.ENGINE)
+    parser.add_argument("--api", choices=config.API_BACKENDS, default=config.API_BACKEND, help="metadata api")
+    parser.add_argument("--no-threaded", dest="threaded", action="store_false",
+                        help="use the single threaded downloader")
+    parser.add_argument("--no-datasaver", dest="datasaver", action="store_false")
+    parser.add_argument("--format", choices=config.OUTPUT_FORMATS, default=config.OUTPUT_FORMAT)
+    parser.add_argument("--no-hedge", dest="hedge", action="store_false", help="disable hedged page requests")
+    parser.add_argument("--dedup", action="store_true", help="download identical pages once (page store)")
+    parser.add_argument("--postprocess", default=None, metavar="STEPS",
+                        help="post-process every page (comma separated steps, pages are served as PNGs)")
+    parser.add_argument("--trace", default=None, metavar="TRACE_FILE",
+                        help="trace every request and page write, saved as a Chrome trace")
+    parser.add_argument("--manga", type=int, default=1, help="number of manga to download")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="spread the manga over this many worker processes (job ledger), 0 runs in process")
+    parser.add_argument("--label", default=None, help="name stored with the results")
+    parser.add_argument("--output", default=None, help="write the results to a json file")
+    parser.add_argument("--compare", default=None, help="json result file to compare against")
+    parser.add_argument("--parse", action="store_true",
+                        help="only benchmark parsing the chapter list (--chapters x --groups x --languages entries)")
+    mock_server.add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.engine == "async" and not async_downloader.available():
+        parser.error("the async engine requires aiohttp")
+
+    if args.postprocess and not postprocess.available():
+        parser.error("post-processing requires Pillow")
+
+    if args.parse:
+        result = run_parse(args)
+    elif args.workers:
+        result = run_workers(args)
+    else:
+        result = run(args)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as compare_file:
+            baseline = json.load(compare_file)
+
+    print_results(result, baseline)
+    postprocess.print_postprocess_stats()
+    tracing.print_trace_summary()
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(result, output_file, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""Chapters module that contains:
+                                 A single pass parse of the api v2 chapter list
+
+                                 Chapters are decoded one at a time straight from the response
+                                 text, filtered by language and deduplicated by views as they are
+                                 read, only a small record per chapter number is kept"""
+import json
+import re
+
+from scheduler import chapter_priority
+from selection import ChapterSelection
+
+
+whitespace = re.compile(r"\s*")
+separator = re.compile(r"\s*(?:(,)\s*|\])") # Between the elements of an array (or its end)
+DECODER = json.JSONDecoder()
+
+
+class ChapterRecord():
+    """The fields of a chapter that are needed to pick and download it"""
+
+    __slots__ = ("id", "chapter", "volume", "views")
+
+    def __init__(self, chapter_id : int, chapter : str, volume : str, views : int):
+
+        self.id = chapter_id
+        self.chapter = chapter
+        self.volume = volume
+        self.views = views
+
+
+def skip(text : str, pos : int, expected : str = None) -> int:
+    """Skip whitespace (and an expected character), returns the new position"""
+
+    pos = whitespace.match(text, pos).end()
+
+    if expected:
+        if text[pos:pos+1] != expected:
+            raise ValueError(f"Expected '{expected}' at {pos} in the chapter list")
+        pos = whitespace.match(text, pos + 1).end()
+
+    return pos
+
+
+def find_key(text : str, pos : int, key : str) -> int:
+    """Returns the position of a key's value in the json object starting at pos (None if missing)
+
+    Values of the other keys are skipped over
+    """
+    pos = skip(text, pos, "{")
+
+    while text[pos:pos+1] != "}":
+        name, pos = DECODER.raw_decode(text, pos)
+        pos = skip(text, pos, ":")
+
+        if name == key:
+            return pos
+
+        _, pos = DECODER.raw_decode(text, pos)
+        pos = skip(text, pos)
+        if text[pos:pos+1] == ",":
+            pos = skip(text, pos, ",")
+
+    return None
+
+
+def iter_chapters(text : str):
+    """Decode the chapters of an api v2 chapter list response one at a time"""
+
+    pos = find_key(text, 0, "data")
+    if pos is not None:
+        pos = find_key(text, pos, "chapters")
+    if pos is None:
+        return
+
+    pos = skip(text, pos, "[")
+    if text[pos:pos+1] == "]":
+        return
+
+    scan = DECODER.scan_once
+
+    while True:
+        try:
+            chapter, pos = scan(text, pos)
+        except StopIteration:
+            raise ValueError(f"Expected a chapter at {pos} in the chapter list") from None
+        yield chapter
+
+        match = separator.match(text, pos)
+        if match is None:
+            raise ValueError(f"Expected ',' or ']' at {pos} in the chapter list")
+        if match[1] is None:
+            return
+        pos = match.end()
+
+
+def select_chapters(text : str, language_id : str, selection : ChapterSelection = None) -> tuple:
+    """Returns the manga title and one chapter record per chapter number in a language
+
+    Chapters released by several groups keep the release with the most views (releases
+    of groups the selection excludes are skipped), records are returned in download
+    priority order
+    """
+    title = None
+    selected = {} # Chapter number -> ChapterRecord
+
+    for chapter in iter_chapters(text):
+        if title is None:
+            title = chapter["mangaTitle"]
+
+        if chapter["language"] != language_id:
+            continue
+
+        if selection and selection.excluded(chapter["groups"], chapter["id"]):
+            continue
+
+        # Empty chapter numbers (oneshots) count as chapter 0
+        number = chapter["chapter"] or "0"
+        views = chapter["views"]
+
+        record = selected.get(number)
+        if record is None:
+            selected[number] = ChapterRecord(chapter["id"], number, chapter["volume"], views)
+        elif record.views < views:
+            record.id = chapter["id"]
+            record.volume = chapter["volume"]
+            record.views = views
+
+    records = sorted(selected.values(), key=lambda record: chapter_priority(record.chapter))
+    return title, records
@@ -3,7 +3,6 @@
 
                                 Configuration constants"""
 import re
-import time
 
 from os import (name as sys_name, system)
 from typing import NoReturn
@@ -11,25 +10,201 @@ from typing import NoReturn
 import requests
 
 
+# Metadata api: "v5" (the current api, chapters are listed by a paginated feed whose pages
+# are requested at once when the first one gives the total, each chapter's image server
+# comes from the at-home endpoint) or "v2" (the retired api, one chapter list response)
+API_BACKEND    = "v5"
+API_BACKENDS   = ["v5", "v2"]
+API_URLS       = {
+                  "v5" : "https://api.mangadex.org",
+                  "v2" : "https://mangadex.org/api/v2",
+                 }
+API_URL        = API_URLS[API_BACKEND]
+FEED_PAGE_SIZE = 500 # Chapters per feed request (the api's maximum)
+
 MAX_MANGA_THREADS   = 2 # One more for the display function
 MAX_CHAPTER_THREADS = 10
 MAX_IMAGE_THREADS   = 10
-MAX_INITIALIZATION_THREADS = 10
+MAX_INITIALIZATION_THREADS = 10 # Feed pages requested at once (api v5)
+
+# Page downloads of every manga (threaded mode) run on one shared pool of workers,
+# handed out round robin between manga. Within a manga pages are downloaded in
+# chapter priority order: "lowest" (chapter 1 first), "highest" or "none" (api order)
+MAX_PAGE_WORKERS   = 4 * MAX_IMAGE_THREADS
+CHAPTER_PRIORITY   = "lowest"
+CHAPTER_PRIORITIES = ["lowest", "highest", "none"]
+
+# Hedged requests: a page still downloading after the HEDGE_PERCENTILE of recent page
+# latencies is requested again (from the fallback server if the chapter has one), at most
+# for HEDGE_BUDGET of all pages. Image servers failing SERVER_MAX_FAILURES times in a row
+# are dropped for the rest of the run.
+HEDGE               = True
+HEDGE_PERCENTILE    = 0.95
+HEDGE_WINDOW        = 500  # Recent page latencies the percentile is taken from
+HEDGE_MIN_SAMPLES   = 20   # No hedging until this many pages finished
+HEDGE_REFRESH       = 16   # Pages between deadline updates
+HEDGE_MIN_DELAY     = 0.05 # Seconds
+HEDGE_POLL          = 0.25 # Seconds between checks while no deadline applies
+HEDGE_BUDGET        = 0.1
+SERVER_MAX_FAILURES = 5
+
+# Retries: failed pages are retried after the main pass and failed api requests right
+# away, waiting RETRY_BASE_DELAY doubled per attempt (with jitter, at most RETRY_MAX_DELAY
+# or as long as a Retry-After asks). Refused connections are retried immediately.
+RETRY_MAX_ATTEMPTS = 5
+RETRY_BASE_DELAY   = 0.5 # Seconds
+RETRY_MAX_DELAY    = 30.0
+CONNECT_RETRIES    = 3
+
+# Chapters whose img urls have been retrieved but haven't started downloading yet
+# (chapter info requests stop once this many are waiting)
+PIPELINE_DEPTH = 10
+
+# Adaptive (AIMD) concurrency limit per host (api and each image server separately)
+# Starts at the image thread count, grows while the host stays healthy and never passes the cap
+HOST_START_CONCURRENCY = MAX_IMAGE_THREADS
+HOST_MAX_CONCURRENCY   = MAX_CHAPTER_THREADS * MAX_IMAGE_THREADS
+AIMD_DECREASE          = 0.5  # Limit multiplier on 429/5xx/connection errors
+AIMD_LATENCY_TOLERANCE = 2.0  # Limit stops growing past this multiple of the host's healthy latency
+AIMD_LATENCY_SLACK     = 0.05 # Plus this many seconds (keeps very fast hosts from looking slow)
+AIMD_LATENCY_WEIGHT    = 0.1  # Weight of new requests in the latency moving average
+AIMD_MIN_WINDOW        = 0.25 # Minimum seconds between two decreases
+
+# Images are read from the network (and copied to disk) in chunks of this size
+CHUNK_SIZE = 64 * 1024
+
+# Persistent download state (stored next to the manga folders), used to resume
+# interrupted downloads and to only download new chapters in sync mode
+USE_STATE  = True
+STATE_FILE = "mdd_state.sqlite3"
+
+# On-disk cache of api responses (least recently used responses are evicted past the size limit)
+# Chapter lists change when chapters are published, chapter details almost never change
+# (None never expires, but the image server in a chapter response can go stale)
+# Past the limit the cache is trimmed down to CACHE_TRIM_TO of it, so eviction runs rarely
+USE_CACHE       = True
+CACHE_FILE      = "mdd_cache.sqlite3"
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+CACHE_TRIM_TO   = 0.9
+CACHE_TTL       = {
+                   "manga"   : 10 * 60,
+                   "chapter" : 24 * 60 * 60,
+                   "at-home" : 5 * 60, # Image servers are handed out for 15 minutes
+                  }
+
+# Content addressed page store: pages are kept under their sha256 so identical pages
+# (credit and recruitment pages, covers) are downloaded once and hardlinked everywhere else
+USE_PAGE_STORE = False
+PAGE_STORE_DIR = "mdd_store"
+
+# Tracing: phase timings of every request and page write, saved as a Chrome trace
+# (ui.perfetto.dev or chrome://tracing) with a report of the slowest hosts and chapters
+TRACE      = False
+TRACE_FILE = "mdd_trace.json"
+TRACE_TOP  = 5 # Hosts and chapters in the report
+
+# Metrics: counters, gauges and latency histograms of the run, served in the Prometheus
+# text format on http://METRICS_HOST:METRICS_PORT/metrics when a port is set
+METRICS_PORT        = None
+METRICS_HOST        = "127.0.0.1"
+METRICS_FILE        = None # Json file the metrics are saved to at the end of a run
+METRICS_RATE_WINDOW = 10   # Seconds pages/s and bytes/s are averaged over
+METRICS_BUCKETS     = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0) # Seconds
+
+# Job ledger (--ledger): a SQLite file every worker process can reach (a shared folder for
+# workers on other machines). Workers lease manga for LEDGER_LEASE seconds and keep renewing
+# the lease while downloading, the manga of a crashed worker are leased again once it runs
+# out. A manga fails for good after LEDGER_MAX_ATTEMPTS leases
+LEDGER_LEASE        = 60.0 # Seconds
+LEDGER_MAX_ATTEMPTS = 3
+LEDGER_POLL         = 2.0  # Seconds between checks while other workers hold the last manga
+LEDGER_REPORT       = 5.0  # Seconds between progress lines of the coordinator
+SQLITE_TIMEOUT      = 30.0 # Seconds a SQLite file locked by another process is waited for
+
+# Progress display: "auto" (only when writing to a terminal), "on" or "off"
+PROGRESS     = "auto"
+PROGRESS_FPS = 4 # Maximum redraws per second
+
+# Service mode: url list files with this suffix are picked up from the spool directory
+SPOOL_SUFFIX = ".txt"
+SPOOL_POLL   = 2.0 # Seconds between spool directory checks
+
+# Output format: "folder" (<title>/Chapter_N/<page>) or "cbz" (<title>/Chapter_N.cbz)
+# In cbz mode pages are streamed into the archive
+OUTPUT_FORMAT   = "folder"
+OUTPUT_FORMATS  = ["folder", "cbz"]
+
+# Disk writer: downloaded pages are buffered in memory (up to PAGE_SPOOL_BYTES each, larger
+# ones spill to a temporary file) and handed to writer threads, so network workers never wait
+# on storage. Pages waiting for a writer are capped at WRITE_QUEUE_BYTES (downloads pause),
+# and so is the memory of all page buffers together (pages being downloaded included), past
+# it pages spill to temporary files. Peak page memory is WRITE_QUEUE_BYTES, not image size
+PAGE_SPOOL_BYTES  = 4 * 1024 * 1024
+WRITER_THREADS    = 4
+WRITE_QUEUE_BYTES = 64 * 1024 * 1024
+
+# Verify command: every recorded page is re-read (memory mapped) by VERIFY_THREADS threads
+# (None is one per CPU) and checked against its sha256, damaged pages are downloaded again
+VERIFY_THREADS = None
+MANGA_URL      = "https://mangadex.org/title/{}" # Manga whose damaged pages are downloaded again
+
+# Post-processing: steps run on every downloaded page (in memory) by worker processes, in order
+# ("verify" decode checks, "reencode" turns PNGs into REENCODE_FORMAT, "thumbnail" makes a
+# THUMBNAIL_SIZE jpeg), needs Pillow. Outputs go to POSTPROCESS_DIR/<step>/, next to nothing else.
+# Pages waiting for a process are capped at POSTPROCESS_QUEUE_BYTES (the disk writers pause)
+POSTPROCESS             = []
+POSTPROCESS_PROCESSES   = None # None is one per CPU
+POSTPROCESS_QUEUE_BYTES = 64 * 1024 * 1024
+POSTPROCESS_DIR         = "mdd_processed"
+REENCODE_FORMAT         = "webp" # "avif" needs a Pillow built with AVIF support
+REENCODE_QUALITY        = 80
+THUMBNAIL_SIZE          = (256, 256)
+
+# Download engine: "thread" (nested thread pools) or "async" (single event loop, needs aiohttp)
+ENGINE             = "thread"
+ENGINES            = ["thread", "async"]
+MAX_ASYNC_REQUESTS = MAX_MANGA_THREADS * MAX_CHAPTER_THREADS * MAX_IMAGE_THREADS
+# The async engine's download state, response cache, page store and archive calls run on
+# these threads, never on the event loop (one thread keeps the sqlite commits in order)
+ASYNC_IO_THREADS   = 1
+# The async engine waits for a host's adaptive limit (see AIMD above) on the event loop, checking
+# at least this often (seconds) in case the thread engine freed a slot
+ASYNC_HOST_POLL    = 0.05
+
+# Shared HTTP connection pool (one keep-alive pool per host, reused by every request)
+POOL_HOSTS   = 10 # Number of hosts (api + image servers) to keep pools open for
+POOL_MAXSIZE = MAX_MANGA_THREADS * MAX_CHAPTER_THREADS * MAX_IMAGE_THREADS
+
+# Seconds to wait for a connection and for each read on it (both engines), a stalled request
+# fails like a dropped connection: it is retried and slows its host down
+CONNECT_TIMEOUT = 10.0
+READ_TIMEOUT    = 30.0
 
 ENABLE = lambda x: "Enabled" if x else "Disabled"
 
+# (menu name, api v2 code, short name, api v5 code)
 LANGUAGE_LIST = [
-                ("English (Default)"     , "gb", "English"       ),
-                ("Chinese (simple)"      , "cn", "Chinese (s)"   ),
-                ("Chinese (traditional)" , "hk", "Chinese (t)"   ),
-                ("French"                , "fr", "French"        ),
-                ("Indonesian"            , "id", "Indonesian"    ),
-                ("Polish"                , "pl", "Polish"        ),
-                ("Portuguese (Brazil)"   , "br", "Portuguese (b)"),
-                ("Russian"               , "ru", "Russian"       ),
-                ("Spanish (Mexican)"     , "mx", "Spanish (m)"   ),
-                ("Spanish (Spain)"       , "es", "Spanish (s)"   ),
-                ("Vietnamese"            , "vn", "Vietnamese"    ) ]
+                ("English (Default)"     , "gb", "English"       , "en"   ),
+                ("Chinese (simple)"      , "cn", "Chinese (s)"   , "zh"   ),
+                ("Chinese (traditional)" , "hk", "Chinese (t)"   , "zh-hk"),
+                ("French"                , "fr", "French"        , "fr"   ),
+                ("Indonesian"            , "id", "Indonesian"    , "id"   ),
+                ("Polish"                , "pl", "Polish"        , "pl"   ),
+                ("Portuguese (Brazil)"   , "br", "Portuguese (b)", "pt-br"),
+                ("Russian"               , "ru", "Russian"       , "ru"   ),
+                ("Spanish (Mexican)"     , "mx", "Spanish (m)"   , "es-la"),
+                ("Spanish (Spain)"       , "es", "Spanish (s)"   , "es"   ),
+                ("Vietnamese"            , "vn", "Vietnamese"    , "vi"   ) ]
+
+
+def language_by_id(language_id : str) -> tuple:
+    """Returns the LANGUAGE_LIST entry for a language code (English if it isn't listed)"""
+
+    for language in LANGUAGE_LIST:
+        if language[1] == language_id:
+            return language
+
+    return LANGUAGE_LIST[0]
 
 
 def check_connection() -> int:
@@ -104,16 +279,9 @@ def clear_screen() -> NoReturn:
         _ = system('clear')
 
 
-def print_status(
-                status_dict  : dict,
-                finished     : int,
-                started      : int,
-                chapters_dl  : int,
-                chapters_tot : int,
-                options      : list) -> NoReturn:
-    """Display download setup status and download status for the manga downloads"""
+def print_banner(options : list) -> NoReturn:
+    """Display the program banner with the current options (threaded, datasaver, language)"""
 
-    clear_screen()
     print(f"\n\
                           #############################                              \n\
 ############################   MangaDex Downloader   ################################\n\
@@ -133,16 +301,3 @@ def print_status(
 #                                                                                   #\n\
 #                                                                                   #\n\
 #####################################################################################")
-    print(f"Started: {started} Finished: {finished}")
-    if status_dict:
-        for name, status in status_dict.items():
-            print(f"Downloading {name[:15]:<15}: {status}%")
-        if chapters_dl < chapters_tot:
-            print(f"Chapter info downloaded: {chapters_dl} of {chapters_tot} (setup stage)")
-    else:
-
-        # Display download setup status after initial chapter count has been downloaded
-        if chapters_dl < chapters_tot:
-            print(f"Chapter info downloaded: {chapters_dl} of {chapters_tot} (setup stage)")
-
-    time.sleep(0.5)
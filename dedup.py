@@ -0,0 +1,207 @@
+"""Dedup module that contains:
+                               A content addressed store of downloaded pages
+
+                               Pages are stored under their sha256, which MangaDex page filenames
+                               already embed, so a page seen before is never downloaded again and
+                               duplicate page files are hardlinks to a single copy"""
+import hashlib
+import re
+import shutil
+
+from os import (getpid, link, makedirs, path, remove, replace)
+from threading import (get_ident, Lock)
+from typing import NoReturn
+
+import config
+
+
+page_hash = re.compile(r"([0-9a-f]{64})\.\w+$")
+
+
+def page_digest(image : str) -> str:
+    """Returns the sha256 embedded in a MangaDex page filename (None if it has none)"""
+
+    match = page_hash.search(image)
+    return match[1] if match else None
+
+
+def stored_digest(stored : str) -> tuple:
+    """Returns the size and sha256 of a stored page, read back from disk"""
+
+    digest = hashlib.sha256()
+    size = 0
+
+    with open(stored, "rb") as stored_page:
+        for chunk in iter(lambda: stored_page.read(config.CHUNK_SIZE), b""):
+            digest.update(chunk)
+            size += len(chunk)
+
+    return size, digest.hexdigest()
+
+
+def temp_name(target : str) -> str:
+    """Returns a temporary file name for a target that no other thread or worker process uses"""
+    return f"{target}.{getpid()}-{get_ident()}.part"
+
+
+class PageStore():
+    """Threadsafe content addressed page store (one file per sha256)"""
+
+    def __init__(self, store_dir : str):
+
+        self.store_dir = store_dir
+        self.mutex = Lock()
+
+        self.reused = 0      # Pages filled from the store instead of downloaded
+        self.bytes_saved = 0 # Bytes not downloaded
+        self.linked = 0      # Downloaded pages replaced by a link to an identical stored page
+        self.bytes_linked = 0
+
+
+    def stored_file(self, digest : str) -> str:
+        return path.join(self.store_dir, digest[:2], digest)
+
+
+    def fetch(self, image : str, target : str, archive = None) -> tuple:
+        """Fill a page from the store, returns its size and sha256 (None if it isn't stored)
+
+        The page is hardlinked to the target file, or copied into the archive in cbz mode.
+        A stored page that no longer matches its sha256 is removed (the page is downloaded again)
+        """
+        digest = page_digest(image)
+        if digest is None:
+            return None
+
+        stored = self.stored_file(digest)
+        try:
+            size, found = stored_digest(stored)
+        except FileNotFoundError:
+            return None
+
+        if found != digest:
+            self.discard(digest)
+            return None
+
+        if archive:
+            with open(stored, "rb") as stored_page:
+                archive.write(target, stored_page)
+        else:
+            self.link_file(stored, target)
+
+        with self.mutex:
+            self.reused += 1
+            self.bytes_saved += size
+
+        return size, digest
+
+
+    def add_file(self, image_file : str, digest : str) -> NoReturn:
+        """Add a downloaded page file (it becomes a link to the stored copy if there already is one)"""
+
+        stored = self.stored_file(digest)
+
+        if path.isfile(stored):
+            if not path.samefile(stored, image_file):
+                size = path.getsize(image_file)
+                self.link_file(stored, image_file)
+                with self.mutex:
+                    self.linked += 1
+                    self.bytes_linked += size
+            return
+
+        makedirs(path.dirname(stored), exist_ok=True)
+        try:
+            link(image_file, stored)
+        except FileExistsError: # Stored by another thread in the meantime
+            pass
+        except OSError: # No hardlinks (e.g. a different filesystem), keep a copy instead
+            self.copy_file(image_file, stored)
+
+
+    def add_buffer(self, buffer, digest : str) -> NoReturn:
+        """Add a downloaded page from a file object (cbz mode)"""
+
+        stored = self.stored_file(digest)
+        if path.isfile(stored):
+            return
+
+        makedirs(path.dirname(stored), exist_ok=True)
+        temp_file = temp_name(stored)
+
+        buffer.seek(0)
+        with open(temp_file, "wb") as stored_page:
+            shutil.copyfileobj(buffer, stored_page, config.CHUNK_SIZE)
+        replace(temp_file, stored)
+
+
+    def discard(self, digest : str) -> NoReturn:
+        """Remove a stored page (e.g. a damaged one), the page files linked to it are left alone"""
+
+        try:
+            remove(self.stored_file(digest))
+        except FileNotFoundError:
+            pass
+
+
+    def link_file(self, stored : str, target : str) -> NoReturn:
+        """Replace a target file with a hardlink to a stored page (a copy if links aren't possible)"""
+
+        temp_file = temp_name(target)
+        try:
+            link(stored, temp_file)
+        except OSError:
+            shutil.copyfile(stored, temp_file)
+        replace(temp_file, target)
+
+
+    def copy_file(self, source : str, stored : str) -> NoReturn:
+        """Store a copy of a page file"""
+
+        temp_file = temp_name(stored)
+        try:
+            shutil.copyfile(source, temp_file)
+            replace(temp_file, stored)
+        except OSError:
+            if path.exists(temp_file):
+                remove(temp_file)
+
+
+    def stats(self) -> dict:
+        """Returns the requests and bytes the store saved"""
+
+        with self.mutex:
+            return {
+                    "reused":self.reused,
+                    "bytes_saved":self.bytes_saved,
+                    "linked":self.linked,
+                    "bytes_linked":self.bytes_linked,
+                    }
+
+
+STORE = None
+m_store = Lock()
+
+
+def page_store() -> PageStore:
+    """Returns the shared page store (None if deduplication is disabled)"""
+
+    global STORE
+
+    if config.USE_PAGE_STORE and STORE is None:
+        with m_store:
+            if STORE is None:
+                STORE = PageStore(config.PAGE_STORE_DIR)
+
+    return STORE
+
+
+def print_store_stats() -> NoReturn:
+    """Display the requests and bytes the page store saved"""
+
+    if STORE is None:
+        return
+
+    stats = STORE.stats()
+    print(f"Page store: {stats['reused']} pages reused ({stats['reused']} requests, "
+          f"{stats['bytes_saved']} bytes saved), {stats['linked']} duplicates linked "
+          f"({stats['bytes_linked']} bytes saved)")
@@ -1,13 +1,19 @@
+import hashlib
 import json
 import re
+import shutil
+import socket
+import sqlite3
 
 import time
 
-from concurrent.futures import ThreadPoolExecutor
-from os import (mkdir, path)
+from concurrent.futures import (FIRST_COMPLETED, ThreadPoolExecutor, wait)
+from contextlib import contextmanager
+from os import (makedirs, path, replace)
+from queue import Queue
 
 from urllib3.util.retry import Retry
-from threading import Lock
+from threading import (BoundedSemaphore, Lock, local)
 from typing import NoReturn
 from requests.adapters import HTTPAdapter
 
@@ -15,103 +21,516 @@ import requests
 
 
 import config
+import feed
+
+from archive import (archive_file, entry_path, page_buffer, page_entry, ChapterArchive)
+from chapters import select_chapters
+from dedup import page_store
+from flight import API_FLIGHTS
+from hedge import (attempt_pool, server_health, PageRace, TRACKER)
+from integrity import (content_length, page_problem)
+from postprocess import post_processor
+from metrics import (pages_done, request_done, CHAPTERS_FOUND, CHAPTERS_RESOLVED, PAGE_RETRIES,
+                     PAGE_SECONDS, PAGES_DAMAGED, PAGES_FAILED, PAGES_FOUND)
+from scheduler import (chapter_priority, page_scheduler)
+from progress import PROGRESS
+from retry import (retry_call, PageError, RetryQueue)
+from selection import ChapterSelection
+from state import DownloadState
+from throttle import (host_limit, retry_after)
+from writer import (disk_writer, WriteGroup)
+from tracing import (instrument, request_trace, tracer)
+
+find_id        = re.compile(r"title/([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}|\d+)")
+
+
+# One adapter (and so one urllib3 pool manager) shared by every thread,
+# keeps connections to the api and image servers alive between requests
+# (only refused connections are retried here, without sleeping, see retry.py)
+ADAPTER = HTTPAdapter(
+                      pool_connections=config.POOL_HOSTS,
+                      pool_maxsize=config.POOL_MAXSIZE,
+                      max_retries=Retry(connect=config.CONNECT_RETRIES, read=0, backoff_factor=0))
+instrument(ADAPTER)
+
+THREAD_SESSION = local()
+
+
+def session() -> requests.Session:
+    """Returns this thread's session (sessions are per thread, connections are shared)"""
+
+    curr_session = getattr(THREAD_SESSION, "session", None)
+
+    if curr_session is None:
+        curr_session = requests.Session()
+        curr_session.mount('http://', ADAPTER)
+        curr_session.mount('https://', ADAPTER)
+        THREAD_SESSION.session = curr_session
+
+    return curr_session
+
+
+@contextmanager
+def http_stream(url : str, chapter : str = None, acquired = None, **kwargs) -> requests.Response:
+    """Sends a GET request through the shared keep-alive connection pool
+
+    Holds a slot in the host's adaptive concurrency limit until the response
+    body has been read and the response is closed, acquired is called once it has the slot.
+    A connection or read that stalls past its timeout raises requests.Timeout
+    """
+    kwargs.setdefault("timeout", (config.CONNECT_TIMEOUT, config.READ_TIMEOUT))
+    limit = host_limit(url)
+    trace = request_trace(url, chapter)
+    limit.acquire()
+
+    if trace:
+        trace.phase("queue")
+
+    if acquired:
+        acquired()
+
+    status = None
+    wait = 0.0
+    response = None
+    start = time.perf_counter()
+
+    try:
+        with session().get(url, stream=True, **kwargs) as response:
+            status = response.status_code
+            wait = retry_after(response.headers.get("Retry-After"))
+
+            if trace:
+                trace.phase("ttfb")
+                trace.connected()
+
+            yield response
+    finally:
+        elapsed = time.perf_counter() - start
+        limit.release(status, elapsed, wait)
+        request_done(limit.host, status, elapsed)
+
+        if trace:
+            trace.done(status, response.raw.tell() if response is not None else 0)
+
+
+def abort_response(response : requests.Response) -> NoReturn:
+    """Stop a response that another thread is streaming
+
+    Its socket is shut down, which wakes a read blocked on it, and the connection is closed
+    instead of going back to the pool
+    """
+    connection = getattr(response.raw, "_connection", None) # Only set while the body is unread
+    sock = getattr(connection, "sock", None)
+
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    if connection is not None:
+        connection.close()
+
+
+def http_get(url : str, **kwargs) -> requests.Response:
+    """Sends a GET request through the shared keep-alive connection pool and reads the body"""
+
+    with http_stream(url, **kwargs) as response:
+        response.content # Reads the body while the host slot is held
+        return response
+
+
+def connection_stats() -> dict:
+    """Returns the number of requests and new connections made by the shared pool, per host
+
+    Every request that didn't need a new connection reused a kept-alive one
+    """
+    pools = ADAPTER.poolmanager.pools
+    stats = {}
+
+    for key in pools.keys():
+        pool = pools.get(key)
+        if pool is None:
+            continue
+
+        host = stats.setdefault(pool.host, {"requests":0, "connections":0, "reused":0})
+        host["requests"]    += pool.num_requests
+        host["connections"] += pool.num_connections
+        host["reused"]      += max(pool.num_requests - pool.num_connections, 0)
+
+    return stats
+
+
+def print_connection_stats() -> NoReturn:
+    """Display how many requests reused a kept-alive connection"""
+
+    for host, stats in connection_stats().items():
+        print(f"{host}: {stats['requests']} requests, "
+              f"{stats['connections']} connections, {stats['reused']} reused")
+
+
+class ResponseCache():
+    """Persistent, size limited (LRU) cache of MangaDex api responses
+
+    Fresh entries are returned without a request, stale entries are revalidated
+    with ETag/Last-Modified when the server provided them
+    """
+
+    def __init__(self, cache_file : str, max_bytes : int):
+
+        self.max_bytes = max_bytes
+        self.mutex = Lock()
+
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+        self.connection = sqlite3.connect(cache_file, timeout=config.SQLITE_TIMEOUT, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                url           TEXT PRIMARY KEY,
+                body          TEXT NOT NULL,
+                etag          TEXT,
+                last_modified TEXT,
+                stored        REAL NOT NULL,
+                accessed      REAL NOT NULL,
+                size          INTEGER NOT NULL
+            )""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS lru ON responses (accessed)")
+        self.connection.commit()
+
+        # Running size of the cache, only summed up again once it passes the limit
+        self.total = self.cached_bytes()
+
+
+    def lookup(self, url : str, ttl : float) -> tuple:
+        """Returns (fresh body or None, revalidation headers, cached entry or None)
+
+        A ttl of None never expires
+        """
+        with self.mutex:
+            entry = self.connection.execute(
+                                            "SELECT body, etag, last_modified, stored, size "
+                                            "FROM responses WHERE url = ?",
+                                            (url,)).fetchone()
+            if not entry:
+                return None, {}, None
+
+            body, etag, last_modified, stored, size = entry
+            now = time.time()
+
+            if ttl is None or now - stored < ttl:
+                self.connection.execute("UPDATE responses SET accessed = ? WHERE url = ?", (now, url))
+                self.connection.commit() # Left open, the write lock would block other worker processes
+                self.hits += 1
+                self.bytes_saved += size
+                return body, {}, entry
+
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+
+        return None, headers, entry
+
+
+    def complete(self, url : str, status : int, body : str, headers : dict, entry : tuple) -> str:
+        """Store or revalidate a response, returns the body to use (None if the request failed)"""
+
+        now = time.time()
+
+        with self.mutex:
+            if status == 304 and entry:
+                self.connection.execute(
+                                        "UPDATE responses SET stored = ?, accessed = ? WHERE url = ?",
+                                        (now, now, url))
+                self.connection.commit()
+                self.revalidated += 1
+                self.bytes_saved += entry[4]
+                return entry[0]
+
+            if status != 200:
+                return None
+
+            self.misses += 1
+            size = len(body.encode())
+            self.connection.execute(
+                                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                    (url, body, headers.get("ETag"), headers.get("Last-Modified"),
+                                     now, now, size))
+            self.total += size - (entry[4] if entry else 0)
+
+            if self.total > self.max_bytes:
+                self.evict()
+            self.connection.commit()
+
+        return body
+
+
+    def cached_bytes(self) -> int:
+        """Returns the size of every cached response (other worker processes share the cache file)"""
+
+        (total,) = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return total
+
+
+    def evict(self) -> NoReturn:
+        """Remove the least recently used responses until the cache is trimmed below its size limit"""
+
+        self.total = self.cached_bytes()
+        target = self.max_bytes * config.CACHE_TRIM_TO
+
+        evicted = []
+        for url, size in self.connection.execute("SELECT url, size FROM responses ORDER BY accessed"):
+            if self.total <= target:
+                break
+
+            evicted.append((url,))
+            self.total -= size
+
+        self.connection.executemany("DELETE FROM responses WHERE url = ?", evicted)
+
+
+    def stats(self) -> dict:
+        """Returns the cache hits, misses and bytes saved during this run"""
+
+        return {
+                "hits":self.hits,
+                "revalidated":self.revalidated,
+                "misses":self.misses,
+                "bytes_saved":self.bytes_saved,
+                }
+
+
+    def close(self) -> NoReturn:
+        """Close the cache database"""
+
+        with self.mutex:
+            self.connection.commit()
+            self.connection.close()
+
+
+CACHE = None
+m_cache = Lock()
+
+
+def response_cache() -> ResponseCache:
+    """Returns the shared api response cache (None if caching is disabled)"""
 
-find_id        = re.compile(r"\/\d+\/*")
+    global CACHE
 
+    if config.USE_CACHE and CACHE is None:
+        with m_cache:
+            if CACHE is None:
+                CACHE = ResponseCache(config.CACHE_FILE, config.CACHE_MAX_BYTES)
 
-mutex = Lock()
-m_tot = Lock() # For updating the total number of downloads
-m_fin= Lock() # For updating the number of finished downloads
-m_setup = Lock() # For updating how much chapter info has been downloaded during setup
+    return CACHE
 
-STATUS_DICT = {} # Contains list of all currently downloading manga
 
-MANGA_STARTED = 0
-MANGA_FINISHED = 0
+def api_request(url : str, headers : dict = None) -> requests.Response:
+    """Sends an api request, raises PageError for failures that can succeed on a retry"""
 
-CHAPTER_INFO_TOTAL = 0
-CHAPTER_INFO_DL     = 0
+    try:
+        response = http_get(url, headers=headers)
+    except requests.RequestException: # No response (including timeouts), retried
+        raise PageError()
 
-OPTIONS = []
+    if response.status_code == 429 or response.status_code >= 500:
+        raise PageError(response.status_code, retry_after(response.headers.get("Retry-After")))
 
+    return response
 
-def update_status(
-                  to_total       : bool = None,
-                  to_finished    : bool = None,
-                  name           : str = None,
-                  status         : int = None,
-                  setup_progress : bool = None) -> NoReturn:
-    """Used to update the different program stats that are displayed while downloading:
 
-    The started and finished global variables are used to tell the display status thread
-    when to exit and return to the main thread, as well as to display the total number of
-    finished downloads
+def manga_key(url : str) -> str:
+    """Returns the manga id in a manga url (the url itself if it has none), urls of the same manga share it"""
 
-    to_total:
-            Used to keep track of the total number of manga being downloaded
+    found = find_id.search(url)
+    return found[1] if found else url
 
-    to_finished:
-            Updates the total number of finished downloads
 
-    name, status:
-            Adds current download info to a dictionary of finished and/or
-            currently downloading manga
-            (used for displaying the download status of all the finished
-            and/or currently downloading manga)
+def api_get(url : str, ttl : float) -> str:
+    """Retrieve a MangaDex api response through the response cache, returns None on failure
 
-    setup_progress:
-            Updates the amount of chapter info that has been downloaded
-            during each manga's download setup
+    Identical requests in flight at the same time are made once (their callers share the response)
     """
-    if to_total:
-        m_tot.acquire()
-        global MANGA_STARTED
-        MANGA_STARTED += 1
-        m_tot.release()
-
-    if to_finished:
-        m_fin.acquire()
-        global MANGA_FINISHED
-        MANGA_FINISHED += 1
-        m_fin.release()
-
-    if name and status:
-        mutex.acquire()
-        global STATUS_DICT
-        STATUS_DICT[name] = status
-        mutex.release()
-
-    if setup_progress:
-        m_setup.acquire()
-        global CHAPTER_INFO_DL
-        CHAPTER_INFO_DL += 1
-        m_setup.release()
-
-
-def display_status() -> NoReturn:
-    global STATUS_DICT
-    global MANGA_STARTED
-    global MANGA_FINISHED
-    global CHAPTER_INFO_TOTAL
-    global CHAPTER_INFO_DL
-    global OPTIONS
-
-    while MANGA_FINISHED < MANGA_STARTED:
-        config.print_status(
-                            STATUS_DICT,
-                            MANGA_FINISHED,
-                            MANGA_STARTED,
-                            CHAPTER_INFO_DL,
-                            CHAPTER_INFO_TOTAL,
-                            options=OPTIONS)
-
-    config.print_status(
-                        STATUS_DICT,
-                        MANGA_FINISHED,
-                        MANGA_STARTED,
-                        CHAPTER_INFO_DL,
-                        CHAPTER_INFO_TOTAL,
-                        options=OPTIONS)
+    return API_FLIGHTS.do((url, ttl), fetch_api, url, ttl)
+
+
+def fetch_api(url : str, ttl : float) -> str:
+    """Retrieve a MangaDex api response through the response cache, returns None on failure
+
+    Failed requests are retried with backoff (the caller's thread waits, it holds no host slot)
+    """
+    cache = response_cache()
+    body, headers, entry = cache.lookup(url, ttl) if cache else (None, {}, None)
+
+    if body is not None:
+        return body
+
+    try:
+        response = retry_call(api_request, url, headers)
+    except PageError:
+        return None
+
+    if cache is None:
+        return response.text if response.status_code == 200 else None
+
+    return cache.complete(url, response.status_code, response.text, response.headers, entry)
+
+
+def print_cache_stats() -> NoReturn:
+    """Display how many api requests the response cache saved"""
+
+    if CACHE is None:
+        return
+
+    stats = CACHE.stats()
+    print(f"Cache: {stats['hits']} hits, {stats['revalidated']} revalidated, "
+          f"{stats['misses']} misses, {stats['bytes_saved']} bytes saved")
+
+
+def part_file(image_file : str) -> str:
+    """Returns the temporary file an image is written to before it is complete"""
+    return f"{image_file}.part"
+
+
+def page_sink():
+    """Returns the buffer an attempt at a page is read into before it is kept or discarded
+
+    Every attempt has its own buffer and nothing touches the disk until the page is
+    complete, so an interrupted or losing download never looks finished
+    """
+    return page_buffer()
+
+
+def keep_sink(sink, image_file : str, archive : ChapterArchive, digest : str, chapter : str = None) -> NoReturn:
+    """Write a finished page into its file or archive entry (and into the page store)
+
+    Runs on a disk writer thread, a page file is written under a temporary name first
+    """
+    start = time.perf_counter()
+    store = page_store()
+
+    with sink:
+        if archive:
+            archive.write(image_file, sink)
+            if store:
+                store.add_buffer(sink, digest)
+        else:
+            disk_writer().make_folder(path.dirname(image_file))
+
+            sink.seek(0)
+            with open(part_file(image_file), "wb") as page_file:
+                shutil.copyfileobj(sink, page_file, config.CHUNK_SIZE)
+            replace(part_file(image_file), image_file)
+
+            if store:
+                store.add_file(image_file, digest)
+
+    current = tracer()
+    if current:
+        current.write(chapter, start, image_file)
+
+
+def drop_sink(sink) -> NoReturn:
+    """Discard an unfinished or losing attempt at a page"""
+
+    if sink is not None:
+        sink.close()
+
+
+def page_attempt(
+                 url        : str,
+                 server     : str,
+                 race       : PageRace,
+                 attempt    : int,
+                 chapter    : str = None) -> tuple:
+    """Streams one request for a page, returns the size, sha256 and sink of the page
+
+    Returns None if the request failed, the page arrived damaged (cut short or not matching
+    the sha256 in its name) or another attempt at the page finished first
+    """
+    if race.over(): # Delivered while this attempt was waiting to run
+        return None
+
+    health = server_health(server)
+    sink = None # Only opened once the page starts arriving
+    start = None
+
+    def sent() -> NoReturn:
+        """The request got its host slot: waiting for one counts toward neither the hedge delay nor the latency"""
+
+        nonlocal start
+        race.sent(attempt)
+        start = time.perf_counter()
+
+    try:
+        with http_stream(url, chapter, acquired=sent) as response:
+            if response.status_code != 200:
+                health.failed()
+                race.fail(response.status_code, retry_after(response.headers.get("Retry-After")))
+                return None
+
+            # A losing attempt is stopped (its socket shut down) by the attempt that wins
+            if not race.streaming(attempt, lambda: abort_response(response)):
+                return None
+
+            try:
+                sink = page_sink()
+                digest = hashlib.sha256()
+                written = 0
+
+                for chunk in response.iter_content(chunk_size=config.CHUNK_SIZE):
+                    if race.over(): # Another attempt delivered the page
+                        drop_sink(sink)
+                        return None
+
+                    sink.write(chunk)
+                    digest.update(chunk)
+                    written += len(chunk)
+            finally:
+                # Before the connection goes back to the pool, where stopping it would hit another request
+                race.streamed(attempt)
+
+            problem = page_problem(url, written, digest.hexdigest(), content_length(response.headers))
+            if problem:
+                PAGES_DAMAGED.inc()
+                health.failed()
+                race.fail(reason=problem)
+                drop_sink(sink)
+                return None
+
+    except Exception as error:
+        drop_sink(sink)
+
+        if race.over(): # Stopped because another attempt delivered the page, not the server's fault
+            return None
+
+        if not isinstance(error, (requests.RequestException, OSError)):
+            raise
+
+        health.failed()
+        race.fail()
+        return None
+
+    except BaseException:
+        drop_sink(sink)
+        raise
+
+    latency = time.perf_counter() - start
+    health.succeeded(latency)
+    TRACKER.record(latency)
+    PAGE_SECONDS.observe(latency)
+
+    if not race.claim(attempt):
+        drop_sink(sink)
+        return None
+
+    return written, digest.hexdigest(), sink
 
 
 class MangaDownloader():
@@ -122,10 +541,40 @@ class MangaDownloader():
                  threaded    : bool = True,
                  datasaver   : bool = True,
                  language    : str = "English",
-                 language_id : str = "gb"):
+                 language_id : str = "gb",
+                 state       : DownloadState = None,
+                 sync        : bool = False,
+                 output      : str = config.OUTPUT_FORMAT,
+                 selection   : ChapterSelection = None):
 
         self.name = None
         self.url  = url
+        self.manga_id = find_id.search(url)[1]
+
+        # Chapters to download, picked from the chapter list before any img urls are requested
+        self.selection = selection or ChapterSelection()
+
+        # Metadata api the chapters are listed and resolved with (chapter numbers by id for api v5)
+        self.api = config.API_BACKEND
+        self.numbers = {}
+
+        # Persistent record of finished pages/chapters (resume), sync skips finished chapters
+        self.state = state
+        self.sync  = sync and state is not None
+
+        # "folder" writes every page as a file, "cbz" writes one archive per chapter
+        self.output = output
+
+        # Scheduler job the pages are downloaded through (threaded mode)
+        self.job = None
+
+        # Failed pages, retried after the main pass
+        self.retries = RetryQueue()
+
+        # Chapters whose img urls or download failed and pages that couldn't be saved
+        # (a later run downloads them)
+        self.failed_chapters = 0
+        self.failed_saves = 0
 
         self.language    = language
         self.language_id = language_id
@@ -136,21 +585,13 @@ class MangaDownloader():
         self.total_images = 0
         self.downloaded_images = 0
 
+        # Download events feed the progress display
+        self.progress = PROGRESS.add(url)
+
         self.mutex_initialize = Lock()
         self.mutex_total = Lock()
         self.mutex_downloaded = Lock()
 
-        self.options_set()
-
-
-    def options_set(self):
-        """Set global variables to program options for use in the status display"""
-
-        global OPTIONS
-        OPTIONS.append(config.ENABLE(self.threaded))
-        OPTIONS.append(config.ENABLE(self.datasaver))
-        OPTIONS.append(self.language)
-
 
 
     def update_chapters(self, chapter_num : str, chapter_info : dict) -> NoReturn:
@@ -168,113 +609,183 @@ class MangaDownloader():
         self.total_images += update
         self.mutex_total.release()
 
+        PAGES_FOUND.inc(amount=update)
+
 
-    def update_completed(self, update : int) -> NoReturn:
+    def update_completed(self, update : int, size : int = 0) -> NoReturn:
         """Provides a threadsafe way to update the number of completed image downloads"""
 
         self.mutex_downloaded.acquire()
         self.downloaded_images += update
         self.mutex_downloaded.release()
 
+        self.progress.page_done(size)
+        pages_done(update, size)
 
-    def initialize(self) -> int:
-        """Get chapter ids and img urls for each chapter"""
 
-        # Get list of chapter ids
-        chapter_list = self.chapter_info()
+    def chapter_failed(self, error : Exception) -> NoReturn:
+        """Count a chapter that failed, the rest of the manga still downloads"""
 
-        if not chapter_list:
-            print(f"Failed to initialize      : '{self.name}'")
-            return 0
+        self.progress.note(f"Chapter failed            : {error}")
 
-        # Download the info for each chapter in a separate thread
-        # (threading: faster, but possibly less stable)
-        if self.threaded:
-            with ThreadPoolExecutor(max_workers=config.MAX_CHAPTER_THREADS) as executor:
-                for chapter in chapter_list:
-                    executor.submit(self.image_urls, chapter)
+        with self.mutex_initialize:
+            self.failed_chapters += 1
 
-        # Download the info for each chapter one by one
-        # (no threading: much slower, but possibly more stable)
-        else:
-            for chapter in chapter_list:
-                self.image_urls(chapter)
 
-        with ThreadPoolExecutor(max_workers=2) as executor:
-            # Have a status updater running while the manga is downloading
-            executor.submit(self.status)
+    def report_unfinished(self) -> bool:
+        """Display the pages and chapters that still failed, returns whether there are any"""
+
+        report = self.retries.report()
+        if report:
+            self.progress.note(report)
+
+        if self.failed_chapters:
+            self.progress.note(f"Chapters failed           : {self.failed_chapters} of '{self.name}'")
 
-            # Start download after initialization
-            executor.submit(self.start_download)
+        if self.failed_saves:
+            self.progress.note(f"Pages not saved           : {self.failed_saves} of '{self.name}'")
 
-        # Update number of finished downloads
-        update_status(to_finished=True)
+        return bool(report or self.failed_chapters or self.failed_saves)
 
-        # Reset the download setup info before starting next manga download
-        global CHAPTER_INFO_TOTAL
-        global CHAPTER_INFO_DL
-        CHAPTER_INFO_TOTAL = 0
-        CHAPTER_INFO_DL = 0
+
+    def initialize(self) -> int:
+        """Get chapter ids, then download each chapter as soon as its img urls arrive
+
+        Returns 1 if every page of the manga finished (0 if it failed or pages are missing)
+        """
+
+        try:
+            # Get list of chapter ids
+            chapter_list = self.chapter_info()
+
+            if not chapter_list:
+                if self.sync:
+                    self.progress.note(f"Already up to date        : '{self.name}'")
+                else:
+                    self.progress.note(f"Failed to initialize      : '{self.name}'")
+                return int(self.sync) # Nothing new counts as finished
+
+            # Chapter info is retrieved and downloaded in the same pipeline
+            self.start_download(chapter_list)
+
+            if self.report_unfinished():
+                return 0 # Not finished, a later run downloads the missing pages and chapters
+
+        except Exception as error:
+            self.progress.note(f"Download failed           : {error}")
+            return 0
+
+        finally:
+            # Update number of finished downloads
+            self.progress.finish()
 
         return 1
 
 
-    def start_download(self) -> NoReturn:
+    def start_download(self, chapter_list : list) -> NoReturn:
         """Starts the manga download in either threaded mode or regular mode """
         if self.threaded:
-            self.threaded_download()
+            self.threaded_download(chapter_list)
         else:
-            self.regular_download()
+            self.regular_download(chapter_list)
+
+
+    def manga_api_url(self) -> str:
+        """Returns the MangaDex api v2 url for the manga's chapter list"""
+
+        return f"{config.API_URL}/manga/{self.manga_id}/chapters"
+
+
+    def chapter_api_url(self, chapter_id : int) -> str:
+        """Returns the MangaDex api url for a chapter's image list (its image server for api v5)"""
+
+        if self.api == "v5":
+            return feed.at_home_url(chapter_id)
+
+        chapter_api_v2 = f"{config.API_URL}/chapter/{chapter_id}"
+
+        # Datasaver provides links to compressed versions of the original images
+        # (reduces bandwidth usage and storage space)
+        if self.datasaver:
+            chapter_api_v2 += "?saver=true"
+
+        return chapter_api_v2
+
+
+    def chapter_ttl(self) -> float:
+        """Returns how long a chapter response is cached (image servers from api v5 expire)"""
+        return config.CACHE_TTL["at-home" if self.api == "v5" else "chapter"]
 
 
     def chapter_info(self) -> list:
         """Use the MangaDex api to retrieve all the chapter information for a manga"""
 
-        m_id = find_id.search(self.url)[0].replace("/", "")
-        manga_api_v2 = f"https://mangadex.org/api/v2/manga/{m_id}/chapters"
-        response = requests.get(manga_api_v2, headers={"Connection":"close"})
+        if self.api == "v5":
+            return self.feed_chapter_list()
 
-        if response and response.status_code == 200:
-            manga = json.loads(response.text)
-        else:
+        body = api_get(self.manga_api_url(), config.CACHE_TTL["manga"])
+
+        if not body:
             raise Exception(f"Failed to initialize '{self.name}'")
 
-        # Start chapter extraction from mangadex manga api dictionary
-        chapter_list = manga["data"]["chapters"]
+        return self.parse_chapter_list(body)
 
-        # Loop through each chapter and check chapter language
-        # Add chapters with specified language to dictionary
-        chapters     = []
-        for chapter in chapter_list:
-            if chapter["language"] == self.language_id:
-                chapters.append(chapter)
 
-        # Replaces empty chapter numbers with '0'
-        for i in range(len(chapters)):
-            if chapters[i]["chapter"] == "":
-                chapters[i]["chapter"] = "0"
+    def feed_chapter_list(self) -> list:
+        """Retrieve the manga's title and chapter feed from the MangaDex api v5
+
+        The title and the first feed page are requested together, the remaining
+        feed pages all at once as soon as the first page gives the total
+        """
+        feed.check_manga_id(self.manga_id)
+
+        def get(url : str) -> dict:
+            body = api_get(url, config.CACHE_TTL["manga"])
+            if not body:
+                raise Exception(f"Failed to initialize '{self.url}'")
+            return json.loads(body)
+
+        with ThreadPoolExecutor(max_workers=config.MAX_INITIALIZATION_THREADS) as requests_pool:
+            manga = requests_pool.submit(get, feed.manga_url(self.manga_id))
+            first_page = get(feed.feed_url(self.manga_id, self.language_id, 0, self.selection))
+
+            feed_pages = [first_page] + list(requests_pool.map(
+                                                               get,
+                                                               [feed.feed_url(self.manga_id, self.language_id, offset,
+                                                                              self.selection)
+                                                                for offset in feed.feed_offsets(first_page)]))
+
+            title = feed.manga_title(manga.result())
+
+        return self.choose_chapters(title, feed.select_feed(feed_pages, self.selection))
 
 
-        # Goes through a process of filtering out duplicates and
-        # leaving the chapters with the most views
-        filtered_dict = {}
+    def parse_chapter_list(self, body : str) -> list:
+        """Filter the manga api v2 response down to one chapter id per chapter number
 
-        for x in chapters:
-            x_chapter = x["chapter"]
-            x_views = x["views"]
+        The chapter list is read in a single pass, without decoding the whole response
+        """
+        title, records = select_chapters(body, self.language_id, self.selection)
 
-            if not x_chapter in filtered_dict.keys():
-                filtered_dict[x_chapter] = x
+        if title is None:
+            raise Exception(f"No chapters found for '{self.name}'")
 
-            elif filtered_dict[x_chapter]["views"] < x_views:
-                filtered_dict[x_chapter] = x
+        return self.choose_chapters(title, records)
 
-        # Create a new list with the ids of the filtered chapters
-        chapters_filtered = []
-        for val in filtered_dict.values():
-            chapters_filtered.append(val["id"])
 
-        title = manga["data"]["chapters"][0]["mangaTitle"]
+    def choose_chapters(self, title : str, records : list) -> list:
+        """Name the manga after its title and return the ids of the chapters to download
+
+        Records are one per chapter number, in download priority order
+        """
+        # Only the selected chapters are resolved, the rest never cost an api request
+        listed = len(records)
+        records = self.selection.select(records)
+
+        # Chapter ids in download priority order
+        chapters_filtered = [record.id for record in records]
+        self.numbers = {record.id:record.chapter for record in records}
+
 
         # Make title safe for creating a folder name
         for c in "!@#$%^&*(),.<>/?'\"[]{};:-":
@@ -284,43 +795,75 @@ class MangaDownloader():
 
         self.name = title
 
+        described = self.selection.describe()
+        if described:
+            self.progress.note(f"Selected chapters         : {len(records)} of {listed} ({described})")
+
+        # Sync mode only downloads chapters that didn't finish in an earlier run
+        if self.sync:
+            finished = self.state.finished_chapters(self.manga_id)
+            chapters_filtered = [c for c in chapters_filtered if str(c) not in finished]
+
         # Update number of chapters needed to get image urls for
         # (needed for download setup status display)
-        global CHAPTER_INFO_TOTAL
-        CHAPTER_INFO_TOTAL= len(chapters_filtered)
+        self.progress.name = title
+        self.progress.chapters_found(len(chapters_filtered))
+        CHAPTERS_FOUND.inc(amount=len(chapters_filtered))
 
         return chapters_filtered
 
 
-    def image_urls(self, chapter_id : int) -> NoReturn:
-        """Use the MangaDex api v2 to retrieve the list of image urls for each chapter"""
+    def read_chapter(self, chapter_id : int, body : str) -> dict:
+        """Decode a chapter response (an api v5 at-home answer is read into the api v2 shape)"""
 
-        chapter_api_v2 = f"https://mangadex.org/api/v2/chapter/{chapter_id}"
+        chapter = json.loads(body)
 
-        # Datasaver provides links to compressed versions of the original images
-        # (reduces bandwidth usage and storage space)
-        if self.datasaver:
-            chapter_api_v2 += "?saver=true"
+        if self.api == "v5":
+            return feed.at_home_chapter(chapter, chapter_id, self.numbers[chapter_id], self.datasaver)
 
-        # Sets up retry configuration to prevent connection refusals from too many requests at once
-        session = requests.Session()
-        retry = Retry(connect=3, backoff_factor=0.5)
-        adapter = HTTPAdapter(max_retries=retry)
-        session.mount('http://', adapter)
-        session.mount('https://', adapter)
-        response = session.get(
-                                chapter_api_v2,
-                                headers={"Connection":"close"}
-                                )
-
-        #response = requests.get(chapter_api_v2, headers={"Connection":"close"})
-
-        if response and response.status_code == 200:
-            chapter = json.loads(response.text)
+        return chapter
+
+
+    def image_urls(self, chapter_id : int) -> dict:
+        """Use the MangaDex api to retrieve the list of image urls for each chapter"""
+
+        body = api_get(self.chapter_api_url(chapter_id), self.chapter_ttl())
+
+        if body:
+            chapter = self.read_chapter(chapter_id, body)
         else:
             raise Exception(f"Failed to initialize '{self.name}'")
 
-        server_url      = chapter["data"]["server"]
+        return self.add_chapter(chapter)
+
+
+    def refresh_servers(self, curr_chapter : dict) -> NoReturn:
+        """Look up a chapter's image server again before its failed pages are retried (api v5)
+
+        At-home servers are only handed out for a while, a server that failed pages
+        may have expired. Done once per chapter and retry round, whatever the failed pages
+        """
+        if self.api != "v5":
+            return
+
+        body = api_get(self.chapter_api_url(curr_chapter["id"]), 0)
+        if body:
+            self.update_servers(curr_chapter, self.read_chapter(curr_chapter["id"], body))
+
+
+    def update_servers(self, curr_chapter : dict, chapter : dict) -> NoReturn:
+        """Point a chapter's remaining downloads at the servers of a fresh chapter response"""
+
+        server_url   = chapter["data"]["server"]
+        fallback_url = chapter["data"].get("serverFallback")
+
+        curr_chapter["server"] = server_url
+        curr_chapter["servers"] = [server_url] + ([fallback_url] if fallback_url and fallback_url != server_url else [])
+
+
+    def add_chapter(self, chapter : dict) -> dict:
+        """Store the server, hash and image list from a chapter api response"""
+
         link_hash       = chapter["data"]["hash"]
         chapter_images  = chapter["data"]["pages"]
 
@@ -330,114 +873,416 @@ class MangaDownloader():
         self.update_total(len(chapter_images))
 
         chapter_info = {
-                        "server":server_url,
+                        "id":chapter["data"]["id"],
+                        "priority":chapter_priority(chapter["data"]["chapter"]),
                         "hash":link_hash,
                         "images":chapter_images,
                         "num":chapter_num,
                         }
+        self.update_servers(chapter_info, chapter)
 
         # Updates number of chapters that have had img urls downloaded for (for download setup status display)
-        update_status(setup_progress=True)
+        self.progress.chapter_resolved(len(chapter_images))
+        CHAPTERS_RESOLVED.inc()
 
         # Thread safe function, allowing multithreaded initialization
         self.update_chapters(chapter_num, chapter_info)
 
+        return chapter_info
+
+
+    def page_done(self, curr_chapter : dict, image : str, archive : ChapterArchive = None, entry : str = None) -> bool:
+        """Returns whether a page was already downloaded in an earlier run (counts it as completed)"""
+
+        if archive:
+            done = archive.has(entry)
+        else:
+            done = self.state and self.state.page_done(self.manga_id, curr_chapter["id"], image)
+
+        if done:
+            self.update_completed(1)
+            return True
+
+        return False
+
+
+    def reuse_page(self, curr_chapter : dict, image : str, image_file : str, archive : ChapterArchive) -> bool:
+        """Returns whether a page was filled from the page store (no download needed)"""
+
+        store = page_store()
+        saved = store.fetch(image, image_file, archive) if store else None
+        if saved is None:
+            return False
+
+        self.record_page(curr_chapter, image, image_file, saved)
+        self.update_completed(1, saved[0])
+        return True
+
 
-    def threaded_image(self, image_file : str, image_url : str) -> NoReturn:
-        """Downloads an image into a specified file"""
+    def fetch_page(self, curr_chapter : dict, image : str) -> tuple:
+        """Downloads a page, returns its size, sha256 and the buffer holding it
 
-        # Sets up retry configuration to prevent connection refusals from too many requests at once
-        with requests.Session() as session:
-            retry = Retry(connect=3, backoff_factor=0.5)
-            adapter = HTTPAdapter(max_retries=retry)
-            session.mount('http://', adapter)
-            session.mount('https://', adapter)
-            response = session.get(
-                                    image_url,
-                                    headers={"Connection":"close"}
-                                   )
+        A page that takes longer than most pages recently did is requested a second
+        time (from the next server if the chapter has a fallback) and whichever copy
+        arrives first is kept. A failed request moves on to the next server.
+        """
+        race = PageRace(curr_chapter["servers"])
+        pending = {} # Future -> attempt
+        chapter = self.chapter_label(curr_chapter)
 
-            if response and response.status_code == 200:
-                with open(image_file, "wb") as img_file:
-                    img_file.write(response.content)
-                self.update_completed(1)
+        def launch() -> NoReturn:
+            attempt, server = race.launch()
+            url = f"{server}{curr_chapter['hash']}/{image}"
+            pending[attempt_pool().submit(page_attempt, url, server, race, attempt, chapter)] = attempt
+
+        launch()
+
+        try:
+            while pending:
+                done, _ = wait(list(pending), timeout=race.timeout(), return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    del pending[future]
+                    result = future.result()
+                    if result:
+                        return result
+
+                if race.another(bool(done), list(pending.values())):
+                    launch()
+
+        finally:
+            race.abandon()
+
+        raise race.error
+
+
+    def download_page(self, page : dict, archive : ChapterArchive) -> bool:
+        """Downloads a page, a failed page is deferred to the retry queue, returns whether it arrived
 
+        A page is a dict with the chapter, image, target file (or archive entry), attempts
+        made and the chapter's write group
+        """
+        try:
+            size, digest, sink = self.fetch_page(page["chapter"], page["image"])
+        except PageError as error:
+            if self.retries.defer(page, error):
+                PAGE_RETRIES.inc()
+            else:
+                PAGES_FAILED.inc()
+                self.progress.page_failed()
+            return False
 
-    def threaded_chapter(self, chapter_folder : str, curr_chapter : dict, base_url : str) -> NoReturn:
+        # A disk writer saves and records the page, this worker moves on to the next one
+        disk_writer().submit(page["writes"], size, self.save_page, page, archive, sink, size, digest)
+        return True
+
+
+    def save_page(self, page : dict, archive : ChapterArchive, sink, size : int, digest : str) -> NoReturn:
+        """Writes a downloaded page and records it as finished (on a disk writer thread)
+
+        The page is then queued for post-processing from memory, if any steps are configured
+        """
+        processor = post_processor()
+        if processor:
+            sink.seek(0)
+            data = sink.read()
+
+        try:
+            keep_sink(sink, page["file"], archive, digest, self.chapter_label(page["chapter"]))
+            self.record_page(page["chapter"], page["image"], page["file"], (size, digest))
+        except Exception as error: # Not only disk errors, a page that wasn't saved must never look finished
+            PAGES_FAILED.inc()
+            self.progress.page_failed()
+            self.progress.note(f"Failed to save page       : '{page['file']}' ({type(error).__name__}: {error})")
+
+            with self.mutex_downloaded:
+                self.failed_saves += 1
+            raise
+
+        self.update_completed(1, size)
+
+        if processor:
+            # Archive entries are processed as if the chapter were a folder
+            page_file = path.join(self.chapter_folder(page["chapter"]), page["file"]) if archive else page["file"]
+            processor.submit(data, page_file)
+
+
+    def retry_pages(self) -> NoReturn:
+        """Retry the deferred pages as they come due, after the main pass
+
+        Waiting happens here (the manga's own thread), never in a worker or while
+        holding a host slot. The retries of each batch run like the main pass.
+        """
+        while len(self.retries):
+            time.sleep(self.retries.delay())
+
+            chapters = {}
+            for page in self.retries.due():
+                chapters.setdefault(page["chapter"]["id"], []).append(page)
+
+            archives = {}
+            writes = WriteGroup()
+            try:
+                pages = []
+                for chapter_id, chapter_pages in chapters.items():
+                    curr_chapter = chapter_pages[0]["chapter"]
+                    self.refresh_servers(curr_chapter)
+                    archives[chapter_id] = self.open_archive(self.chapter_folder(curr_chapter), curr_chapter)
+
+                    for page in chapter_pages:
+                        page["writes"] = writes
+                        if self.threaded:
+                            pages.append(self.job.submit(
+                                                         (curr_chapter["priority"], 0),
+                                                         self.download_page,
+                                                         page,
+                                                         archives[chapter_id]))
+                        else:
+                            self.download_page(page, archives[chapter_id])
+                wait(pages)
+
+            finally:
+                writes.wait()
+                for chapter_id, chapter_pages in chapters.items():
+                    self.close_archive(archives.get(chapter_id), chapter_pages[0]["chapter"])
+                    self.record_chapter(chapter_pages[0]["chapter"])
+
+
+    def chapter_label(self, curr_chapter : dict) -> str:
+        """Returns the name a chapter is shown with in traces"""
+        return f"{self.name}/{curr_chapter['num']}"
+
+
+    def chapter_folder(self, curr_chapter : dict) -> str:
+        """Returns the folder a chapter is downloaded to (the archive's name in cbz mode)"""
+        return f"{self.name}/{curr_chapter['num']}/"
+
+
+    def open_archive(self, chapter_folder : str, curr_chapter : dict) -> ChapterArchive:
+        """Returns the chapter's archive in cbz mode
+
+        Returns None in folder mode, or when the chapter's archive was already
+        completed (its pages are counted as completed)
+        """
+        if self.output != "cbz":
+            return None
+
+        if path.isfile(archive_file(chapter_folder)):
+            self.update_completed(len(curr_chapter["images"]))
+            return None
+
+        return ChapterArchive(archive_file(chapter_folder))
+
+
+    def close_archive(self, archive : ChapterArchive, curr_chapter : dict) -> NoReturn:
+        """Finish a chapter archive (it keeps its .part name if any page is missing)"""
+
+        if archive:
+            archive.close(complete=archive.count() == len(curr_chapter["images"]))
+
+
+    def page_target(self, chapter_folder : str, index : int, image : str, archive : ChapterArchive) -> str:
+        """Returns the file (or archive entry in cbz mode) a page is written to"""
+
+        if archive:
+            return page_entry(index+1, image)
+
+        # Name the image accordingly (based on 1, 2, 3, etc.)
+        return f"{chapter_folder}{index+1}{image[-4:]}"
+
+
+    def record_page(self, curr_chapter : dict, image : str, image_file : str, saved : tuple) -> NoReturn:
+        """Record a finished page in the download state"""
+
+        if self.state:
+            # Archive pages are recorded as files in the archive
+            if self.output == "cbz":
+                image_file = entry_path(archive_file(self.chapter_folder(curr_chapter)), image_file)
+
+            size, digest = saved
+            self.state.mark_page(self.manga_id, curr_chapter["id"], image, image_file, size, digest)
+
+
+    def record_chapter(self, curr_chapter : dict) -> NoReturn:
+        """Record a chapter as finished in the download state if all its pages are done"""
+
+        if self.state:
+            self.state.mark_chapter(
+                                    self.manga_id,
+                                    curr_chapter["id"],
+                                    curr_chapter["num"],
+                                    len(curr_chapter["images"]))
+
+
+    def threaded_image(
+                       self,
+                       image_file   : str,
+                       curr_chapter : dict,
+                       image        : str,
+                       archive      : ChapterArchive,
+                       writes       : WriteGroup) -> NoReturn:
+        """Downloads an image into a specified file (or archive entry)"""
+
+        if self.page_done(curr_chapter, image, archive, image_file):
+            return
+
+        if self.reuse_page(curr_chapter, image, image_file, archive):
+            return
+
+        self.download_page({"chapter":curr_chapter, "image":image, "file":image_file, "attempts":0, "writes":writes}, archive)
+
+
+    def threaded_chapter(self, chapter_folder : str, curr_chapter : dict) -> NoReturn:
         """Sends each image in a chapter into a separate thread to be downloaded"""
 
+        archive = self.open_archive(chapter_folder, curr_chapter)
+        if self.output == "cbz" and archive is None:
+            return
+
         # Creates the chapter directory for the current chapter being downloaded
-        if not path.isdir(chapter_folder):
-            mkdir(chapter_folder)
+        if not archive:
+            disk_writer().make_folder(chapter_folder)
+
+        # Hands each image to the shared page scheduler, lower chapters (then pages) go first
+        writes = WriteGroup()
+        try:
+            pages = []
+            for index, image in enumerate(curr_chapter["images"]):
+                image_file = self.page_target(chapter_folder, index, image, archive)
+                pages.append(self.job.submit(
+                                             (curr_chapter["priority"], index),
+                                             self.threaded_image,
+                                             image_file,
+                                             curr_chapter,
+                                             image,
+                                             archive,
+                                             writes))
+            wait(pages)
+        finally:
+            writes.wait()
+            self.close_archive(archive, curr_chapter)
 
-        # Downloads each image in a separate thread (Default: 10 threads running at a time)
-        with ThreadPoolExecutor(max_workers=config.MAX_IMAGE_THREADS) as executor:
-            for image in curr_chapter["images"]:
-                image_url = f"{base_url}{image}"
+        self.record_chapter(curr_chapter)
 
-                # Name the image accordingly (based on 1, 2, 3, etc.)
-                image_file = f"{chapter_folder}{curr_chapter['images'].index(image)+1}{image[-4:]}"
-                executor.submit(self.threaded_image, image_file, image_url)
 
+    def queue_chapter(self, chapter_queue : Queue, chapter_id : int) -> NoReturn:
+        """Retrieve a chapter's img urls and hand them to the download stage
 
-    def threaded_download(self) -> NoReturn:
-        """Downloads each chapter in its own thread"""
+        Blocks while the queue is full, so chapter info can't run far ahead of the downloads
+        """
+        curr_chapter = None
+        try:
+            curr_chapter = self.image_urls(chapter_id)
+        except Exception as error:
+            self.chapter_failed(error)
+        finally:
+            # Always hand something over, the download stage waits for one item per chapter
+            chapter_queue.put(curr_chapter)
 
-        if not path.isdir(self.name):
-            mkdir(self.name)
 
-        with ThreadPoolExecutor(max_workers=config.MAX_CHAPTER_THREADS) as executor:
-            for chapter in self.chapters.keys():
+    def pipelined_chapter(self, curr_chapter : dict, slots : BoundedSemaphore) -> NoReturn:
+        """Downloads a chapter from the pipeline and frees its slot when finished"""
 
-                chapter_folder = f"{self.name}/{chapter}/"
-                curr_chapter = self.chapters[chapter]
-                base_url = f"{curr_chapter['server']}{curr_chapter['hash']}/"
-                executor.submit(self.threaded_chapter, chapter_folder, curr_chapter, base_url)
+        try:
+            self.threaded_chapter(self.chapter_folder(curr_chapter), curr_chapter)
+        finally:
+            slots.release()
 
 
-    def regular_download(self) -> NoReturn:
-        """Downloads each chapter and image in a single thread"""
+    def threaded_download(self, chapter_list : list) -> NoReturn:
+        """Downloads each chapter in its own thread as soon as its img urls arrive
 
-        if not path.isdir(self.name):
-            mkdir(self.name)
+        Chapter info threads feed a bounded queue that the download stage empties
+        (the first pages start downloading after a single chapter info request)
+        """
+        makedirs(self.name, exist_ok=True)
 
-        for chapter in self.chapters.keys():
+        # Every manga's pages share one pool of download workers
+        self.job = page_scheduler().job(self.name)
+        try:
+            chapter_queue = Queue(maxsize=config.PIPELINE_DEPTH)
 
-            chapter_folder = f"{self.name}/{chapter}/"
-            curr_chapter = self.chapters[chapter]
-            base_url = f"{curr_chapter['server']}{curr_chapter['hash']}/"
+            # Limits chapters waiting on or in the download stage (backpressure)
+            slots = BoundedSemaphore(config.MAX_CHAPTER_THREADS + config.PIPELINE_DEPTH)
 
-            if not path.isdir(chapter_folder):
-                    mkdir(chapter_folder)
+            chapters = []
+            with ThreadPoolExecutor(max_workers=config.MAX_CHAPTER_THREADS) as downloads:
+                with ThreadPoolExecutor(max_workers=config.MAX_CHAPTER_THREADS) as setup:
+                    for chapter in chapter_list:
+                        setup.submit(self.queue_chapter, chapter_queue, chapter)
 
-            for image in curr_chapter["images"]:
+                    for _ in chapter_list:
+                        curr_chapter = chapter_queue.get()
+                        if curr_chapter is None:
+                            continue
 
-                image_url = f"{base_url}{image}"
-                image_file = f"{chapter_folder}{image}"
-                response = requests.get(image_url, headers={"Connection":"close"})
+                        slots.acquire()
+                        chapters.append(downloads.submit(self.pipelined_chapter, curr_chapter, slots))
 
-                if response and response.status_code == 200:
-                    with open(image_file, "wb") as img_file:
-                        img_file.write(response.content)
-                else:
-                    print(f"Error downloading chapter: {curr_chapter['num']} Image: {image}")
+            # A failed chapter doesn't stop the rest of the manga
+            for chapter in chapters:
+                if chapter.exception():
+                    self.chapter_failed(chapter.exception())
 
+            self.retry_pages()
+        finally:
+            self.job.close()
 
-    def percent_done(self) -> int:
-        """ Returns percentage of the number of downloaded images vs the total images to download"""
-        percent = (self.downloaded_images/self.total_images) * 100
-        return int(percent)
 
+    def regular_chapter(self, chapter_folder : str, curr_chapter : dict) -> NoReturn:
+        """Downloads each image in a chapter one by one"""
+
+        archive = self.open_archive(chapter_folder, curr_chapter)
+        if self.output == "cbz" and archive is None:
+            return
+
+        if not archive:
+            disk_writer().make_folder(chapter_folder)
 
-    def status(self) -> NoReturn:
-        """Updates the percent downloaded status for the current manga"""
+        writes = WriteGroup()
+        try:
+            for index, image in enumerate(curr_chapter["images"]):
 
-        curr_status= self.percent_done()
-        while(curr_status < 100):
+                image_file = self.page_target(chapter_folder, index, image, archive)
 
-            update_status(name=self.name, status=curr_status)
-            time.sleep(0.5)
+                if self.page_done(curr_chapter, image, archive, image_file):
+                    continue
 
-            curr_status = self.percent_done()
+                if self.reuse_page(curr_chapter, image, image_file, archive):
+                    continue
 
-        update_status(name=self.name, status=curr_status)
+                self.download_page({"chapter":curr_chapter, "image":image, "file":image_file, "attempts":0, "writes":writes}, archive)
+        finally:
+            writes.wait()
+            self.close_archive(archive, curr_chapter)
+
+        self.record_chapter(curr_chapter)
+
+
+    def regular_download(self, chapter_list : list) -> NoReturn:
+        """Downloads each chapter and image in a single thread, right after its img urls arrive"""
+
+        # Another manga with the same title may create it at the same time
+        makedirs(self.name, exist_ok=True)
+
+        for chapter in chapter_list:
+
+            # A failed chapter doesn't stop the rest of the manga
+            try:
+                curr_chapter = self.image_urls(chapter)
+            except Exception as error:
+                self.chapter_failed(error)
+                continue
+
+            self.regular_chapter(self.chapter_folder(curr_chapter), curr_chapter)
+
+        self.retry_pages()
+
+
+    def percent_done(self) -> int:
+        """ Returns percentage of the number of downloaded images vs the total images to download"""
+        if not self.total_images:
+            return 0
+
+        percent = (self.downloaded_images/self.total_images) * 100
+        return int(percent)
@@ -0,0 +1,122 @@
+"""Feed module that contains:
+                               The MangaDex api v5 metadata backend
+
+                               A manga's chapters are listed by a paginated feed, the first page
+                               gives the total and the rest are requested at once. Each chapter's
+                               image server is looked up on the at-home endpoint, the answer is
+                               read into the same chapter shape the api v2 backend returns"""
+import re
+
+from typing import NoReturn
+
+import config
+
+from chapters import ChapterRecord
+from scheduler import chapter_priority
+from selection import ChapterSelection
+
+
+find_uuid = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
+
+# The feed leaves out chapters of any content rating that isn't asked for
+CONTENT_RATINGS = ("safe", "suggestive", "erotica", "pornographic")
+
+
+def check_manga_id(manga_id : str) -> NoReturn:
+    """Raise if a manga id isn't an api v5 id (numeric ids belong to the retired api v2)"""
+
+    if not find_uuid.match(manga_id):
+        raise ValueError(f"'{manga_id}' isn't an api v5 manga id, use the manga's current url (or --api v2)")
+
+
+def manga_url(manga_id : str) -> str:
+    """Returns the api v5 url for a manga (its title)"""
+    return f"{config.API_URL}/manga/{manga_id}"
+
+
+def feed_url(manga_id : str, language_id : str, offset : int, selection : ChapterSelection = None) -> str:
+    """Returns the api v5 url for a page of a manga's chapter feed in one language
+
+    Groups are listed with their names, groups the selection excludes by id are left out by the api
+    """
+    ratings = "".join(f"&contentRating[]={rating}" for rating in CONTENT_RATINGS)
+    excluded = "".join(f"&excludedGroups[]={group}" for group in sorted(selection.exclude_groups)
+                       if find_uuid.match(group)) if selection else ""
+
+    return (f"{config.API_URL}/manga/{manga_id}/feed?limit={config.FEED_PAGE_SIZE}&offset={offset}"
+            f"&translatedLanguage[]={config.language_by_id(language_id)[3]}&order[chapter]=asc"
+            f"&includes[]=scanlation_group{ratings}{excluded}")
+
+
+def at_home_url(chapter_id : str) -> str:
+    """Returns the api v5 url for a chapter's image server"""
+    return f"{config.API_URL}/at-home/server/{chapter_id}"
+
+
+def manga_title(manga : dict) -> str:
+    """Returns a manga's title (english if it has one)"""
+
+    titles = manga["data"]["attributes"]["title"]
+    return titles.get("en") or next(iter(titles.values()), None)
+
+
+def feed_offsets(first_page : dict) -> list:
+    """Returns the offsets of the feed pages after the first one"""
+    return list(range(first_page["limit"], first_page["total"], first_page["limit"]))
+
+
+def release_groups(chapter : dict) -> list:
+    """Returns the ids and names of the groups that released a feed chapter"""
+
+    groups = []
+    for relationship in chapter.get("relationships", ()):
+        if relationship["type"] == "scanlation_group":
+            groups.append(relationship["id"])
+            name = (relationship.get("attributes") or {}).get("name")
+            if name:
+                groups.append(name)
+
+    return groups
+
+
+def select_feed(feed_pages : list, selection : ChapterSelection = None) -> list:
+    """Returns one chapter record per chapter number from the pages of a chapter feed
+
+    The feed carries no view counts, a chapter released by several groups keeps the
+    first release listed (releases of groups the selection excludes are skipped).
+    Chapters hosted elsewhere (external url) have no pages here.
+    Records are returned in download priority order
+    """
+    selected = {} # Chapter number -> ChapterRecord
+
+    for feed_page in feed_pages:
+        for chapter in feed_page["data"]:
+            attributes = chapter["attributes"]
+            if attributes.get("externalUrl") or not attributes.get("pages", 1):
+                continue
+
+            if selection and selection.excluded(release_groups(chapter), chapter["id"]):
+                continue
+
+            # Empty chapter numbers (oneshots) count as chapter 0
+            number = attributes["chapter"] or "0"
+            if number not in selected:
+                selected[number] = ChapterRecord(chapter["id"], number, attributes.get("volume"), 0)
+
+    return sorted(selected.values(), key=lambda record: chapter_priority(record.chapter))
+
+
+def at_home_chapter(at_home : dict, chapter_id : str, number : str, datasaver : bool) -> dict:
+    """Returns an at-home answer in the shape of an api v2 chapter response"""
+
+    quality = "data-saver" if datasaver else "data"
+
+    return {
+            "data":{
+                    "id":chapter_id,
+                    "chapter":number,
+                    "hash":at_home["chapter"]["hash"],
+                    "pages":at_home["chapter"]["dataSaver" if datasaver else "data"],
+                    "server":f"{at_home['baseUrl']}/{quality}/",
+                   }
+            }
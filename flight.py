@@ -0,0 +1,147 @@
+"""Flight module that contains:
+                                Single-flight coalescing of identical work
+
+                                Concurrent calls with the same key (a manga, or an api url) share one
+                                call in flight, the first caller makes it and the others wait for its
+                                result. Duplicate manga jobs are merged before they are scheduled"""
+import asyncio
+
+from threading import (Event, Lock)
+from typing import NoReturn
+
+
+class Flight():
+    """A call in flight and, once it returned, its result (or the exception it raised)"""
+
+    def __init__(self):
+
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight():
+    """Threadsafe single-flight group, counts the calls that shared another call's result"""
+
+    def __init__(self):
+
+        self.flights = {} # Key -> Flight
+        self.mutex = Lock()
+
+        self.calls = 0
+        self.shared = 0
+
+
+    def do(self, key, function, *args):
+        """Returns function(*args), or the result of the call with the same key already in flight"""
+
+        with self.mutex:
+            self.calls += 1
+            flight = self.flights.get(key)
+
+            if flight is not None:
+                self.shared += 1
+            else:
+                leader = self.flights[key] = Flight()
+
+        if flight is not None:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            leader.result = function(*args)
+            return leader.result
+        except BaseException as error:
+            leader.error = error
+            raise
+        finally:
+            with self.mutex:
+                del self.flights[key]
+            leader.done.set()
+
+
+class AsyncSingleFlight():
+    """Single-flight group for coroutines on one event loop"""
+
+    def __init__(self):
+
+        self.flights = {} # Key -> Future
+
+        self.calls = 0
+        self.shared = 0
+
+
+    async def do(self, key, function, *args):
+        """Returns await function(*args), or the result of the call with the same key already in flight"""
+
+        self.calls += 1
+        future = self.flights.get(key)
+
+        if future is not None:
+            self.shared += 1
+            return await asyncio.shield(future) # A waiter that is cancelled leaves the call running
+
+        future = self.flights[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await function(*args)
+            future.set_result(result)
+            return result
+        except BaseException as error:
+            if isinstance(error, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(error)
+                future.exception() # Only the waiters (if any) raise it
+            raise
+        finally:
+            del self.flights[key]
+
+
+def merge_jobs(url_list : list, key) -> tuple:
+    """Merge the urls with the same key (e.g. manga id), returns the first url of every key and each url's job
+
+    jobs[index[i]] is the job that downloads url_list[i]
+    """
+    positions = {} # Key -> job
+    jobs = []
+    index = []
+
+    for url in url_list:
+        job_key = key(url)
+        if job_key not in positions:
+            positions[job_key] = len(jobs)
+            jobs.append(url)
+        index.append(positions[job_key])
+
+    return jobs, index
+
+
+# Api requests (manga, chapter list and chapter urls) of the thread and async engines
+API_FLIGHTS = SingleFlight()
+ASYNC_API_FLIGHTS = AsyncSingleFlight()
+
+MERGED = 0 # Duplicate manga jobs merged this run
+m_merged = Lock()
+
+
+def jobs_merged(count : int) -> NoReturn:
+    """Count duplicate manga jobs that were merged into another job"""
+
+    global MERGED
+
+    with m_merged:
+        MERGED += count
+
+
+def print_flight_stats() -> NoReturn:
+    """Display the duplicate jobs merged and the api requests that shared one in flight"""
+
+    calls = API_FLIGHTS.calls + ASYNC_API_FLIGHTS.calls
+    shared = API_FLIGHTS.shared + ASYNC_API_FLIGHTS.shared
+
+    if not MERGED and not shared:
+        return
+
+    print(f"Coalesced: {MERGED} duplicate manga merged, {shared} of {calls} api requests shared one in flight")
@@ -0,0 +1,298 @@
+"""Hedge module that contains:
+                               Hedged page requests and image server (MangaDex@Home) health
+
+                               A page that hasn't arrived by an adaptive latency percentile gets a
+                               second request, to the chapter's fallback server when it has one,
+                               and servers that keep failing are dropped for the rest of the run"""
+import time
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import NoReturn
+
+import config
+
+from retry import PageError
+
+
+class LatencyTracker():
+    """Recent page latencies, used to decide when a page is late enough to hedge"""
+
+    def __init__(self, window : int, percentile : float):
+
+        self.percentile = percentile
+        self.latencies = deque(maxlen=window)
+        self.cached = None
+        self.stale = 0 # Latencies recorded since the deadline was last computed
+
+        self.requests = 0 # Pages
+        self.hedges = 0
+        self.mutex = Lock()
+
+
+    def started(self) -> NoReturn:
+        with self.mutex:
+            self.requests += 1
+
+
+    def record(self, latency : float) -> NoReturn:
+        with self.mutex:
+            self.latencies.append(latency)
+            self.stale += 1
+
+
+    def deadline(self) -> float:
+        """Returns how long a page may take before it is hedged (None until enough pages were seen)"""
+
+        with self.mutex:
+            if len(self.latencies) < config.HEDGE_MIN_SAMPLES:
+                return None
+
+            # Sorting the window on every page would cost more than it saves
+            if self.cached is None or self.stale >= config.HEDGE_REFRESH:
+                ordered = sorted(self.latencies)
+                index = min(int(self.percentile * len(ordered)), len(ordered) - 1)
+                self.cached = max(ordered[index], config.HEDGE_MIN_DELAY)
+                self.stale = 0
+
+            return self.cached
+
+
+    def allow_hedge(self) -> bool:
+        """Returns whether another hedge fits in the budget (a fraction of all page requests)"""
+
+        with self.mutex:
+            if self.hedges >= self.requests * config.HEDGE_BUDGET:
+                return False
+            self.hedges += 1
+            return True
+
+
+class ServerHealth():
+    """Request outcomes of a single image server"""
+
+    def __init__(self, server : str):
+
+        self.server = server
+        self.requests = 0
+        self.failures = 0
+        self.consecutive = 0 # Failures since the last success
+        self.latency = 0.0   # Total latency of successful requests
+        self.wins = 0        # Pages delivered by a hedge or failover request to this server
+        self.dropped = False
+        self.mutex = Lock()
+
+
+    def succeeded(self, latency : float) -> NoReturn:
+        with self.mutex:
+            self.requests += 1
+            self.consecutive = 0
+            self.latency += latency
+
+
+    def failed(self) -> NoReturn:
+        with self.mutex:
+            self.requests += 1
+            self.failures += 1
+            self.consecutive += 1
+
+            if self.consecutive >= config.SERVER_MAX_FAILURES:
+                self.dropped = True
+
+
+    def won(self) -> NoReturn:
+        with self.mutex:
+            self.wins += 1
+
+
+    def stats(self) -> dict:
+        with self.mutex:
+            successes = self.requests - self.failures
+            return {
+                    "requests":self.requests,
+                    "failures":self.failures,
+                    "latency":self.latency / successes if successes else 0.0,
+                    "hedge_wins":self.wins,
+                    "dropped":self.dropped,
+                    }
+
+
+class PageRace():
+    """The requests for a single page, decides when another one is sent and which one is kept"""
+
+    def __init__(self, servers : list):
+
+        healthy = healthy_servers(servers)
+
+        # Without a fallback server the hedge goes to the same server (on a new connection)
+        self.candidates = healthy if len(healthy) > 1 else healthy * 2
+        self.servers = [] # Server of each attempt, in the order they were sent
+        self.hedged = not config.HEDGE
+        self.start = None # When the first attempt got its host slot and was sent (the wait for a slot is no delay)
+
+        self.winner = None
+        self.error = PageError() # Last failure (raised if no attempt succeeds)
+        self.streams = {} # Attempt -> function that stops its response, while it streams
+        self.mutex = Lock()
+
+        TRACKER.started()
+
+
+    def launch(self) -> tuple:
+        """Returns the number and server of the next attempt"""
+
+        server = self.candidates[len(self.servers)]
+        self.servers.append(server)
+        return len(self.servers) - 1, server
+
+
+    def sent(self, attempt : int) -> NoReturn:
+        """An attempt is about to send its request"""
+
+        if attempt == 0:
+            self.start = time.perf_counter()
+
+
+    def timeout(self) -> float:
+        """Returns how long to wait for the attempts before checking on them again"""
+
+        deadline = TRACKER.deadline()
+        if self.hedged or deadline is None or self.start is None:
+            return config.HEDGE_POLL
+        return min(max(deadline - (time.perf_counter() - self.start), 0.0), config.HEDGE_POLL)
+
+
+    def another(self, failed : bool, pending : list) -> bool:
+        """Returns whether to send another attempt
+
+        failed is whether an attempt just failed, pending the attempts still running
+        """
+        if len(self.servers) >= len(self.candidates):
+            return False
+
+        # Fail over when every attempt failed or is stuck on a dropped server
+        if failed and not pending:
+            return True
+        if any(server_health(self.servers[attempt]).dropped for attempt in pending):
+            return True
+
+        if self.hedged:
+            return False
+
+        deadline = TRACKER.deadline()
+        if deadline is None or self.start is None or time.perf_counter() - self.start < deadline:
+            return False
+
+        # Late page, hedge it (once)
+        self.hedged = True
+        return TRACKER.allow_hedge()
+
+
+    def over(self) -> bool:
+        return self.winner is not None
+
+
+    def fail(self, status : int = None, wait : float = 0.0, reason : str = None) -> NoReturn:
+        """An attempt failed (status is None when there was no response, reason if the page was damaged)"""
+
+        with self.mutex:
+            self.error = PageError(status, wait, reason)
+
+
+    def streaming(self, attempt : int, stop) -> bool:
+        """An attempt's response started streaming, returns False if the page was already delivered
+
+        stop is called (from another thread) if the page is delivered or abandoned while it streams
+        """
+        with self.mutex:
+            if self.winner is not None:
+                return False
+            self.streams[attempt] = stop
+            return True
+
+
+    def streamed(self, attempt : int) -> NoReturn:
+        """An attempt's response finished streaming (it can no longer be stopped)"""
+
+        with self.mutex:
+            self.streams.pop(attempt, None)
+
+
+    def claim(self, attempt : int) -> bool:
+        """Returns whether the attempt is the first to finish (and so the one to keep)
+
+        The attempts still streaming are stopped, not just left to notice
+        """
+        with self.mutex:
+            if self.winner is not None:
+                return False
+
+            self.winner = attempt
+            if attempt > 0:
+                server_health(self.servers[attempt]).won()
+
+            for stop in self.streams.values():
+                stop()
+            self.streams.clear()
+            return True
+
+
+    def abandon(self) -> NoReturn:
+        """Stop the attempts still running (the page failed or is no longer needed)"""
+        self.claim(-1)
+
+
+TRACKER = LatencyTracker(config.HEDGE_WINDOW, config.HEDGE_PERCENTILE)
+
+SERVERS = {}
+ATTEMPTS = None
+m_servers = Lock()
+
+
+def server_health(server : str) -> ServerHealth:
+    """Returns the health record of an image server"""
+
+    with m_servers:
+        if server not in SERVERS:
+            SERVERS[server] = ServerHealth(server)
+        return SERVERS[server]
+
+
+def healthy_servers(servers : list) -> list:
+    """Returns a chapter's servers that haven't been dropped (all of them if every one was)"""
+
+    healthy = [server for server in servers if not server_health(server).dropped]
+    return healthy or servers
+
+
+def attempt_pool() -> ThreadPoolExecutor:
+    """Returns the pool page requests run on (so a late request can be hedged while it runs)"""
+
+    global ATTEMPTS
+
+    with m_servers:
+        if ATTEMPTS is None:
+            ATTEMPTS = ThreadPoolExecutor(max_workers=2 * config.MAX_PAGE_WORKERS)
+        return ATTEMPTS
+
+
+def server_stats() -> dict:
+    """Returns the request outcomes of every image server"""
+
+    with m_servers:
+        servers = list(SERVERS.values())
+
+    return {health.server:health.stats() for health in servers}
+
+
+def print_server_stats() -> NoReturn:
+    """Display each image server's success rate and latency, and how many pages were hedged"""
+
+    for server, stats in server_stats().items():
+        print(f"{server}: {stats['requests'] - stats['failures']} of {stats['requests']} requests ok, "
+              f"{stats['latency']*1000:.0f}ms avg latency, {stats['hedge_wins']} hedges won"
+              f"{', dropped' if stats['dropped'] else ''}")
+
+    if TRACKER.hedges:
+        print(f"Hedged {TRACKER.hedges} of {TRACKER.requests} pages")
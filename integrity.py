@@ -0,0 +1,231 @@
+"""Integrity module that contains:
+                                   Checks that pages are complete and unchanged, while downloading and afterwards
+
+                                   A downloaded page must be as long as its response announced and hash to the
+                                   sha256 in its MangaDex filename. The verify command re-reads every recorded
+                                   page (memory mapped, in parallel) and only hands the damaged ones back to the
+                                   download state, so they are all a later run downloads again"""
+import hashlib
+import mmap
+import time
+import zipfile
+
+from concurrent.futures import ThreadPoolExecutor
+from os import (cpu_count, fstat, path, remove)
+from typing import NoReturn
+
+import config
+
+from archive import (reopen_without, split_entry, LOCAL_HEADER)
+from dedup import (page_digest, PageStore)
+from metrics import PAGES_DAMAGED
+from state import DownloadState
+
+
+# Damaged pages listed in the report
+MAX_LISTED_PAGES = 20
+
+
+def content_length(headers) -> int:
+    """Returns the size a response announced for its body (None if unknown or the body is content encoded)"""
+
+    if headers.get("Content-Encoding", "identity") != "identity":
+        return None
+
+    try:
+        return int(headers["Content-Length"])
+    except (KeyError, ValueError):
+        return None
+
+
+def page_problem(image : str, size : int, digest : str, length : int = None) -> str:
+    """Returns what is wrong with a downloaded page (None if it is intact)
+
+    The page must be as long as announced (length) and match the sha256 in its name (image is the
+    page's name or url), if it has one
+    """
+    if length is not None and size != length:
+        return f"cut short ({size} of {length} bytes)"
+
+    expected = page_digest(image)
+    if expected and digest != expected:
+        return "sha256 doesn't match the page name"
+
+    return None
+
+
+def file_digest(file_name : str) -> tuple:
+    """Returns the size and sha256 of a file, read through a memory map"""
+
+    with open(file_name, "rb") as page_file:
+        size = fstat(page_file.fileno()).st_size
+        if not size: # Empty files can't be mapped
+            return 0, hashlib.sha256().hexdigest()
+
+        with mmap.mmap(page_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return size, hashlib.sha256(data).hexdigest()
+
+
+def archive_digests(archive_path : str) -> dict:
+    """Returns the size and sha256 of every page in an archive (entry -> (size, sha256))
+
+    The archive is memory mapped once, stored pages are hashed where they lie
+    """
+    with zipfile.ZipFile(archive_path) as archive:
+        entries = archive.infolist()
+
+        digests = {}
+        with open(archive_path, "rb") as archive_file:
+            with mmap.mmap(archive_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for info in entries:
+                    if info.compress_type != zipfile.ZIP_STORED: # Not written by the downloader
+                        page = archive.read(info)
+                        digests[info.filename] = (len(page), hashlib.sha256(page).hexdigest())
+                        continue
+
+                    header = LOCAL_HEADER.unpack_from(data, info.header_offset)
+                    start = info.header_offset + LOCAL_HEADER.size + header[9] + header[10]
+
+                    with memoryview(data)[start:start + info.compress_size] as page:
+                        digests[info.filename] = (len(page), hashlib.sha256(page).hexdigest())
+
+    return digests
+
+
+def check_page(row : tuple, found : tuple) -> str:
+    """Returns what is wrong with a recorded page given its size and sha256 on disk (None if it is intact)"""
+
+    _, _, image, _, size, digest = row
+
+    if found is None:
+        return "missing"
+
+    found_size, found_digest = found
+    if found_size != size:
+        return f"size changed ({found_size} of {size} bytes)"
+
+    # The name's sha256 also catches pages that were already damaged when they were recorded
+    if found_digest != (page_digest(image) or digest):
+        return "sha256 doesn't match"
+
+    return None
+
+
+def check_file(row : tuple) -> list:
+    """Check a recorded page file, returns [(row, problem)] if it is damaged"""
+
+    try:
+        found = file_digest(row[3])
+    except FileNotFoundError:
+        found = None
+
+    problem = check_page(row, found)
+    return [(row, problem)] if problem else []
+
+
+def check_archive(archive_path : str, rows : list) -> list:
+    """Check the recorded pages of an archive, returns (row, problem) for every damaged page
+
+    Pages of a chapter that never finished (only the .part archive exists) are left to the
+    next download, which checks them itself
+    """
+    if not path.isfile(archive_path):
+        if path.isfile(f"{archive_path}.part"):
+            return []
+        return [(row, "missing") for row in rows]
+
+    try:
+        digests = archive_digests(archive_path)
+    except (zipfile.BadZipFile, OSError, ValueError) as error:
+        return [(row, f"unreadable archive ({error})") for row in rows]
+
+    damaged = []
+    for row in rows:
+        _, entry = split_entry(row[3])
+        problem = check_page(row, digests.get(entry))
+        if problem:
+            damaged.append((row, problem))
+
+    return damaged
+
+
+def verify_pages(state : DownloadState) -> tuple:
+    """Re-read every page recorded in the download state, returns the pages checked and the damaged ones
+
+    Page files and archives are checked in parallel, damaged pages are (row, problem)
+    """
+    rows = state.recorded_pages()
+
+    files = []
+    archives = {} # Archive -> recorded pages in it
+    for row in rows:
+        archive_path, _ = split_entry(row[3])
+        if archive_path:
+            archives.setdefault(archive_path, []).append(row)
+        else:
+            files.append(row)
+
+    with ThreadPoolExecutor(max_workers=config.VERIFY_THREADS or cpu_count() or 1) as checks:
+        results = list(checks.map(check_file, files))
+        results += list(checks.map(check_archive, archives, archives.values()))
+
+    return rows, sorted((page for damaged in results for page in damaged), key=lambda page: page[0][3])
+
+
+def requeue_damaged(state : DownloadState, damaged : list) -> dict:
+    """Hand the damaged pages back to the download state, returns manga id -> ids of the chapters they belong to
+
+    Finished archives with damaged pages are reopened without them (an unreadable one is removed).
+    Their copies in the page store are removed too, a damaged page file may be a link to one
+    """
+    archives = {} # Archive -> damaged entries
+    for row, problem in damaged:
+        archive_path, entry = split_entry(row[3])
+        if archive_path and path.isfile(archive_path):
+            archives.setdefault(archive_path, set()).add(entry)
+
+    for archive_path, entries in archives.items():
+        try:
+            reopen_without(archive_path, entries)
+        except (zipfile.BadZipFile, ValueError): # Every page of it is damaged
+            remove(archive_path)
+
+    store = PageStore(config.PAGE_STORE_DIR)
+    for row, _ in damaged:
+        digest = page_digest(row[2])
+        if digest:
+            store.discard(digest)
+
+    state.requeue_pages([(manga_id, chapter_id, image) for (manga_id, chapter_id, image, *_), _ in damaged])
+    chapters = {}
+    for (manga_id, chapter_id, *_), _ in damaged:
+        chapters.setdefault(manga_id, set()).add(chapter_id)
+    return chapters
+
+
+def verify(state : DownloadState) -> dict:
+    """Verify every recorded page and requeue the damaged ones, returns manga id -> ids of the chapters to download again"""
+
+    time_start = time.perf_counter()
+    rows, damaged = verify_pages(state)
+    elapsed = time.perf_counter() - time_start
+
+    size = sum(row[4] for row in rows)
+    print(f"Verified {len(rows)} pages ({size / (1024 * 1024):.1f} MB) in {elapsed:.2f} seconds, "
+          f"{len(damaged)} damaged")
+
+    for row, problem in damaged[:MAX_LISTED_PAGES]:
+        print(f"    {problem}: '{row[3]}'")
+
+    if len(damaged) > MAX_LISTED_PAGES:
+        print(f"    ... {len(damaged) - MAX_LISTED_PAGES} more")
+
+    return requeue_damaged(state, damaged) if damaged else {}
+
+
+def print_integrity_stats() -> NoReturn:
+    """Display how many page responses arrived damaged (they were never saved)"""
+
+    damaged = sum(value for _, _, value in PAGES_DAMAGED.samples())
+    if damaged:
+        print(f"Integrity: {int(damaged)} damaged page responses discarded (requested again)")
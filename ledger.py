@@ -0,0 +1,203 @@
+"""Ledger module that contains:
+                                 The shared job ledger of a multi-process (or multi-machine) download
+
+                                 Manga are work units leased to one worker at a time. A worker keeps
+                                 renewing its leases while it downloads, so the units of a crashed
+                                 worker expire and are leased again by the others"""
+import sqlite3
+import time
+
+from os import getpid
+from socket import gethostname
+from threading import (Event, Lock, Thread)
+from typing import NoReturn
+
+import config
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS units (
+    url      TEXT PRIMARY KEY,
+    state    TEXT NOT NULL DEFAULT 'pending',
+    worker   TEXT,
+    expires  REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    finished REAL
+);
+"""
+
+STATES = ("pending", "leased", "done", "failed")
+
+
+def worker_name() -> str:
+    """Returns the name this process leases units under (host and process id)"""
+    return f"{gethostname()}:{getpid()}"
+
+
+class JobLedger():
+    """Threadsafe work unit ledger stored in a SQLite file every worker can reach
+
+    Units move from pending to leased (with an expiry) to done, or back to
+    pending when they failed (failed for good after LEDGER_MAX_ATTEMPTS leases)
+    """
+
+    def __init__(self, ledger_file : str):
+
+        self.ledger_file = ledger_file
+        self.mutex = Lock()
+
+        # Transactions are started explicitly, a lease is read and taken in one write transaction.
+        # The rollback journal (unlike WAL) works for workers on other machines sharing the file
+        self.connection = sqlite3.connect(
+                                          ledger_file,
+                                          timeout=config.SQLITE_TIMEOUT,
+                                          isolation_level=None,
+                                          check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=DELETE")
+        self.connection.executescript(SCHEMA)
+
+
+    def add(self, url_list : list) -> int:
+        """Add manga urls as pending units, returns how many weren't listed yet"""
+
+        with self.mutex:
+            self.connection.execute("BEGIN IMMEDIATE")
+            added = 0
+            for url in url_list:
+                added += self.connection.execute("INSERT OR IGNORE INTO units (url) VALUES (?)", (url,)).rowcount
+            self.connection.execute("COMMIT")
+
+        return added
+
+
+    def lease(self, worker : str, count : int = 1) -> list:
+        """Lease up to count units (pending ones, or leased ones whose lease expired)
+
+        Expired units that already used up their attempts are failed instead
+        (a unit that crashes every worker taking it isn't handed out forever)
+        """
+        now = time.time()
+
+        with self.mutex:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.execute(
+                                        "UPDATE units SET state = 'failed', worker = NULL, finished = ? "
+                                        "WHERE state = 'leased' AND expires < ? AND attempts >= ?",
+                                        (now, now, config.LEDGER_MAX_ATTEMPTS))
+
+                rows = self.connection.execute(
+                                               "SELECT url FROM units WHERE state = 'pending' "
+                                               "OR (state = 'leased' AND expires < ?) ORDER BY rowid LIMIT ?",
+                                               (now, count)).fetchall()
+
+                urls = [row[0] for row in rows]
+                self.connection.executemany(
+                                            "UPDATE units SET state = 'leased', worker = ?, expires = ?, "
+                                            "attempts = attempts + 1 WHERE url = ?",
+                                            [(worker, now + config.LEDGER_LEASE, url) for url in urls])
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+
+        return urls
+
+
+    def renew(self, worker : str, url_list : list) -> int:
+        """Extend the leases a worker still holds, returns how many it still held"""
+
+        with self.mutex:
+            renewed = self.connection.executemany(
+                                                  "UPDATE units SET expires = ? "
+                                                  "WHERE url = ? AND worker = ? AND state = 'leased'",
+                                                  [(time.time() + config.LEDGER_LEASE, url, worker)
+                                                   for url in url_list]).rowcount
+
+        return renewed
+
+
+    def finish(self, worker : str, url : str, succeeded : bool) -> NoReturn:
+        """Record the result of a leased unit (failed units go back to pending while attempts are left)
+
+        Nothing changes if the worker lost the lease to another worker in the meantime
+        """
+        with self.mutex:
+            if succeeded:
+                self.connection.execute(
+                                        "UPDATE units SET state = 'done', worker = NULL, finished = ? "
+                                        "WHERE url = ? AND worker = ? AND state = 'leased'",
+                                        (time.time(), url, worker))
+            else:
+                self.connection.execute(
+                                        "UPDATE units SET worker = NULL, finished = ?, "
+                                        "state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END "
+                                        "WHERE url = ? AND worker = ? AND state = 'leased'",
+                                        (time.time(), config.LEDGER_MAX_ATTEMPTS, url, worker))
+
+
+    def counts(self) -> dict:
+        """Returns the number of units in each state"""
+
+        with self.mutex:
+            rows = self.connection.execute("SELECT state, COUNT(*) FROM units GROUP BY state").fetchall()
+
+        counts = dict.fromkeys(STATES, 0)
+        counts.update(rows)
+        return counts
+
+
+    def remaining(self) -> int:
+        """Returns the number of units that aren't done or failed yet"""
+
+        counts = self.counts()
+        return counts["pending"] + counts["leased"]
+
+
+    def close(self) -> NoReturn:
+        """Close the ledger database"""
+
+        with self.mutex:
+            self.connection.close()
+
+
+class LeaseKeeper():
+    """Renews a worker's leases on a background thread while its units are downloading"""
+
+    def __init__(self, ledger : JobLedger, worker : str, url_list : list):
+
+        self.ledger = ledger
+        self.worker = worker
+        self.url_list = url_list
+        self.lost = False # A lease ran out and may have gone to another worker
+
+        self.stopped = Event()
+        self.thread = Thread(target=self.run, daemon=True)
+
+
+    def run(self) -> NoReturn:
+        while not self.stopped.wait(config.LEDGER_LEASE / 3):
+            try:
+                renewed = self.ledger.renew(self.worker, self.url_list)
+            except sqlite3.Error: # Tried again on the next renewal, well before the lease runs out
+                continue
+
+            self.lost = self.lost or renewed < len(self.url_list)
+
+
+    def __enter__(self) -> "LeaseKeeper":
+        self.thread.start()
+        return self
+
+
+    def __exit__(self, *args) -> NoReturn:
+        self.stopped.set()
+        self.thread.join()
+
+
+def print_ledger_stats(ledger : JobLedger) -> NoReturn:
+    """Display how many units of the ledger are in each state"""
+
+    counts = ledger.counts()
+    print(f"Ledger: {counts['done']} done, {counts['failed']} failed, "
+          f"{counts['leased']} leased, {counts['pending']} pending")
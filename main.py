@@ -1,40 +1,43 @@
 """Main module for the MangaDex Downloader program"""
+import argparse
 import re
 import sys
 import time
 
 from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+from multiprocessing import get_context
+from os import (cpu_count, makedirs, path, replace)
+from socket import gethostname
 from typing import NoReturn
 
 # Local modules
+import async_downloader
 import config
-from downloader import (display_status, update_status, MangaDownloader)
+import integrity
+import postprocess
+from state import DownloadState
+from ledger import (JobLedger, LeaseKeeper, print_ledger_stats, worker_name)
+from selection import ChapterSelection
+from throttle import print_host_stats
+from dedup import print_store_stats
+from hedge import print_server_stats
+from metrics import (print_metrics_summary, serve_metrics)
+from tracing import print_trace_summary
+from writer import print_writer_stats
+from downloader import (find_id, manga_key, print_cache_stats, print_connection_stats, MangaDownloader)
+from flight import (jobs_merged, merge_jobs, print_flight_stats)
+from progress import PROGRESS
+
+
+# Same manga id as the downloader reads from the url, so every accepted url has one
+check_url = re.compile(rf"[^\n]+mangadex\.org/{find_id.pattern}[^\n]*")
 
 
 def get_input(threaded : str, datasaver : str, language : str) -> list:
     """Get list of MangaDex urls from the user or exit the program if 'exit' is typed"""
     config.clear_screen()
-    print(f"\n\
-                          #############################                              \n\
-############################   MangaDex Downloader   ################################\n\
-#                         #############################                             #\n\
-#                                                                                   #\n\
-#    Input list of mangadex manga urls: (press enter after each url)                #\n\
-#                                                                                   #\n\
-#    Input format example:  https://mangadex.org/title/#####                        #\n\
-#                           https://mangadex.org/title/#####/<manga_name>           #\n\
-#                           etc...                                                  #\n\
-#                                                                                   #\n\
-#    Options:                                                                       #\n\
-#            Threaded: {threaded:<8}   Datasaver: {datasaver:<8}   Language: {language:<14}    #\n\
-#                                                                                   #\n\
-#                                                                                   #\n\
-#    Type 'exit' and press enter to exit the program                                #\n\
-#                                                                                   #\n\
-#                                                                                   #\n\
-#####################################################################################")
-
-    check = re.compile(r"[^\n]+mangadex.org/title/\d+[^\n]*")
+    config.print_banner([threaded, datasaver, language])
 
     url_list = []
     temp = input("")
@@ -44,7 +47,7 @@ def get_input(threaded : str, datasaver : str, language : str) -> list:
             print("Exiting...")
             sys.exit(1)
 
-        if check.search(temp):
+        if check_url.search(temp):
             url_list.append(temp)
         else:
             print("INVALID URL")
@@ -54,39 +57,534 @@ def get_input(threaded : str, datasaver : str, language : str) -> list:
         return url_list
 
 
-def start(
-          url_list : list,
-          threaded : bool,
-          datasaver : bool,
-          language : str,
-          language_id : str) -> NoReturn:
-    """Create downloader objects from a list of manga urls and start the download for each"""
-    time_start = time.perf_counter()
-    with ThreadPoolExecutor(max_workers=config.MAX_MANGA_THREADS) as executor:
+def download(
+             url_list : list,
+             threaded : bool,
+             datasaver : bool,
+             language : str,
+             language_id : str,
+             engine : str = config.ENGINE,
+             sync : bool = False,
+             output : str = config.OUTPUT_FORMAT,
+             executor : ThreadPoolExecutor = None,
+             state : DownloadState = None,
+             selection : ChapterSelection = None) -> list:
+    """Create downloader objects from a list of manga urls and download each, returns whether each finished
+
+    Urls of the same manga are downloaded once, each of them gets that download's result
+    """
+    jobs, index = merge_jobs(url_list, manga_key)
+    if len(jobs) < len(url_list):
+        jobs_merged(len(url_list) - len(jobs))
+        print(f"{len(url_list) - len(jobs)} duplicate manga urls merged, downloading {len(jobs)} manga")
+
+    own_state = state is None and config.USE_STATE
+    if own_state:
+        state = DownloadState(config.STATE_FILE)
+
+    if engine == "async" and not async_downloader.available():
+        print("The async engine requires aiohttp, falling back to the thread engine")
+        engine = "thread"
 
+    if config.POSTPROCESS and not postprocess.available():
+        print("Post-processing requires Pillow, pages are saved without it")
+        config.POSTPROCESS = []
 
-        # Update the total number of downloads before starting the display status function
-        # The display status function checks the total downloads vs number downloaded in order
-        # to know when to stop
-        for _ in range(len(url_list)):
-            update_status(to_total=True)
+    # The status lines are redrawn as download events arrive
+    PROGRESS.start([config.ENABLE(threaded), config.ENABLE(datasaver), language])
 
-        executor.submit(display_status)
+    try:
+        if engine == "async":
+            results = async_downloader.start(jobs, datasaver, language, language_id, state, sync, output, selection)
+            return [results[job] for job in index]
 
-        for url in url_list:
+        own_executor = executor is None
+        if own_executor:
+            executor = ThreadPoolExecutor(max_workers=config.MAX_MANGA_THREADS)
+
+        downloads = []
+        for url in jobs:
             downloader = MangaDownloader(
                                          url,
                                          threaded=threaded,
                                          datasaver=datasaver,
                                          language=language,
-                                         language_id=language_id)
-            executor.submit(downloader.initialize)
+                                         language_id=language_id,
+                                         state=state,
+                                         sync=sync,
+                                         output=output,
+                                         selection=selection)
+            downloads.append(executor.submit(downloader.initialize))
+
+        results = [future.result() for future in downloads]
+
+        if own_executor:
+            executor.shutdown()
+
+        return [results[job] for job in index]
+    finally:
+        postprocess.wait_post_processing()
+        PROGRESS.stop()
+
+        if own_state:
+            state.close()
+
+
+def start(
+          url_list : list,
+          threaded : bool,
+          datasaver : bool,
+          language : str,
+          language_id : str,
+          engine : str = config.ENGINE,
+          sync : bool = False,
+          output : str = config.OUTPUT_FORMAT,
+          executor : ThreadPoolExecutor = None,
+          state : DownloadState = None,
+          selection : ChapterSelection = None) -> list:
+    """Download every manga in a list of urls and display the run statistics, returns whether each manga finished
+
+    A long running caller can pass its own manga executor and download state so
+    they (along with the connection pool and response cache) stay warm between jobs
+    """
+    time_start = time.perf_counter()
+
+    if config.METRICS_PORT:
+        serve_metrics(config.METRICS_PORT)
+
+    results = download(url_list, threaded, datasaver, language, language_id, engine, sync, output, executor, state, selection)
 
     time_finish = time.perf_counter()
     print(f"Finished in {int(time_finish-time_start)} seconds")
+    print_connection_stats()
+    print_host_stats()
+    print_server_stats()
+    print_cache_stats()
+    print_store_stats()
+    print_writer_stats()
+    print_flight_stats()
+    integrity.print_integrity_stats()
+    postprocess.print_postprocess_stats()
+    print_trace_summary()
+    print_metrics_summary()
+
+    return results
+
+
+def read_urls(url_file : str) -> list:
+    """Read a list of manga urls from a file (one per line, '#' starts a comment)"""
+
+    url_list = []
+    with open(url_file) as urls:
+        for line in urls:
+            url = line.split("#", 1)[0].strip()
+
+            if not url:
+                continue
+
+            if check_url.search(url):
+                url_list.append(url)
+            else:
+                print(f"INVALID URL: {url}")
+
+    return url_list
+
+
+def run_job(job_file : str, args : argparse.Namespace, executor : ThreadPoolExecutor, state : DownloadState) -> bool:
+    """Download the urls listed in a spool job file, returns whether the job succeeded (every manga finished)"""
+
+    url_list = read_urls(job_file)
+    if not url_list:
+        return False
+
+    language = config.language_by_id(args.language)
+    results = start(
+                    url_list,
+                    args.threaded,
+                    args.datasaver,
+                    language[2],
+                    language[1],
+                    engine=args.engine,
+                    sync=args.sync,
+                    output=args.format,
+                    executor=executor,
+                    state=state,
+                    selection=args.selection)
+
+    return all(results)
+
+
+def serve(spool_dir : str, args : argparse.Namespace) -> NoReturn:
+    """Run as a service, downloading every job file (url list) placed in the spool directory
+
+    Jobs are claimed by renaming them, then moved to done/ or failed/. The manga executor,
+    download state, connection pool and response cache are shared by every job.
+    """
+    for folder in ("done", "failed"):
+        makedirs(path.join(spool_dir, folder), exist_ok=True)
+
+    print(f"Waiting for jobs in '{spool_dir}' (*{config.SPOOL_SUFFIX}), press Ctrl+C to stop")
+
+    state = DownloadState(config.STATE_FILE) if config.USE_STATE else None
+
+    with ThreadPoolExecutor(max_workers=config.MAX_MANGA_THREADS) as executor:
+        try:
+            while True:
+                jobs = sorted(glob(path.join(spool_dir, f"*{config.SPOOL_SUFFIX}")))
+
+                if not jobs:
+                    time.sleep(config.SPOOL_POLL)
+                    continue
+
+                for job in jobs:
+                    working = f"{job}.working"
+                    try:
+                        replace(job, working)
+                    except OSError: # Claimed by another service
+                        continue
+
+                    print(f"Starting job '{path.basename(job)}'")
+                    try:
+                        succeeded = run_job(working, args, executor, state)
+                    except Exception as error:
+                        print(f"Job '{path.basename(job)}' failed: {error}")
+                        succeeded = False
+
+                    folder = "done" if succeeded else "failed"
+                    replace(working, path.join(spool_dir, folder, path.basename(job)))
+
+        except KeyboardInterrupt:
+            print("Stopping...")
+
+        finally:
+            if state:
+                state.close()
+
+
+def tagged_file(file_name : str, tag : str) -> str:
+    """Returns a file name with a tag before its extension (mdd_trace.json -> mdd_trace.<tag>.json)"""
+
+    root, extension = path.splitext(file_name)
+    return f"{root}.{tag}{extension}"
+
+
+def work(args : argparse.Namespace, index : int) -> NoReturn:
+    """Worker process: download manga leased from the job ledger until every manga is done or failed
+
+    Up to MAX_MANGA_THREADS manga are leased at a time and their leases renewed while they
+    download. Manga that didn't finish go back to the ledger for another attempt.
+    """
+    configure(args, index)
 
+    worker = worker_name()
+    ledger = JobLedger(args.ledger)
+    state = DownloadState(config.STATE_FILE) if config.USE_STATE else None
+    language = config.language_by_id(args.language)
 
-def main() -> NoReturn:
+    if config.METRICS_PORT:
+        serve_metrics(config.METRICS_PORT)
+
+    finished = 0
+    failed = 0
+
+    with ThreadPoolExecutor(max_workers=config.MAX_MANGA_THREADS) as executor:
+        try:
+            while True:
+                url_list = ledger.lease(worker, config.MAX_MANGA_THREADS)
+
+                if not url_list:
+                    if not ledger.remaining():
+                        break
+
+                    # The last manga are leased by other workers (taken over if their leases run out)
+                    time.sleep(config.LEDGER_POLL)
+                    continue
+
+                with LeaseKeeper(ledger, worker, url_list) as keeper:
+                    try:
+                        results = download(
+                                           url_list,
+                                           args.threaded,
+                                           args.datasaver,
+                                           language[2],
+                                           language[1],
+                                           engine=args.engine,
+                                           sync=args.sync,
+                                           output=args.format,
+                                           executor=executor,
+                                           state=state,
+                                           selection=args.selection)
+                    except Exception as error:
+                        print(f"[{worker}] Download failed: {error}")
+                        results = [0] * len(url_list)
+
+                if keeper.lost:
+                    print(f"[{worker}] A lease ran out during the download, another worker may repeat it")
+
+                for url, result in zip(url_list, results):
+                    ledger.finish(worker, url, bool(result))
+                    finished += bool(result)
+                    failed += not result
+                    print(f"[{worker}] {'Finished' if result else 'Failed'}: {url}")
+
+        except KeyboardInterrupt: # The leases run out and the manga go to the other workers
+            pass
+
+        finally:
+            if state:
+                state.close()
+            ledger.close()
+
+    postprocess.stop_post_processing()
+    print(f"[{worker}] {finished} manga finished, {failed} failed")
+    print_flight_stats()
+    postprocess.print_postprocess_stats()
+    print_trace_summary()
+    print_metrics_summary()
+
+
+def coordinate(args : argparse.Namespace, url_list : list) -> NoReturn:
+    """Add the urls to the job ledger and run worker processes on it until every manga is done or failed
+
+    Workers started on other machines with the same ledger (and output folder) share the work
+    """
+    time_start = time.perf_counter()
+
+    ledger = JobLedger(args.ledger)
+    if url_list:
+        # Listed by manga id, so two urls of the same manga are one job
+        jobs, _ = merge_jobs(url_list, manga_key)
+        added = ledger.add([config.MANGA_URL.format(manga_key(url)) for url in jobs])
+        print(f"Added {added} manga to '{args.ledger}' ({len(url_list) - added} were duplicates or already listed)")
+
+    # Spawned (not forked) so every worker opens its own connections, the same on every platform
+    context = get_context("spawn")
+    workers = [context.Process(target=work, args=(args, index)) for index in range(args.workers)]
+    for worker in workers:
+        worker.start()
+
+    try:
+        for worker in workers:
+            worker.join(config.LEDGER_REPORT)
+            while worker.is_alive():
+                print_ledger_stats(ledger)
+                worker.join(config.LEDGER_REPORT)
+
+    except KeyboardInterrupt:
+        print("Stopping...")
+        for worker in workers:
+            worker.join()
+
+    finally:
+        time_finish = time.perf_counter()
+        print(f"Finished in {int(time_finish-time_start)} seconds")
+        print_ledger_stats(ledger)
+        ledger.close()
+
+
+def parse_args() -> argparse.Namespace:
+    """Parse the command line options"""
+
+    parser = argparse.ArgumentParser(description="MangaDex Downloader")
+    parser.add_argument(
+                        "urls",
+                        nargs="*",
+                        help="manga urls to download without any prompts")
+    parser.add_argument(
+                        "--file",
+                        help="file with manga urls to download (one per line)")
+    parser.add_argument(
+                        "--serve",
+                        metavar="SPOOL_DIR",
+                        help="keep running and download every url list file placed in SPOOL_DIR")
+    parser.add_argument(
+                        "--verify",
+                        action="store_true",
+                        help="check every downloaded page against its sha256 and download the damaged ones again "
+                             "(with the options of the original download)")
+    parser.add_argument(
+                        "--ledger",
+                        metavar="LEDGER_FILE",
+                        help="add the urls to a shared job ledger and download them with worker processes")
+    parser.add_argument(
+                        "--workers",
+                        type=int,
+                        default=1,
+                        help="number of worker processes on this machine (ledger mode, 0 only adds the urls)")
+    parser.add_argument(
+                        "--engine",
+                        choices=config.ENGINES,
+                        default=config.ENGINE,
+                        help="download engine (async requires aiohttp)")
+    parser.add_argument(
+                        "--sync",
+                        action="store_true",
+                        help="only download chapters that are new since the last run")
+    parser.add_argument(
+                        "--format",
+                        choices=config.OUTPUT_FORMATS,
+                        default=config.OUTPUT_FORMAT,
+                        help="save each chapter as a folder of pages or as a .cbz archive")
+    parser.add_argument(
+                        "--dedup",
+                        action="store_true",
+                        help="keep a store of downloaded pages, identical pages are downloaded once")
+    parser.add_argument(
+                        "--postprocess",
+                        metavar="STEPS",
+                        help=f"post-process every page in worker processes, comma separated steps in order "
+                             f"({', '.join(postprocess.STEPS)}), needs Pillow")
+    parser.add_argument(
+                        "--postprocess-processes",
+                        type=int,
+                        default=config.POSTPROCESS_PROCESSES,
+                        metavar="N",
+                        help="post-processing worker processes (default one per CPU)")
+    parser.add_argument(
+                        "--trace",
+                        nargs="?",
+                        const=config.TRACE_FILE,
+                        metavar="TRACE_FILE",
+                        help=f"time every request and page write, saved as a Chrome trace (default '{config.TRACE_FILE}')")
+    parser.add_argument(
+                        "--metrics-port",
+                        type=int,
+                        default=config.METRICS_PORT,
+                        help="serve live metrics (Prometheus text format) on http://127.0.0.1:PORT/metrics")
+    parser.add_argument(
+                        "--metrics-json",
+                        default=config.METRICS_FILE,
+                        metavar="METRICS_FILE",
+                        help="save the metrics of the run as json")
+    parser.add_argument(
+                        "--no-threaded",
+                        dest="threaded",
+                        action="store_false",
+                        help="disable multithreaded downloads (prompt-free modes only)")
+    parser.add_argument(
+                        "--no-datasaver",
+                        dest="datasaver",
+                        action="store_false",
+                        help="download uncompressed images (prompt-free modes only)")
+    parser.add_argument(
+                        "--language",
+                        default=config.LANGUAGE_LIST[0][1],
+                        choices=[language[1] for language in config.LANGUAGE_LIST],
+                        help="chapter language code (prompt-free modes only)")
+    parser.add_argument(
+                        "--chapters",
+                        metavar="RANGES",
+                        help="only download these chapter numbers, e.g. '1-10,15,20-' (prompt-free modes only)")
+    parser.add_argument(
+                        "--volumes",
+                        metavar="RANGES",
+                        help="only download the chapters of these volumes, e.g. '1-3' (prompt-free modes only)")
+    parser.add_argument(
+                        "--latest",
+                        type=int,
+                        metavar="N",
+                        help="only download the N highest numbered (selected) chapters (prompt-free modes only)")
+    parser.add_argument(
+                        "--exclude-group",
+                        dest="exclude_groups",
+                        action="append",
+                        metavar="GROUP",
+                        help="skip releases of this group (id or name, repeatable), "
+                             "another group's release of the chapter is taken instead")
+    parser.add_argument(
+                        "--api",
+                        choices=config.API_BACKENDS,
+                        default=config.API_BACKEND,
+                        help="MangaDex api to list and resolve chapters with (v2 is retired)")
+    parser.add_argument(
+                        "--api-url",
+                        help="MangaDex api base url (e.g. a local mock server)")
+    parser.add_argument(
+                        "--no-check",
+                        dest="check",
+                        action="store_false",
+                        help="skip the internet connection test")
+    args = parser.parse_args()
+
+    try:
+        args.selection = ChapterSelection(args.chapters, args.volumes, args.latest, args.exclude_groups)
+    except ValueError as error:
+        parser.error(str(error))
+
+    args.postprocess = args.postprocess.split(",") if args.postprocess else config.POSTPROCESS
+    for step in args.postprocess:
+        if step not in postprocess.STEPS:
+            parser.error(f"unknown post-processing step '{step}' (choose from {', '.join(postprocess.STEPS)})")
+
+    return args
+
+
+def command_urls(args : argparse.Namespace) -> list:
+    """Returns the valid urls given on the command line and in the url file"""
+
+    url_list = [url for url in args.urls if check_url.search(url)]
+    for url in set(args.urls) - set(url_list):
+        print(f"INVALID URL: {url}")
+
+    if args.file:
+        url_list += read_urls(args.file)
+
+    return url_list
+
+
+def headless(args : argparse.Namespace) -> NoReturn:
+    """Download the urls given on the command line or in a file without any prompts"""
+
+    url_list = command_urls(args)
+
+    if not url_list:
+        print("No valid urls to download")
+        sys.exit(1)
+
+    language = config.language_by_id(args.language)
+    start(
+          url_list,
+          args.threaded,
+          args.datasaver,
+          language[2],
+          language[1],
+          engine=args.engine,
+          sync=args.sync,
+          output=args.format,
+          selection=args.selection)
+
+
+def verify(args : argparse.Namespace) -> NoReturn:
+    """Verify every page recorded in the download state and download only the damaged ones again
+
+    The manga are downloaded in sync mode, only the chapters with a damaged page are resolved
+    (chapters released since the last run are left for a regular download)
+    """
+    state = DownloadState(config.STATE_FILE)
+    try:
+        chapters = integrity.verify(state)
+    finally:
+        state.close()
+
+    if not chapters:
+        return
+
+    print(f"Downloading the damaged pages of {len(chapters)} manga again")
+
+    language = config.language_by_id(args.language)
+    start(
+          [config.MANGA_URL.format(manga_id) for manga_id in sorted(chapters)],
+          args.threaded,
+          args.datasaver,
+          language[2],
+          language[1],
+          engine=args.engine,
+          sync=True,
+          output=args.format,
+          selection=ChapterSelection(chapter_ids=set().union(*chapters.values())))
+
+
+def main(engine : str = config.ENGINE, sync : bool = False, output : str = config.OUTPUT_FORMAT) -> NoReturn:
     """Main function for the MangaDex Download program"""
     print()               # formatting
     threaded_config = config.multithread_option()
@@ -109,12 +607,72 @@ def main() -> NoReturn:
                   threaded_config,
                   datasaver_config,
                   language_config[2],
-                  language_config[1])
+                  language_config[1],
+                  engine=engine,
+                  sync=sync,
+                  output=output)
             break
 
 
+def configure(args : argparse.Namespace, index : int = None) -> NoReturn:
+    """Apply the command line options to the config (index is set in a ledger worker process)"""
+
+    config.API_BACKEND = args.api
+    config.API_URL = args.api_url or config.API_URLS[args.api]
+    config.USE_PAGE_STORE = config.USE_PAGE_STORE or args.dedup
+    config.POSTPROCESS = args.postprocess
+    config.POSTPROCESS_PROCESSES = args.postprocess_processes
+
+    config.METRICS_PORT = args.metrics_port
+    config.METRICS_FILE = args.metrics_json
+
+    if args.trace:
+        config.TRACE = True
+        config.TRACE_FILE = args.trace
+
+    if index is None:
+        return
+
+    # Workers share the terminal and the output folder, every worker gets its own metrics
+    # port and files. State and cache (SQLite WAL) can't be shared between machines
+    config.PROGRESS = "off"
+
+    # The CPUs are shared by every worker's post-processing
+    if not config.POSTPROCESS_PROCESSES:
+        config.POSTPROCESS_PROCESSES = max(1, (cpu_count() or 1) // max(args.workers, 1))
+    config.STATE_FILE = tagged_file(config.STATE_FILE, gethostname())
+    config.CACHE_FILE = tagged_file(config.CACHE_FILE, gethostname())
+
+    if config.METRICS_PORT:
+        config.METRICS_PORT += index
+    if config.METRICS_FILE:
+        config.METRICS_FILE = tagged_file(config.METRICS_FILE, str(index))
+    if config.TRACE:
+        config.TRACE_FILE = tagged_file(config.TRACE_FILE, str(index))
+
+
 if __name__ == '__main__':
-    config.clear_screen()
+    args = parse_args()
+    configure(args)
+
+    if args.serve:
+        if not args.check or config.check_connection():
+            serve(args.serve, args)
+
+    elif args.verify:
+        if not args.check or config.check_connection():
+            verify(args)
+
+    elif args.ledger:
+        if not args.check or config.check_connection():
+            coordinate(args, command_urls(args))
+
+    elif args.urls or args.file:
+        if not args.check or config.check_connection():
+            headless(args)
+
+    else:
+        config.clear_screen()
 
-    if config.check_connection():
-        main()
+        if config.check_connection():
+            main(engine=args.engine, sync=args.sync, output=args.format)
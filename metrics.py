@@ -0,0 +1,387 @@
+"""Metrics module that contains:
+                                 A registry of run metrics (counters, gauges, latency histograms)
+
+                                 Counters and histograms are updated on the download path, gauges
+                                 (host limits, scheduler queue, image servers) are read when the
+                                 metrics are collected. Served over http in the Prometheus text
+                                 format and optionally saved as json at the end of a run"""
+import json
+import time
+
+from bisect import bisect_left
+from collections import deque
+from http.server import (BaseHTTPRequestHandler, ThreadingHTTPServer)
+from threading import (Lock, Thread)
+from typing import NoReturn
+
+import config
+import dedup
+import hedge
+import scheduler
+
+from progress import PROGRESS
+from throttle import host_stats
+
+
+class Metric():
+    """A named metric with one value per set of label values"""
+
+    kind = "untyped"
+
+    def __init__(self, name : str, description : str, labels : tuple = ()):
+
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values = {} # Label values -> value
+        self.mutex = Lock()
+
+        if not labels: # Reported as 0 until the first update
+            self.values[()] = self.empty()
+
+
+    def empty(self):
+        return 0
+
+
+    def samples(self) -> list:
+        """Returns (name, labels, value) for every label set"""
+
+        with self.mutex:
+            return [(self.name, dict(zip(self.labels, key)), value) for key, value in self.values.items()]
+
+
+class Counter(Metric):
+    """A value that only goes up"""
+
+    kind = "counter"
+
+    def inc(self, labels : tuple = (), amount : float = 1) -> NoReturn:
+        with self.mutex:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that is set to its current reading"""
+
+    kind = "gauge"
+
+    def set(self, value : float, labels : tuple = ()) -> NoReturn:
+        with self.mutex:
+            self.values[labels] = value
+
+
+class Histogram(Metric):
+    """Counts of observed values per bucket (upper bounds), with their sum"""
+
+    kind = "histogram"
+
+    def __init__(self, name : str, description : str, labels : tuple = (), buckets : tuple = config.METRICS_BUCKETS):
+
+        self.buckets = buckets
+        super().__init__(name, description, labels)
+
+
+    def empty(self) -> list:
+        """Returns the counts of a new label set, one per bucket plus +Inf, then the sum"""
+        return [0] * (len(self.buckets) + 1) + [0.0]
+
+
+    def observe(self, value : float, labels : tuple = ()) -> NoReturn:
+
+        index = bisect_left(self.buckets, value) # len(buckets) is the +Inf bucket
+
+        with self.mutex:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = self.values[labels] = self.empty()
+
+            counts[index] += 1
+            counts[-1] += value
+
+
+    def samples(self) -> list:
+        """Returns the cumulative bucket counts, sum and count of every label set"""
+
+        samples = []
+
+        with self.mutex:
+            values = [(dict(zip(self.labels, key)), list(counts)) for key, counts in self.values.items()]
+
+        for labels, counts in values:
+            total = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                total += count
+                samples.append((f"{self.name}_bucket", dict(labels, le=str(bound)), total))
+
+            samples.append((f"{self.name}_sum", labels, counts[-1]))
+            samples.append((f"{self.name}_count", labels, total))
+
+        return samples
+
+
+class Throughput():
+    """Pages and bytes finished per second, over the last few seconds"""
+
+    def __init__(self, window : int):
+
+        self.window = window
+        self.start = time.monotonic()
+        self.seconds = deque() # [second, pages, bytes]
+        self.mutex = Lock()
+
+
+    def add(self, pages : int, size : int) -> NoReturn:
+
+        now = int(time.monotonic())
+
+        with self.mutex:
+            if not self.seconds or self.seconds[-1][0] != now:
+                self.seconds.append([now, 0, 0])
+                while self.seconds[0][0] <= now - self.window:
+                    self.seconds.popleft()
+
+            current = self.seconds[-1]
+            current[1] += pages
+            current[2] += size
+
+
+    def rates(self) -> tuple:
+        """Returns the pages and bytes per second"""
+
+        now = time.monotonic()
+        span = max(min(self.window, now - self.start), 1.0)
+
+        with self.mutex:
+            recent = [second for second in self.seconds if second[0] > int(now) - self.window]
+
+        return sum(second[1] for second in recent) / span, sum(second[2] for second in recent) / span
+
+
+class MetricsRegistry():
+    """Every metric of the run, plus the functions that read the gauges when collected"""
+
+    def __init__(self):
+
+        self.metrics = []
+        self.collectors = []
+
+
+    def add(self, metric : Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+
+    def counter(self, name : str, description : str, labels : tuple = ()) -> Counter:
+        return self.add(Counter(name, description, labels))
+
+
+    def gauge(self, name : str, description : str, labels : tuple = ()) -> Gauge:
+        return self.add(Gauge(name, description, labels))
+
+
+    def histogram(self, name : str, description : str, labels : tuple = ()) -> Histogram:
+        return self.add(Histogram(name, description, labels))
+
+
+    def collector(self, function) -> NoReturn:
+        """Add a function that sets gauges from the current state, called on every collection"""
+        self.collectors.append(function)
+
+
+    def collect(self) -> list:
+        """Returns every metric after reading the gauges"""
+
+        for function in self.collectors:
+            function()
+        return self.metrics
+
+
+    def prometheus(self) -> str:
+        """Returns the metrics in the Prometheus text format"""
+
+        lines = []
+
+        for metric in self.collect():
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+
+            for name, labels, value in metric.samples():
+                if labels:
+                    label_text = ",".join(f'{label}="{escape(str(text))}"' for label, text in labels.items())
+                    lines.append(f"{name}{{{label_text}}} {value}")
+                else:
+                    lines.append(f"{name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+    def snapshot(self) -> dict:
+        """Returns the metrics as a dictionary (name -> list of labels and value)"""
+
+        snapshot = {}
+        for metric in self.collect():
+            for name, labels, value in metric.samples():
+                snapshot.setdefault(name, []).append({"labels":labels, "value":value})
+        return snapshot
+
+
+def escape(text : str) -> str:
+    """Escape a label value for the Prometheus text format"""
+    return text.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+REGISTRY = MetricsRegistry()
+THROUGHPUT = Throughput(config.METRICS_RATE_WINDOW)
+
+CHAPTERS_FOUND    = REGISTRY.counter("mdd_chapters_found_total", "Chapters selected for download")
+CHAPTERS_RESOLVED = REGISTRY.counter("mdd_chapters_resolved_total", "Chapters whose img urls were retrieved (setup stage)")
+PAGES_FOUND       = REGISTRY.counter("mdd_pages_found_total", "Pages of the resolved chapters")
+PAGES_DONE        = REGISTRY.counter("mdd_pages_done_total", "Pages downloaded or already on disk (download stage)")
+BYTES_DONE        = REGISTRY.counter("mdd_bytes_total", "Bytes of downloaded pages")
+PAGE_RETRIES      = REGISTRY.counter("mdd_page_retries_total", "Failed pages deferred for a retry")
+PAGES_FAILED      = REGISTRY.counter("mdd_pages_failed_total", "Pages that failed for good")
+PAGES_DAMAGED     = REGISTRY.counter("mdd_pages_damaged_total", "Page responses cut short or not matching their sha256")
+REQUESTS          = REGISTRY.counter("mdd_requests_total", "Http requests by host and status", ("host", "status"))
+
+REQUEST_SECONDS     = REGISTRY.histogram("mdd_request_seconds", "Http request latency (until the body is read)", ("host",))
+PAGE_SECONDS        = REGISTRY.histogram("mdd_page_seconds", "Latency of the page requests that delivered a page")
+POSTPROCESS_SECONDS = REGISTRY.histogram("mdd_postprocess_seconds", "Post-processing time per page by step", ("step",))
+
+PAGES_PER_SECOND = REGISTRY.gauge("mdd_pages_per_second", "Pages finished per second (recent)")
+BYTES_PER_SECOND = REGISTRY.gauge("mdd_bytes_per_second", "Bytes finished per second (recent)")
+MANGA            = REGISTRY.gauge("mdd_manga", "Manga downloads by state", ("state",))
+HOST_IN_FLIGHT   = REGISTRY.gauge("mdd_host_in_flight", "Requests in flight per host", ("host",))
+HOST_LIMIT       = REGISTRY.gauge("mdd_host_limit", "Adaptive concurrency limit per host", ("host",))
+PAGES_QUEUED     = REGISTRY.gauge("mdd_pages_queued", "Pages waiting for a scheduler worker")
+WORKERS_BUSY     = REGISTRY.gauge("mdd_workers_busy", "Scheduler workers downloading a page")
+JOB_SHARE        = REGISTRY.gauge("mdd_job_share", "Share of the busy scheduler workers per job", ("job",))
+JOB_PAGES        = REGISTRY.gauge("mdd_job_pages", "Pages per scheduler job and state", ("job", "state"))
+SERVER_FAILURES  = REGISTRY.gauge("mdd_server_failures", "Failed page requests per image server", ("server",))
+SERVER_DROPPED   = REGISTRY.gauge("mdd_server_dropped", "Whether an image server was dropped (1) or not (0)", ("server",))
+HEDGES           = REGISTRY.gauge("mdd_hedges", "Page requests that were hedged")
+STORE_REUSED     = REGISTRY.gauge("mdd_store_reused", "Pages filled from the page store instead of downloaded")
+
+
+def request_done(host : str, status, seconds : float) -> NoReturn:
+    """Count an http request and its latency (status is None when there was no response)"""
+
+    REQUESTS.inc((host, str(status) if status else "error"))
+    REQUEST_SECONDS.observe(seconds, (host,))
+
+
+def pages_done(pages : int, size : int) -> NoReturn:
+    """Count finished pages and their bytes"""
+
+    PAGES_DONE.inc(amount=pages)
+    if size:
+        BYTES_DONE.inc(amount=size)
+    THROUGHPUT.add(pages, size)
+
+
+def collect_state() -> NoReturn:
+    """Read the gauges from the state of the run"""
+
+    pages, size = THROUGHPUT.rates()
+    PAGES_PER_SECOND.set(pages)
+    BYTES_PER_SECOND.set(size)
+
+    with PROGRESS.mutex:
+        MANGA.set(PROGRESS.started - PROGRESS.finished, ("running",))
+        MANGA.set(PROGRESS.finished, ("finished",))
+
+    for host, stats in host_stats().items():
+        HOST_IN_FLIGHT.set(stats["in_flight"], (host,))
+        HOST_LIMIT.set(stats["limit"], (host,))
+
+    if scheduler.SCHEDULER:
+        stats = scheduler.SCHEDULER.stats()
+        PAGES_QUEUED.set(stats["queued"])
+        WORKERS_BUSY.set(stats["busy"])
+
+        # Jobs that left the scheduler keep their done count with nothing in flight
+        for _, labels, _ in JOB_SHARE.samples():
+            JOB_SHARE.set(0.0, (labels["job"],))
+            JOB_PAGES.set(0, (labels["job"], "queued"))
+            JOB_PAGES.set(0, (labels["job"], "running"))
+
+        for job in stats["jobs"]:
+            label = str(job["label"])
+            JOB_SHARE.set(job["share"], (label,))
+            for state in ("queued", "running", "done"):
+                JOB_PAGES.set(job[state], (label, state))
+
+    for server, stats in hedge.server_stats().items():
+        SERVER_FAILURES.set(stats["failures"], (server,))
+        SERVER_DROPPED.set(int(stats["dropped"]), (server,))
+
+    HEDGES.set(hedge.TRACKER.hedges)
+
+    if dedup.STORE:
+        STORE_REUSED.set(dedup.STORE.stats()["reused"])
+
+
+REGISTRY.collector(collect_state)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serves /metrics (Prometheus text format) and /metrics.json"""
+
+    def log_message(self, *args) -> NoReturn:
+        pass
+
+
+    def do_GET(self) -> NoReturn:
+
+        if self.path == "/metrics":
+            body = REGISTRY.prometheus().encode()
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        elif self.path == "/metrics.json":
+            body = json.dumps(REGISTRY.snapshot()).encode()
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+SERVER = None
+m_server = Lock()
+
+
+def serve_metrics(port : int) -> ThreadingHTTPServer:
+    """Start the metrics endpoint on a background thread (once, it stays up between runs)"""
+
+    global SERVER
+
+    with m_server:
+        if SERVER is None:
+            SERVER = ThreadingHTTPServer((config.METRICS_HOST, port), MetricsHandler)
+            SERVER.daemon_threads = True
+            Thread(target=SERVER.serve_forever, daemon=True).start()
+
+    return SERVER
+
+
+def save_metrics(metrics_file : str) -> NoReturn:
+    """Save the metrics as json"""
+
+    with open(metrics_file, "w") as output:
+        json.dump(REGISTRY.snapshot(), output, indent=4)
+
+
+def print_metrics_summary() -> NoReturn:
+    """Save the metrics (if a metrics file is set) and display where they can be found"""
+
+    if SERVER:
+        host, port = SERVER.server_address[:2]
+        print(f"Metrics: http://{host}:{port}/metrics")
+
+    if config.METRICS_FILE:
+        save_metrics(config.METRICS_FILE)
+        print(f"Metrics saved to '{config.METRICS_FILE}'")
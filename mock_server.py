@@ -0,0 +1,525 @@
+"""Mock server module that contains:
+                                     A local stand-in for the MangaDex api (v5 and v2) and image servers
+
+                                     Catalog size, latency, bandwidth and error rate are
+                                     configurable so downloads can be benchmarked offline"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import struct
+import time
+import uuid
+import zlib
+
+from http.server import (BaseHTTPRequestHandler, ThreadingHTTPServer)
+from threading import (Lock, Thread)
+from typing import NoReturn
+from urllib.parse import parse_qs
+
+import config
+
+
+manga_path   = re.compile(r"^/api/v2/manga/(\d+)/chapters$")
+chapter_path = re.compile(r"^/api/v2/chapter/(\d+)$")
+image_path   = re.compile(r"^(/fallback)?/(data|data-saver)/([^/]+)/([^/]+)$")
+
+# Api v5 paths (served from the root, like api.mangadex.org)
+manga_v5_path = re.compile(r"^/manga/([0-9a-f-]{36})$")
+feed_path     = re.compile(r"^/manga/([0-9a-f-]{36})/feed$")
+at_home_path  = re.compile(r"^/at-home/server/([0-9a-f-]{36})$")
+
+API_PATHS      = {"v5":"", "v2":"/api/v2"} # Api base urls below the server url
+FEED_MAX_LIMIT = 500
+
+WRITE_CHUNK = 16 * 1024
+
+
+class Catalog():
+    """Deterministic catalog of manga, chapters and page bodies served by the mock server"""
+
+    def __init__(self,
+                 chapters   : int = 10,
+                 pages      : int = 10,
+                 page_bytes : int = 64 * 1024,
+                 groups     : int = 1,
+                 languages  : list = None,
+                 title      : str = "Benchmark Manga",
+                 shared     : int = 0,
+                 png        : bool = False):
+
+        self.chapters   = chapters
+        self.pages      = pages
+        self.page_bytes = page_bytes
+        self.groups     = groups
+        self.languages  = languages or ["gb"]
+        self.title      = title
+        self.shared     = shared # Last pages of each chapter that are the same for every chapter of a group
+        self.png        = png    # Pages are valid PNG images (about page_bytes each) instead of plain bytes
+
+        self.mutex = Lock()
+        self.page_names = {} # chapter hash -> list of page filenames
+        self.bodies = {}     # page filename -> page body
+
+
+    def chapter_id(self, manga_id : int, number : int, group : int, language : int) -> int:
+        """Returns a unique chapter id for a manga, chapter number, group and language"""
+        return ((manga_id * 100000 + number) * 100 + group) * 100 + language
+
+
+    def split_id(self, chapter_id : int) -> tuple:
+        """Returns the manga id, chapter number, group and language of a chapter id"""
+
+        chapter_id, language = divmod(chapter_id, 100)
+        chapter_id, group = divmod(chapter_id, 100)
+        manga_id, number = divmod(chapter_id, 100000)
+        return manga_id, number, group, language
+
+
+    def page_body(self, chapter_hash : str, page : int) -> bytes:
+        """Returns the deterministic body of a page (shared pages are the group's credit pages)"""
+
+        if page >= self.pages - self.shared:
+            _, _, group, _ = self.split_id(int(chapter_hash, 16))
+            seed = hashlib.sha256(f"group {group}/{page}".encode()).digest()
+        else:
+            seed = hashlib.sha256(f"{chapter_hash}/{page}".encode()).digest()
+
+        if self.png:
+            return png_image(seed, self.page_bytes)
+        return (seed * (self.page_bytes // len(seed) + 1))[:self.page_bytes]
+
+
+    def chapter_pages(self, chapter_hash : str) -> list:
+        """Returns a chapter's page filenames (named after the page's sha256 like MangaDex does)"""
+
+        with self.mutex:
+            if chapter_hash in self.page_names:
+                return self.page_names[chapter_hash]
+
+        names = []
+        bodies = {}
+        for page in range(self.pages):
+            body = self.page_body(chapter_hash, page)
+            name = f"x{page+1}-{hashlib.sha256(body).hexdigest()}.png"
+            names.append(name)
+            bodies[name] = body
+
+        with self.mutex:
+            self.page_names[chapter_hash] = names
+            self.bodies.update(bodies)
+
+        return names
+
+
+    def page(self, name : str) -> bytes:
+        """Returns a page body by filename (None if it was never listed)"""
+
+        with self.mutex:
+            return self.bodies.get(name)
+
+
+    def chapter_summary(self, manga_id : int, number : int, group : int, language : int) -> dict:
+        """Returns a chapter in the shape of the api v2 chapter list"""
+
+        chapter_id = self.chapter_id(manga_id, number, group, language)
+        return {
+                "id":chapter_id,
+                "hash":f"{chapter_id:x}",
+                "mangaId":manga_id,
+                "mangaTitle":f"{self.title} {manga_id}",
+                "volume":str(number // 10 + 1),
+                "chapter":str(number),
+                "title":f"Chapter {number}",
+                "language":self.languages[language],
+                "groups":[group + 1],
+                "uploader":1,
+                "timestamp":1600000000 + number * 3600,
+                "comments":0,
+                "views":1000 - group,
+                }
+
+
+    def manga(self, manga_id : int) -> dict:
+        """Returns the api v2 response for a manga's chapter list"""
+
+        chapters = []
+        for number in range(self.chapters, 0, -1):
+            for group in range(self.groups):
+                for language in range(len(self.languages)):
+                    chapters.append(self.chapter_summary(manga_id, number, group, language))
+
+        groups = [{"id":group + 1, "name":f"Group {group + 1}"} for group in range(self.groups)]
+
+        return {"code":200, "status":"OK", "data":{"chapters":chapters, "groups":groups}}
+
+
+    def chapter(self, chapter_id : int, base_url : str, saver : bool) -> dict:
+        """Returns the api v2 response for a chapter's image list"""
+
+        manga_id, number, group, language = self.split_id(chapter_id)
+
+        data = self.chapter_summary(manga_id, number, group, language)
+        data["groups"] = [{"id":group + 1, "name":f"Group {group + 1}"}]
+        data["status"] = "OK"
+        data["pages"] = self.chapter_pages(data["hash"])
+        data["server"] = f"{base_url}/{'data-saver' if saver else 'data'}/"
+        data["serverFallback"] = f"{base_url}/fallback/{'data-saver' if saver else 'data'}/"
+
+        return {"code":200, "status":"OK", "data":data}
+
+
+    def manga_v5(self, manga_id : int) -> dict:
+        """Returns the api v5 response for a manga"""
+
+        return {
+                "result":"ok",
+                "response":"entity",
+                "data":{
+                        "id":to_uuid(manga_id),
+                        "type":"manga",
+                        "attributes":{"title":{"en":f"{self.title} {manga_id}"}},
+                       },
+                }
+
+
+    def feed(self, manga_id : int, languages : list, offset : int, limit : int, excluded : list = ()) -> dict:
+        """Returns a page of the api v5 chapter feed of a manga (ordered by chapter, without excluded groups)"""
+
+        v5_codes = [config.language_by_id(language)[3] for language in self.languages]
+
+        chapters = []
+        for number in range(1, self.chapters + 1):
+            for group in range(self.groups):
+                for language, code in enumerate(v5_codes):
+                    if languages and code not in languages:
+                        continue
+
+                    if to_uuid(group + 1) in excluded:
+                        continue
+
+                    chapter_id = self.chapter_id(manga_id, number, group, language)
+                    chapters.append({
+                                     "id":to_uuid(chapter_id),
+                                     "type":"chapter",
+                                     "attributes":{
+                                                   "volume":str(number // 10 + 1),
+                                                   "chapter":str(number),
+                                                   "title":f"Chapter {number}",
+                                                   "translatedLanguage":code,
+                                                   "externalUrl":None,
+                                                   "pages":self.pages,
+                                                   "publishAt":"2020-09-13T12:26:40+00:00",
+                                                  },
+                                     "relationships":[
+                                                      {
+                                                       "id":to_uuid(group + 1),
+                                                       "type":"scanlation_group",
+                                                       "attributes":{"name":f"Group {group + 1}"},
+                                                      },
+                                                      {"id":to_uuid(manga_id), "type":"manga"},
+                                                     ],
+                                    })
+
+        return {
+                "result":"ok",
+                "response":"collection",
+                "data":chapters[offset:offset + limit],
+                "limit":limit,
+                "offset":offset,
+                "total":len(chapters),
+                }
+
+
+    def at_home(self, chapter_id : int, base_url : str) -> dict:
+        """Returns the api v5 at-home response for a chapter (same hash and pages as api v2)"""
+
+        pages = self.chapter_pages(f"{chapter_id:x}")
+        return {
+                "result":"ok",
+                "baseUrl":base_url,
+                "chapter":{"hash":f"{chapter_id:x}", "data":pages, "dataSaver":pages},
+                }
+
+
+def png_image(seed : bytes, size : int, width : int = 256) -> bytes:
+    """Returns a grayscale PNG of about size bytes (stored, not compressed) filled from the seed"""
+
+    height = max(1, size // (width + 1))
+    pixels = seed * (width // len(seed) + 2)
+    rows = b"".join(b"\x00" + pixels[row % len(seed):][:width] for row in range(height))
+
+    def chunk(kind : bytes, data : bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(rows, 0))
+            + chunk(b"IEND", b""))
+
+
+def to_uuid(number : int) -> str:
+    """Returns the api v5 id (uuid) standing in for a numeric id"""
+    return str(uuid.UUID(int=number))
+
+
+def from_uuid(text : str) -> int:
+    """Returns the numeric id behind an api v5 id"""
+    return uuid.UUID(text).int
+
+
+def title_url(manga_id : int, api : str) -> str:
+    """Returns the url of a catalog manga as a user would give it (uuid for api v5)"""
+    return f"https://mangadex.org/title/{to_uuid(manga_id) if api == 'v5' else manga_id}"
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """Serves the api and image endpoints of a MockServer"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args) -> NoReturn:
+        pass
+
+
+    def do_GET(self) -> NoReturn:
+        server = self.server.mock
+        server.count_request()
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        if server.error_rate and server.random() < server.error_rate:
+            self.send_body(b"", status=server.error_status, headers={"Retry-After":"1"})
+            return
+
+        url, _, query = self.path.partition("?")
+
+        match = manga_path.match(url)
+        if match:
+            self.send_json(server.catalog.manga(int(match[1])))
+            return
+
+        match = chapter_path.match(url)
+        if match:
+            self.send_json(server.catalog.chapter(int(match[1]), server.url, "saver=true" in query))
+            return
+
+        match = manga_v5_path.match(url)
+        if match:
+            self.send_json(server.catalog.manga_v5(from_uuid(match[1])))
+            return
+
+        match = feed_path.match(url)
+        if match:
+            params = parse_qs(query)
+            offset = int(params.get("offset", ["0"])[0])
+            limit = min(int(params.get("limit", ["100"])[0]), FEED_MAX_LIMIT)
+            self.send_json(server.catalog.feed(
+                                               from_uuid(match[1]),
+                                               params.get("translatedLanguage[]", []),
+                                               offset,
+                                               limit,
+                                               params.get("excludedGroups[]", [])))
+            return
+
+        match = at_home_path.match(url)
+        if match:
+            self.send_json(server.catalog.at_home(from_uuid(match[1]), server.url))
+            return
+
+        match = image_path.match(url)
+        if match and server.catalog.page(match[4]) is not None:
+            # A few image responses stall (an overloaded MangaDex@Home node)
+            if server.slow_rate and server.random() < server.slow_rate:
+                time.sleep(server.slow_latency)
+
+            body = server.catalog.page(match[4])
+
+            # A few image responses are damaged (cut short, or with a changed byte)
+            if server.corrupt_rate and server.random() < server.corrupt_rate:
+                if server.random() < 0.5:
+                    self.send_body(body[:len(body) // 2], content_type="image/png", length=len(body))
+                    return
+                body = bytes([body[0] ^ 0xFF]) + body[1:]
+
+            self.send_body(body, content_type="image/png")
+            return
+
+        self.send_body(b"", status=404)
+
+
+    def send_json(self, data : dict) -> NoReturn:
+        self.send_body(json.dumps(data).encode(), content_type="application/json")
+
+
+    def send_body(
+                  self,
+                  body         : bytes,
+                  status       : int = 200,
+                  content_type : str = "application/octet-stream",
+                  headers      : dict = None,
+                  length       : int = None) -> NoReturn:
+        """Send a response, throttled to the server's bandwidth limit
+
+        A length longer than the body announces more than is sent (the connection is closed after the body)
+        """
+        if length is not None and length > len(body):
+            self.close_connection = True
+
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body) if length is None else length))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+
+        bandwidth = self.server.mock.bandwidth
+        for start in range(0, len(body), WRITE_CHUNK):
+            chunk = body[start:start + WRITE_CHUNK]
+            try:
+                self.wfile.write(chunk)
+            except ConnectionError: # The client gave up on the response (e.g. a hedged request lost)
+                self.close_connection = True
+                return
+            if bandwidth:
+                time.sleep(len(chunk) / bandwidth)
+
+
+class MockServer():
+    """Local MangaDex stand-in running on a background thread"""
+
+    def __init__(self,
+                 catalog      : Catalog,
+                 port         : int = 0,
+                 latency      : float = 0.0,
+                 bandwidth    : int = 0,
+                 error_rate   : float = 0.0,
+                 error_status : int = 503,
+                 seed         : int = 0,
+                 slow_rate    : float = 0.0,
+                 slow_latency : float = 1.0,
+                 corrupt_rate : float = 0.0):
+
+        self.catalog      = catalog
+        self.latency      = latency      # Seconds before each response
+        self.bandwidth    = bandwidth    # Bytes per second per response (0 is unlimited)
+        self.error_rate   = error_rate   # Fraction of requests answered with error_status
+        self.error_status = error_status
+        self.slow_rate    = slow_rate    # Fraction of image responses delayed by slow_latency
+        self.slow_latency = slow_latency
+        self.corrupt_rate = corrupt_rate # Fraction of image responses cut short or changed
+
+        self.requests = 0
+        self.mutex = Lock()
+        self.rng = random.Random(seed)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), MockHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.mock = self
+        self.thread = None
+
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+
+    def api_url(self, api : str) -> str:
+        return f"{self.url}{API_PATHS[api]}"
+
+
+    def random(self) -> float:
+        with self.mutex:
+            return self.rng.random()
+
+
+    def count_request(self) -> NoReturn:
+        with self.mutex:
+            self.requests += 1
+
+
+    def start(self) -> "MockServer":
+        """Start serving on a background thread"""
+
+        self.thread = Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+
+    def stop(self) -> NoReturn:
+        """Stop serving and close the socket"""
+
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def add_arguments(parser : argparse.ArgumentParser) -> NoReturn:
+    """Add the catalog and server options to a command line parser"""
+
+    parser.add_argument("--chapters", type=int, default=10, help="chapters per manga")
+    parser.add_argument("--pages", type=int, default=10, help="pages per chapter")
+    parser.add_argument("--page-bytes", type=int, default=64 * 1024, help="size of each page")
+    parser.add_argument("--groups", type=int, default=1, help="groups releasing each chapter")
+    parser.add_argument("--shared-pages", type=int, default=0,
+                        help="pages at the end of every chapter that are identical within a group")
+    parser.add_argument("--languages", default="gb", help="comma separated chapter languages")
+    parser.add_argument("--png", action="store_true", help="serve valid PNG pages (for post-processing)")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before each response")
+    parser.add_argument("--bandwidth", type=int, default=0, help="bytes/s per response (0 is unlimited)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of failed requests")
+    parser.add_argument("--error-status", type=int, default=503, help="status of failed requests")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="fraction of stalled image responses")
+    parser.add_argument("--slow-latency", type=float, default=1.0, help="seconds a stalled image response takes")
+    parser.add_argument("--corrupt-rate", type=float, default=0.0,
+                        help="fraction of image responses cut short or with a changed byte")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the error sequence")
+
+
+def from_arguments(args : argparse.Namespace, port : int = 0) -> MockServer:
+    """Create a mock server from parsed command line options"""
+
+    catalog = Catalog(
+                      chapters=args.chapters,
+                      pages=args.pages,
+                      page_bytes=args.page_bytes,
+                      groups=args.groups,
+                      languages=args.languages.split(","),
+                      shared=args.shared_pages,
+                      png=args.png)
+
+    return MockServer(
+                      catalog,
+                      port=port,
+                      latency=args.latency,
+                      bandwidth=args.bandwidth,
+                      error_rate=args.error_rate,
+                      error_status=args.error_status,
+                      seed=args.seed,
+                      slow_rate=args.slow_rate,
+                      slow_latency=args.slow_latency,
+                      corrupt_rate=args.corrupt_rate)
+
+
+def main() -> NoReturn:
+    """Run the mock server in the foreground"""
+
+    parser = argparse.ArgumentParser(description="Local MangaDex api (v5 and v2) and image server stand-in")
+    parser.add_argument("--port", type=int, default=8080)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    server = from_arguments(args, port=args.port)
+    print(f"Serving {server.url} (api v5 at {server.api_url('v5')}, api v2 at {server.api_url('v2')})", flush=True)
+
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == '__main__':
+    main()
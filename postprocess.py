@@ -0,0 +1,308 @@
+"""Postprocess module that contains:
+                                    CPU work on downloaded pages (decode check, re-encode, thumbnail)
+
+                                    Pages are handed over in memory by the disk writers, so the library
+                                    is never read back, to a pool of worker processes sized to the CPU
+                                    count (the steps run past the GIL). The queue is bounded by bytes,
+                                    a full queue pauses the disk writers and never a connection"""
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from multiprocessing import get_context
+from os import (cpu_count, makedirs, path, replace)
+from threading import (Condition, Lock)
+from typing import NoReturn
+
+try:
+    from PIL import Image
+except ImportError: # Post-processing is optional
+    Image = None
+
+import config
+
+from metrics import POSTPROCESS_SECONDS
+
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# Failed pages listed in the report
+MAX_LISTED_FAILURES = 10
+
+
+def available() -> bool:
+    """Returns whether pages can be post-processed (requires Pillow)"""
+    return Image is not None
+
+
+class PageWork():
+    """A page in a post-processing worker process, decoded at most once for all of its steps"""
+
+    def __init__(self, data : bytes, page_file : str, output_dir : str):
+
+        self.data = data
+        self.page_file = page_file
+        self.output_dir = output_dir
+        self.decoded = None
+
+
+    def image(self) -> "Image.Image":
+        """Returns the decoded page (every pixel is decoded, a damaged page raises)"""
+
+        if self.decoded is None:
+            image = Image.open(BytesIO(self.data))
+            image.load()
+            self.decoded = image
+
+        return self.decoded
+
+
+    def save(self, image : "Image.Image", step : str, extension : str, **options) -> str:
+        """Save an output of a step as <output_dir>/<step>/<page file with the extension>"""
+
+        target = path.join(self.output_dir, step, f"{path.splitext(self.page_file)[0]}.{extension}")
+        makedirs(path.dirname(target), exist_ok=True)
+
+        image.save(f"{target}.part", format=extension.upper().replace("JPG", "JPEG"), **options)
+        replace(f"{target}.part", target)
+        return target
+
+
+def verify_page(page : PageWork) -> NoReturn:
+    """Decode check: raises if the page isn't a complete image"""
+    page.image()
+
+
+def reencode_page(page : PageWork) -> NoReturn:
+    """Re-encode a PNG page as REENCODE_FORMAT (other pages, e.g. datasaver jpegs, are left alone)"""
+
+    if page.data.startswith(PNG_SIGNATURE):
+        page.save(page.image(), "reencode", config.REENCODE_FORMAT, quality=config.REENCODE_QUALITY)
+
+
+def thumbnail_page(page : PageWork) -> NoReturn:
+    """Save a jpeg thumbnail of the page (at most THUMBNAIL_SIZE)"""
+
+    thumbnail = page.image().copy()
+    thumbnail.thumbnail(config.THUMBNAIL_SIZE)
+    if thumbnail.mode not in ("RGB", "L"):
+        thumbnail = thumbnail.convert("RGB")
+
+    page.save(thumbnail, "thumbnail", "jpg", quality=config.REENCODE_QUALITY)
+
+
+# Step name -> function taking a PageWork, run in the worker processes
+STEPS = {
+         "verify":verify_page,
+         "reencode":reencode_page,
+         "thumbnail":thumbnail_page,
+        }
+
+
+def register_step(name : str, function) -> NoReturn:
+    """Add a post-processing step (a module level function taking a PageWork, so it can be sent to a process)"""
+    STEPS[name] = function
+
+
+def run_steps(steps : list, data : bytes, page_file : str, output_dir : str) -> list:
+    """Run the steps on a page in a worker process, returns (step, seconds, error) for every step run
+
+    A failed step skips the rest of the page's steps
+    """
+    page = PageWork(data, page_file, output_dir)
+    timings = []
+
+    for name, function in steps:
+        start = time.perf_counter()
+        try:
+            function(page)
+            error = None
+        except Exception as exc:
+            error = f"{type(exc).__name__}: {exc}"
+
+        timings.append((name, time.perf_counter() - start, error))
+        if error:
+            break
+
+    return timings
+
+
+class PostProcessor():
+    """Runs the post-processing steps of every page on a process pool, holding at most max_bytes of pages"""
+
+    def __init__(self, steps : list, processes : int, max_bytes : int):
+
+        self.steps = [(name, STEPS[name]) for name in steps]
+        self.processes = processes
+        self.max_bytes = max_bytes
+        self.pool = self.start_pool()
+
+        self.queued_bytes = 0
+        self.pending = 0
+        self.condition = Condition(Lock())
+
+        self.timings = {name:[0, 0.0, 0] for name, _ in self.steps} # Step -> [pages, seconds, failures]
+        self.failures = [] # (page file, step, error)
+        self.pages = 0
+        self.stalls = 0 # Pages that waited for room in the queue
+        self.restarts = 0 # Pools replaced after a worker process died
+
+
+    def start_pool(self) -> ProcessPoolExecutor:
+        """Returns a new pool of worker processes"""
+
+        # Spawned (not forked) so no worker inherits the download threads and their locks
+        return ProcessPoolExecutor(max_workers=self.processes, mp_context=get_context("spawn"))
+
+
+    def submit(self, data : bytes, page_file : str) -> NoReturn:
+        """Queue a page for its steps, waits while the queue is full"""
+
+        size = len(data)
+
+        with self.condition:
+            # A page larger than the whole queue still goes in once the queue is empty
+            if self.queued_bytes and self.queued_bytes + size > self.max_bytes:
+                self.stalls += 1
+                while self.queued_bytes and self.queued_bytes + size > self.max_bytes:
+                    self.condition.wait()
+
+            self.queued_bytes += size
+            self.pending += 1
+
+        pool = self.pool
+        try:
+            future = pool.submit(run_steps, self.steps, data, page_file, config.POSTPROCESS_DIR)
+        except BrokenProcessPool as error:
+            # A worker process died (e.g. killed for memory), the page is skipped and the pool replaced
+            with self.condition:
+                step = self.timings[self.steps[0][0]]
+                step[0] += 1
+                step[2] += 1
+                self.failures.append((page_file, self.steps[0][0], f"{type(error).__name__}: {error}"))
+                self.pages += 1
+                self.queued_bytes -= size
+                self.pending -= 1
+                self.condition.notify_all()
+
+                if self.pool is pool:
+                    self.pool = self.start_pool()
+                    self.restarts += 1
+
+            pool.shutdown(wait=False)
+            print(f"Post-processing of '{page_file}' skipped, a worker process died ({error})")
+            return
+
+        future.add_done_callback(lambda future: self.done(future, page_file, size))
+
+
+    def done(self, future, page_file : str, size : int) -> NoReturn:
+        """Record the step timings of a page (called when its worker finished)"""
+
+        try:
+            timings = future.result()
+        except Exception as error: # The worker process died
+            timings = [(self.steps[0][0], 0.0, f"{type(error).__name__}: {error}")]
+
+        with self.condition:
+            for name, seconds, error in timings:
+                step = self.timings[name]
+                step[0] += 1
+                step[1] += seconds
+                if error:
+                    step[2] += 1
+                    self.failures.append((page_file, name, error))
+
+            self.pages += 1
+            self.queued_bytes -= size
+            self.pending -= 1
+            self.condition.notify_all()
+
+        for name, seconds, _ in timings:
+            POSTPROCESS_SECONDS.observe(seconds, (name,))
+
+
+    def wait(self) -> NoReturn:
+        """Wait until every queued page went through its steps"""
+
+        with self.condition:
+            while self.pending:
+                self.condition.wait()
+
+
+    def shutdown(self) -> NoReturn:
+        """Wait for the queued pages and stop the worker processes"""
+
+        self.wait()
+        self.pool.shutdown()
+
+
+    def stats(self) -> dict:
+        """Returns the pages processed, the time spent per step and the failed pages"""
+
+        with self.condition:
+            return {
+                    "pages":self.pages,
+                    "stalls":self.stalls,
+                    "restarts":self.restarts,
+                    "steps":{name:{"pages":pages, "seconds":seconds, "failures":failures}
+                             for name, (pages, seconds, failures) in self.timings.items()},
+                    "failures":list(self.failures),
+                    }
+
+
+PROCESSOR = None
+m_processor = Lock()
+
+
+def post_processor() -> PostProcessor:
+    """Returns the shared post-processor (None unless post-processing steps are configured)"""
+
+    global PROCESSOR
+
+    if PROCESSOR is None and config.POSTPROCESS:
+        with m_processor:
+            if PROCESSOR is None:
+                PROCESSOR = PostProcessor(
+                                          config.POSTPROCESS,
+                                          config.POSTPROCESS_PROCESSES or cpu_count() or 1,
+                                          config.POSTPROCESS_QUEUE_BYTES)
+
+    return PROCESSOR
+
+
+def wait_post_processing() -> NoReturn:
+    """Wait until the queued pages were post-processed (if any were)"""
+
+    if PROCESSOR is not None:
+        PROCESSOR.wait()
+
+
+def stop_post_processing() -> NoReturn:
+    """Stop the post-processing worker processes (a worker process only exits once they did)"""
+
+    if PROCESSOR is not None:
+        PROCESSOR.shutdown()
+
+
+def print_postprocess_stats() -> NoReturn:
+    """Display the time spent in each post-processing step and the pages that failed one"""
+
+    if PROCESSOR is None:
+        return
+
+    stats = PROCESSOR.stats()
+    print(f"Post-processing: {stats['pages']} pages, {stats['stalls']} pages waited for a process, "
+          f"{stats['restarts']} worker pools restarted")
+
+    for name, step in stats["steps"].items():
+        average = step["seconds"] / step["pages"] * 1000 if step["pages"] else 0.0
+        print(f"    {name}: {step['pages']} pages, {average:.1f}ms avg, "
+              f"{step['seconds']:.2f}s total, {step['failures']} failed")
+
+    for page_file, name, error in stats["failures"][:MAX_LISTED_FAILURES]:
+        print(f"    {name} failed: '{page_file}' ({error})")
+
+    if len(stats["failures"]) > MAX_LISTED_FAILURES:
+        print(f"    ... {len(stats['failures']) - MAX_LISTED_FAILURES} more")
@@ -0,0 +1,255 @@
+"""Progress module that contains:
+                                  Per manga progress counters fed by download events
+
+                                  A display that redraws the status lines in place (ANSI cursor
+                                  control) at a capped frame rate, silent when not on a terminal"""
+import sys
+import time
+
+from threading import (Event, Lock, Thread)
+from typing import NoReturn
+
+import config
+import scheduler
+
+
+CLEAR_LINE = "\x1b[2K"
+LINES_UP   = "\x1b[{}F"
+
+
+class MangaProgress():
+    """Progress counters for a single manga (updated from the download threads)"""
+
+    def __init__(self, display : "ProgressDisplay", label : str):
+
+        self.display = display
+        self.name = label
+
+        self.chapters_total = 0
+        self.chapters_resolved = 0
+        self.pages_total = 0
+        self.pages_done = 0
+        self.pages_failed = 0
+        self.bytes_done = 0
+        self.finished = False
+        self.message = None
+
+        self.mutex = Lock()
+
+
+    def chapters_found(self, chapters : int) -> NoReturn:
+        """The manga's chapter list was retrieved"""
+
+        with self.mutex:
+            self.chapters_total = chapters
+        self.display.notify()
+
+
+    def chapter_resolved(self, pages : int) -> NoReturn:
+        """A chapter's img urls were retrieved (setup stage)"""
+
+        with self.mutex:
+            self.chapters_resolved += 1
+            self.pages_total += pages
+        self.display.notify()
+
+
+    def page_done(self, size : int = 0) -> NoReturn:
+        """A page finished downloading (or was already on disk)"""
+
+        with self.mutex:
+            self.pages_done += 1
+            self.bytes_done += size
+        self.display.notify()
+
+
+    def page_failed(self) -> NoReturn:
+        """A page failed for good (its retries ran out)"""
+
+        with self.mutex:
+            self.pages_failed += 1
+        self.display.notify()
+
+
+    def note(self, message : str) -> NoReturn:
+        """Show a message for this manga (printed directly when the display isn't drawn)"""
+
+        with self.mutex:
+            self.message = message
+
+        if self.display.running:
+            self.display.notify()
+        else:
+            print(message)
+
+
+    def finish(self) -> NoReturn:
+        """The manga's download ended"""
+
+        with self.mutex:
+            if self.finished:
+                return
+            self.finished = True
+
+        self.display.manga_finished()
+
+
+    def percent(self) -> int:
+        """Returns the percentage of the manga's known pages that are done"""
+
+        if not self.pages_total:
+            return 0
+        return int(self.pages_done / self.pages_total * 100)
+
+
+    def lines(self, job : dict = None) -> list:
+        """Returns the status lines for this manga (job is its page scheduler stats)"""
+
+        with self.mutex:
+            failed = f", {self.pages_failed} failed" if self.pages_failed else ""
+            share = f", {job['share']:.0%} of workers" if job and job["running"] else ""
+            lines = [f"Downloading {str(self.name)[:15]:<15}: {self.percent()}% "
+                     f"({self.pages_done} of {self.pages_total} pages{failed}, {self.bytes_done / 1048576:.1f} MB{share})"]
+
+            if self.chapters_resolved < self.chapters_total:
+                lines.append(f"    Chapter info downloaded: {self.chapters_resolved} "
+                             f"of {self.chapters_total} (setup stage)")
+
+            if self.message:
+                lines.append(f"    {self.message}")
+
+        return lines
+
+
+class ProgressDisplay():
+    """Renders the progress of every manga whenever a download event arrives"""
+
+    def __init__(self, stream = sys.stdout, fps : float = config.PROGRESS_FPS):
+
+        self.stream = stream
+        self.interval = 1 / fps
+
+        self.manga = []
+        self.started = 0
+        self.finished = 0
+        self.mutex = Lock()
+
+        self.options = None
+        self.drawn = 0 # Number of status lines on screen
+        self.dirty = Event()
+        self.running = False
+        self.thread = None
+
+
+    def enabled(self) -> bool:
+        """Returns whether progress should be drawn (terminal output only)"""
+
+        if config.PROGRESS == "off":
+            return False
+        if config.PROGRESS == "on":
+            return True
+        return hasattr(self.stream, "isatty") and self.stream.isatty()
+
+
+    def add(self, label : str) -> MangaProgress:
+        """Register a manga download and return its counters"""
+
+        progress = MangaProgress(self, label)
+
+        with self.mutex:
+            self.manga.append(progress)
+            self.started += 1
+
+        self.notify()
+        return progress
+
+
+    def manga_finished(self) -> NoReturn:
+        with self.mutex:
+            self.finished += 1
+        self.notify()
+
+
+    def notify(self) -> NoReturn:
+        """Mark the display as out of date (cheap, drawing happens on the display thread)"""
+        self.dirty.set()
+
+
+    def start(self, options : list) -> NoReturn:
+        """Draw the banner and start redrawing the status lines on a background thread"""
+
+        if self.running:
+            return
+
+        self.options = options
+
+        with self.mutex:
+            self.manga = []
+            self.started = 0
+            self.finished = 0
+
+        if not self.enabled():
+            return
+
+        config.clear_screen()
+        config.print_banner(options)
+
+        self.drawn = 0
+        self.running = True
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+
+    def stop(self) -> NoReturn:
+        """Stop the display thread after drawing the final status"""
+
+        if not self.running:
+            return
+
+        self.running = False
+        self.dirty.set()
+        self.thread.join()
+
+
+    def run(self) -> NoReturn:
+        """Redraw after events arrive, at most once per frame interval"""
+
+        while self.running:
+            self.dirty.wait()
+            self.dirty.clear()
+            self.render()
+            time.sleep(self.interval)
+
+        self.render()
+
+
+    def render(self) -> NoReturn:
+        """Redraw the status lines in place"""
+
+        with self.mutex:
+            lines = [f"Started: {self.started} Finished: {self.finished}"]
+            manga = list(self.manga)
+
+        jobs = {}
+        if scheduler.SCHEDULER:
+            stats = scheduler.SCHEDULER.stats()
+            lines[0] += f" Pages queued: {stats['queued']} Workers busy: {stats['busy']} of {stats['workers']}"
+            jobs = {job["label"]:job for job in stats["jobs"]}
+
+        for progress in manga:
+            lines += progress.lines(jobs.get(progress.name))
+
+        output = LINES_UP.format(self.drawn) if self.drawn else ""
+        output += "".join(f"{CLEAR_LINE}{line}\n" for line in lines)
+
+        # Clear lines left over from a longer previous frame
+        extra = self.drawn - len(lines)
+        if extra > 0:
+            output += f"{CLEAR_LINE}\n" * extra + LINES_UP.format(extra)
+
+        self.stream.write(output)
+        self.stream.flush()
+        self.drawn = len(lines)
+
+
+PROGRESS = ProgressDisplay()
@@ -0,0 +1,127 @@
+"""Retry module that contains:
+                               The retry policy for failed requests (jittered exponential backoff)
+
+                               Failed pages are deferred to a per manga retry queue that is worked
+                               after the main pass, so no worker sleeps while holding a slot"""
+import heapq
+import itertools
+import random
+import time
+
+from threading import Lock
+
+import config
+
+
+PERMANENT_STATUS = (400, 401, 403, 404, 410)
+
+
+class PageError(Exception):
+    """A page (or api request) failed, status is None when there was no response
+
+    reason describes a response that arrived but was unusable (e.g. a damaged page)
+    """
+    def __init__(self, status : int = None, wait : float = 0.0, reason : str = None):
+
+        super().__init__(reason or (f"HTTP {status}" if status else "no response"))
+        self.status = status
+        self.wait = wait # Seconds the server asked to wait (Retry-After)
+
+
+    @property
+    def retryable(self) -> bool:
+        return self.status not in PERMANENT_STATUS
+
+
+def backoff(attempt : int, wait : float = 0.0) -> float:
+    """Returns the delay before a retry, doubling per attempt with random jitter
+
+    Half the delay is fixed and half is random (so retries of pages that failed
+    together spread out), and a server's Retry-After is always respected
+    """
+    delay = min(config.RETRY_BASE_DELAY * 2 ** (attempt - 1), config.RETRY_MAX_DELAY)
+    return max(random.uniform(delay / 2, delay), wait)
+
+
+class RetryQueue():
+    """Threadsafe queue of a manga's failed pages, ordered by when each is due for a retry
+
+    A page is a dict with the chapter folder, chapter, image, target file and attempts made
+    """
+
+    def __init__(self):
+
+        self.pages = [] # Heap of (due, sequence, page)
+        self.sequence = itertools.count()
+        self.failed = {} # Chapter -> images that failed permanently
+        self.mutex = Lock()
+
+
+    def defer(self, page : dict, error : PageError) -> bool:
+        """Queue a failed page for a retry, returns False when it failed permanently"""
+
+        page["attempts"] += 1
+
+        with self.mutex:
+            if not error.retryable or page["attempts"] >= config.RETRY_MAX_ATTEMPTS:
+                self.failed.setdefault(page["chapter"]["num"], []).append(page["image"])
+                return False
+
+            due = time.monotonic() + backoff(page["attempts"], error.wait)
+            heapq.heappush(self.pages, (due, next(self.sequence), page))
+            return True
+
+
+    def __len__(self) -> int:
+        with self.mutex:
+            return len(self.pages)
+
+
+    def delay(self) -> float:
+        """Returns the seconds until the next page is due (0 if one is due now)"""
+
+        with self.mutex:
+            if not self.pages:
+                return 0.0
+            return max(self.pages[0][0] - time.monotonic(), 0.0)
+
+
+    def due(self) -> list:
+        """Remove and return every page that is due for a retry"""
+
+        pages = []
+        now = time.monotonic()
+
+        with self.mutex:
+            while self.pages and self.pages[0][0] <= now:
+                pages.append(heapq.heappop(self.pages)[2])
+
+        return pages
+
+
+    def report(self) -> str:
+        """Returns the permanently failed pages per chapter (None if every page arrived)"""
+
+        with self.mutex:
+            if not self.failed:
+                return None
+
+            chapters = ", ".join(f"{chapter} ({len(images)})" for chapter, images in sorted(self.failed.items()))
+            return f"Pages failed              : {chapters}"
+
+
+def retry_call(function, *args) -> object:
+    """Call a request function until it succeeds, sleeping between attempts (api requests)
+
+    The function raises PageError on failure, the last error is raised once the
+    attempts run out (or right away if it can't succeed)
+    """
+    attempt = 0
+    while True:
+        try:
+            return function(*args)
+        except PageError as error:
+            attempt += 1
+            if not error.retryable or attempt >= config.RETRY_MAX_ATTEMPTS:
+                raise
+            time.sleep(backoff(attempt, error.wait))
@@ -0,0 +1,178 @@
+"""Scheduler module that contains:
+                                   A single pool of page download workers shared by every manga
+
+                                   Each manga is a job with its own priority queue of pages, free
+                                   workers take the next page from the job with the smallest share
+                                   of completed work (weighted round robin)"""
+import heapq
+import itertools
+
+from concurrent.futures import Future
+from threading import (Condition, Lock, Thread)
+from typing import NoReturn
+
+import config
+
+
+def chapter_priority(number : str) -> float:
+    """Returns a chapter's priority from its chapter number (lower is downloaded first)"""
+
+    if config.CHAPTER_PRIORITY == "none":
+        return 0.0
+
+    try:
+        order = float(number)
+    except (TypeError, ValueError): # Unnumbered chapters go last
+        return float("inf")
+
+    return -order if config.CHAPTER_PRIORITY == "highest" else order
+
+
+class SchedulerJob():
+    """A manga's pages waiting for a scheduler worker"""
+
+    def __init__(self, scheduler : "PageScheduler", label : str, weight : float):
+
+        self.scheduler = scheduler
+        self.label = label
+        self.weight = weight
+
+        self.pages = []  # Heap of (priority, sequence, future, function, args)
+        self.running = 0
+        self.done = 0
+        self.virtual = 0.0 # Work received, scaled by the job's weight (lowest goes next)
+
+
+    def submit(self, priority : tuple, function, *args) -> Future:
+        """Queue a page download, returns a future for its result"""
+        return self.scheduler.submit(self, priority, function, *args)
+
+
+    def close(self) -> NoReturn:
+        """Remove the job from the scheduler once its downloads are finished"""
+        self.scheduler.remove(self)
+
+
+class PageScheduler():
+    """Runs the page downloads of every job on one fixed size pool of workers"""
+
+    def __init__(self, workers : int):
+
+        self.workers = workers
+        self.jobs = []
+        self.sequence = itertools.count()
+        self.condition = Condition(Lock())
+        self.threads = []
+
+
+    def job(self, label : str, weight : float = 1.0) -> SchedulerJob:
+        """Register a manga with the scheduler"""
+
+        job = SchedulerJob(self, label, weight)
+
+        with self.condition:
+            self.jobs.append(job)
+
+            # Workers are only started when there is work for them
+            while len(self.threads) < self.workers:
+                thread = Thread(target=self.run, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+        return job
+
+
+    def remove(self, job : SchedulerJob) -> NoReturn:
+        with self.condition:
+            if job in self.jobs:
+                self.jobs.remove(job)
+
+
+    def submit(self, job : SchedulerJob, priority : tuple, function, *args) -> Future:
+
+        future = Future()
+
+        with self.condition:
+            # A job that was idle rejoins at the current minimum so it can't claim
+            # the workers until it catches up on the time it spent idle
+            if not job.pages and not job.running:
+                active = [other.virtual for other in self.jobs if other.pages or other.running]
+                if active:
+                    job.virtual = max(job.virtual, min(active))
+
+            heapq.heappush(job.pages, (priority, next(self.sequence), future, function, args))
+            self.condition.notify()
+
+        return future
+
+
+    def next_page(self) -> tuple:
+        """Wait for the next page from the job that is furthest behind its share"""
+
+        with self.condition:
+            while True:
+                waiting = [job for job in self.jobs if job.pages]
+                if waiting:
+                    break
+                self.condition.wait()
+
+            job = min(waiting, key=lambda job: job.virtual)
+            job.virtual += 1 / job.weight
+            job.running += 1
+
+            _, _, future, function, args = heapq.heappop(job.pages)
+            return job, future, function, args
+
+
+    def run(self) -> NoReturn:
+        """Worker loop"""
+
+        while True:
+            job, future, function, args = self.next_page()
+
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(function(*args))
+                except BaseException as error:
+                    future.set_exception(error)
+
+            with self.condition:
+                job.running -= 1
+                job.done += 1
+
+
+    def stats(self) -> dict:
+        """Returns the queue depth and each job's share of the workers"""
+
+        with self.condition:
+            running = sum(job.running for job in self.jobs)
+            return {
+                    "workers":self.workers,
+                    "busy":running,
+                    "queued":sum(len(job.pages) for job in self.jobs),
+                    "jobs":[{
+                             "label":job.label,
+                             "weight":job.weight,
+                             "queued":len(job.pages),
+                             "running":job.running,
+                             "done":job.done,
+                             "share":job.running / running if running else 0.0,
+                            } for job in self.jobs],
+                    }
+
+
+SCHEDULER = None
+m_scheduler = Lock()
+
+
+def page_scheduler() -> PageScheduler:
+    """Returns the shared page scheduler"""
+
+    global SCHEDULER
+
+    if SCHEDULER is None:
+        with m_scheduler:
+            if SCHEDULER is None:
+                SCHEDULER = PageScheduler(config.MAX_PAGE_WORKERS)
+
+    return SCHEDULER
@@ -0,0 +1,134 @@
+"""Selection module that contains:
+                                  Which chapters of a manga to download
+
+                                  Chapter and volume ranges, the latest chapters and excluded
+                                  groups are applied to the chapter list, before any chapter's
+                                  img urls are requested"""
+import re
+
+
+check_range = re.compile(r"^\s*([0-9.]*)\s*(-?)\s*([0-9.]*)\s*$")
+
+
+def parse_ranges(spec : str) -> list:
+    """Parse a range list like '1-10,15,20-' into inclusive (low, high) ranges (None is open)"""
+
+    ranges = []
+
+    for part in spec.split(","):
+        match = check_range.match(part)
+        if not match or not (match[1] or match[3]):
+            raise ValueError(f"Invalid range '{part.strip()}' in '{spec}'")
+
+        try:
+            low = float(match[1]) if match[1] else None
+            high = float(match[3]) if match[3] else None
+        except ValueError:
+            raise ValueError(f"Invalid range '{part.strip()}' in '{spec}'") from None
+
+        # A single number is a range of its own
+        if not match[2]:
+            high = low
+
+        ranges.append((low, high))
+
+    return ranges
+
+
+def number(text : str) -> float:
+    """Returns a chapter or volume number (None if it has none, e.g. an unnumbered extra)"""
+
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return None
+
+
+def in_ranges(value : float, ranges : list) -> bool:
+    """Returns whether a number is in any of the ranges"""
+
+    if value is None:
+        return False
+
+    return any((low is None or low <= value) and (high is None or value <= high) for low, high in ranges)
+
+
+class ChapterSelection():
+    """The chapters of a manga to download (everything by default)
+
+    Chapter and volume ranges keep the chapters in any of their ranges, latest keeps the
+    highest numbered chapters of those. Releases of excluded groups (ids, or names where
+    the api lists them) are skipped, another group's release of the chapter is taken instead.
+    Chapter ids keep only those releases (used to repair chapters without fetching new ones)
+    """
+
+    def __init__(self,
+                 chapters       : str = None,
+                 volumes        : str = None,
+                 latest         : int = None,
+                 exclude_groups : list = None,
+                 chapter_ids    : list = None):
+
+        self.chapters = parse_ranges(chapters) if chapters else None
+        self.volumes  = parse_ranges(volumes) if volumes else None
+        self.latest   = latest
+        self.exclude_groups = {str(group).lower() for group in exclude_groups or ()}
+        self.chapter_ids = {str(chapter_id) for chapter_id in chapter_ids} if chapter_ids is not None else None
+
+
+    def excluded(self, groups : list, chapter_id = None) -> bool:
+        """Returns whether a release is by an excluded group (groups are ids or names) or not a kept chapter id"""
+
+        if self.chapter_ids is not None and str(chapter_id) not in self.chapter_ids:
+            return True
+
+        return any(str(group).lower() in self.exclude_groups for group in groups)
+
+
+    def select(self, records : list) -> list:
+        """Returns the selected chapter records, in the order they were given"""
+
+        selected = records
+
+        if self.chapters is not None:
+            selected = [record for record in selected if in_ranges(number(record.chapter), self.chapters)]
+
+        if self.volumes is not None:
+            selected = [record for record in selected if in_ranges(number(record.volume), self.volumes)]
+
+        if self.latest is not None:
+            numbered = sorted(
+                              (record for record in selected if number(record.chapter) is not None),
+                              key=lambda record: number(record.chapter))
+            latest = {id(record) for record in numbered[-self.latest:]} if self.latest > 0 else set()
+            selected = [record for record in selected if id(record) in latest]
+
+        return selected
+
+
+    def describe(self) -> str:
+        """Returns the selection as text (None if every chapter is selected)"""
+
+        parts = []
+        if self.chapters is not None:
+            parts.append(f"chapters {format_ranges(self.chapters)}")
+        if self.volumes is not None:
+            parts.append(f"volumes {format_ranges(self.volumes)}")
+        if self.latest is not None:
+            parts.append(f"latest {self.latest}")
+        if self.exclude_groups:
+            parts.append(f"without {', '.join(sorted(self.exclude_groups))}")
+        if self.chapter_ids is not None:
+            parts.append(f"{len(self.chapter_ids)} chapter ids")
+
+        return ", ".join(parts) or None
+
+
+def format_ranges(ranges : list) -> str:
+    """Returns ranges as a range list like '1-10,15,20-'"""
+
+    def text(value : float) -> str:
+        return "" if value is None else f"{value:g}"
+
+    return ",".join(text(low) if low == high else f"{text(low)}-{text(high)}" for low, high in ranges)
+
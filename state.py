@@ -0,0 +1,146 @@
+"""State module that contains:
+                                The persistent download state store (SQLite)
+
+                                Records which pages and chapters finished so an
+                                interrupted run can resume and a re-run can sync"""
+import sqlite3
+
+from os import path
+from threading import Lock
+from typing import NoReturn
+
+import config
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pages (
+    manga_id   TEXT NOT NULL,
+    chapter_id TEXT NOT NULL,
+    page       TEXT NOT NULL,
+    file       TEXT NOT NULL,
+    size       INTEGER NOT NULL,
+    hash       TEXT NOT NULL,
+    done       INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (manga_id, chapter_id, page)
+);
+
+CREATE TABLE IF NOT EXISTS chapters (
+    manga_id    TEXT NOT NULL,
+    chapter_id  TEXT NOT NULL,
+    chapter_num TEXT NOT NULL,
+    pages       INTEGER NOT NULL,
+    done        INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (manga_id, chapter_id)
+);
+"""
+
+
+class DownloadState():
+    """Threadsafe record of finished pages and chapters, keyed by manga id, chapter id and page"""
+
+    def __init__(self, state_file : str):
+
+        self.state_file = state_file
+        self.mutex = Lock()
+
+        self.connection = sqlite3.connect(state_file, timeout=config.SQLITE_TIMEOUT, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.connection.commit()
+
+
+    def page_done(self, manga_id : str, chapter_id : str, page : str) -> bool:
+        """Returns whether a page finished in an earlier run and its file is still intact"""
+
+        with self.mutex:
+            row = self.connection.execute(
+                                          "SELECT file, size FROM pages WHERE done = 1 "
+                                          "AND manga_id = ? AND chapter_id = ? AND page = ?",
+                                          (str(manga_id), str(chapter_id), page)).fetchone()
+
+        if not row:
+            return False
+
+        image_file, size = row
+        return path.isfile(image_file) and path.getsize(image_file) == size
+
+
+    def mark_page(
+                  self,
+                  manga_id   : str,
+                  chapter_id : str,
+                  page       : str,
+                  image_file : str,
+                  size       : int,
+                  digest     : str) -> NoReturn:
+        """Record a page as completely downloaded"""
+
+        with self.mutex:
+            self.connection.execute(
+                                    "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, 1)",
+                                    (str(manga_id), str(chapter_id), page, image_file, size, digest))
+            self.connection.commit()
+
+
+    def mark_chapter(
+                     self,
+                     manga_id    : str,
+                     chapter_id  : str,
+                     chapter_num : str,
+                     pages       : int) -> bool:
+        """Record a chapter as finished if every one of its pages is done, returns whether it was"""
+
+        with self.mutex:
+            (done,) = self.connection.execute(
+                                              "SELECT COUNT(*) FROM pages WHERE done = 1 "
+                                              "AND manga_id = ? AND chapter_id = ?",
+                                              (str(manga_id), str(chapter_id))).fetchone()
+
+            finished = done >= pages
+            self.connection.execute(
+                                    "INSERT OR REPLACE INTO chapters VALUES (?, ?, ?, ?, ?)",
+                                    (str(manga_id), str(chapter_id), chapter_num, pages, int(finished)))
+            self.connection.commit()
+
+        return finished
+
+
+    def recorded_pages(self) -> list:
+        """Returns (manga id, chapter id, page, file, size, sha256) for every finished page"""
+
+        with self.mutex:
+            return self.connection.execute(
+                                           "SELECT manga_id, chapter_id, page, file, size, hash "
+                                           "FROM pages WHERE done = 1").fetchall()
+
+
+    def requeue_pages(self, pages : list) -> NoReturn:
+        """Mark pages (manga id, chapter id, page) and their chapters as not finished, so they are downloaded again"""
+
+        with self.mutex:
+            self.connection.executemany(
+                                        "UPDATE pages SET done = 0 WHERE manga_id = ? AND chapter_id = ? AND page = ?",
+                                        [(str(manga_id), str(chapter_id), page) for manga_id, chapter_id, page in pages])
+            self.connection.executemany(
+                                        "UPDATE chapters SET done = 0 WHERE manga_id = ? AND chapter_id = ?",
+                                        {(str(manga_id), str(chapter_id)) for manga_id, chapter_id, _ in pages})
+            self.connection.commit()
+
+
+    def finished_chapters(self, manga_id : str) -> set:
+        """Returns the ids of every chapter of a manga that finished in an earlier run"""
+
+        with self.mutex:
+            rows = self.connection.execute(
+                                           "SELECT chapter_id FROM chapters WHERE done = 1 AND manga_id = ?",
+                                           (str(manga_id),)).fetchall()
+
+        return {row[0] for row in rows}
+
+
+    def close(self) -> NoReturn:
+        """Close the state database"""
+
+        with self.mutex:
+            self.connection.close()
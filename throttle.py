@@ -0,0 +1,199 @@
+"""Throttle module that contains:
+                                  Adaptive (AIMD) concurrency limits, one per host
+
+                                  Parallelism grows while a host stays fast and healthy
+                                  and is cut multiplicatively on 429s, 5xx and errors"""
+import time
+
+from email.utils import parsedate_to_datetime
+from threading import (Condition, Lock)
+from typing import NoReturn
+from urllib.parse import urlparse
+
+import config
+
+
+THROTTLE_STATUS = (429, 503)
+
+
+def retry_after(value : str) -> float:
+    """Returns the number of seconds a Retry-After header asks to wait (0 if missing or invalid)"""
+
+    if not value:
+        return 0.0
+
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class AdaptiveLimit():
+    """Concurrency limit for a single host using additive increase, multiplicative decrease"""
+
+    def __init__(self, host : str, start : int, cap : int):
+
+        self.host = host
+        self.cap = cap
+        self.limit = float(min(start, cap))
+
+        self.in_flight = 0
+        self.blocked_until = 0.0
+
+        self.latency = None  # Moving average of request latency
+        self.baseline = None # Lowest moving average seen (the host's healthy latency)
+        self.last_decrease = 0.0
+
+        self.requests = 0
+        self.throttled = 0
+        self.errors = 0
+
+        self.condition = Condition(Lock())
+
+
+    def acquire(self) -> NoReturn:
+        """Wait for a free slot on the host (and for any Retry-After to pass)"""
+
+        with self.condition:
+            while True:
+                wait = self.blocked_until - time.monotonic()
+                if wait <= 0 and self.in_flight < int(self.limit):
+                    break
+                self.condition.wait(timeout=wait if wait > 0 else None)
+
+            self.in_flight += 1
+
+
+    def try_acquire(self) -> float:
+        """Take a free slot without waiting (async engine), returns 0 if it did
+
+        Otherwise returns how long until a Retry-After passes, or None to wait for a free slot
+        """
+        with self.condition:
+            wait = self.blocked_until - time.monotonic()
+            if wait > 0:
+                return wait
+            if self.in_flight >= int(self.limit):
+                return None
+
+            self.in_flight += 1
+            return 0.0
+
+
+    def cancel(self) -> NoReturn:
+        """Free the slot of a request that was given up on (its outcome says nothing about the host)"""
+
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+
+    def release(self, status : int, latency : float, wait : float = 0.0) -> NoReturn:
+        """Free a slot and adjust the limit from the request's outcome
+
+        status is None when the request failed without a response
+        """
+        with self.condition:
+            self.in_flight -= 1
+            self.requests += 1
+            now = time.monotonic()
+
+            if status in THROTTLE_STATUS or status is None or status >= 500:
+                if status in THROTTLE_STATUS:
+                    self.throttled += 1
+                else:
+                    self.errors += 1
+
+                if wait:
+                    self.blocked_until = max(self.blocked_until, now + wait)
+
+                self.decrease(now)
+
+            else:
+                self.record_latency(latency)
+
+                # Roughly +1 slot after a full limit's worth of healthy requests
+                # (the limit holds while latency is above the host's healthy range)
+                healthy = self.baseline * config.AIMD_LATENCY_TOLERANCE + config.AIMD_LATENCY_SLACK
+                if self.latency <= healthy:
+                    self.limit = min(self.limit + 1 / self.limit, float(self.cap))
+
+            self.condition.notify_all()
+
+
+    def record_latency(self, latency : float) -> NoReturn:
+        """Update the moving average and healthy baseline latency"""
+
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += config.AIMD_LATENCY_WEIGHT * (latency - self.latency)
+
+        if self.baseline is None or self.latency < self.baseline:
+            self.baseline = self.latency
+
+
+    def decrease(self, now : float) -> NoReturn:
+        """Cut the limit, at most once per latency window so one burst only counts once"""
+
+        window = self.latency if self.latency else config.AIMD_MIN_WINDOW
+        if now - self.last_decrease < max(window, config.AIMD_MIN_WINDOW):
+            return
+
+        self.limit = max(self.limit * config.AIMD_DECREASE, 1.0)
+        self.last_decrease = now
+
+
+    def stats(self) -> dict:
+        """Returns the host's current limit and request outcomes"""
+
+        with self.condition:
+            return {
+                    "limit":int(self.limit),
+                    "in_flight":self.in_flight,
+                    "requests":self.requests,
+                    "throttled":self.throttled,
+                    "errors":self.errors,
+                    "latency":self.latency or 0.0,
+                    }
+
+
+HOST_LIMITS = {}
+m_hosts = Lock()
+
+
+def host_limit(url : str) -> AdaptiveLimit:
+    """Returns the adaptive limit for a url's host (api and each image server are separate)"""
+
+    host = urlparse(url).netloc
+
+    with m_hosts:
+        if host not in HOST_LIMITS:
+            HOST_LIMITS[host] = AdaptiveLimit(
+                                              host,
+                                              config.HOST_START_CONCURRENCY,
+                                              config.HOST_MAX_CONCURRENCY)
+        return HOST_LIMITS[host]
+
+
+def host_stats() -> dict:
+    """Returns the limit and request outcomes of every host"""
+
+    with m_hosts:
+        limits = list(HOST_LIMITS.values())
+
+    return {limit.host:limit.stats() for limit in limits}
+
+
+def print_host_stats() -> NoReturn:
+    """Display each host's final concurrency limit and how often it pushed back"""
+
+    for host, stats in host_stats().items():
+        print(f"{host}: limit {stats['limit']}, {stats['requests']} requests, "
+              f"{stats['throttled']} throttled, {stats['errors']} errors, "
+              f"{stats['latency']*1000:.0f}ms avg latency")
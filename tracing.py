@@ -0,0 +1,274 @@
+"""Tracing module that contains:
+                                 Opt-in timing of every http request and page write
+
+                                 Requests are split into phases (waiting for a slot, time to first
+                                 byte with any new connection inside it, transfer) and exported with
+                                 the page writes as a Chrome trace (ui.perfetto.dev, chrome://tracing),
+                                 summed per host and chapter for a report of the slowest ones"""
+import json
+import time
+
+from threading import (local, Lock)
+from typing import NoReturn
+from urllib.parse import urlparse
+
+import config
+
+
+PHASES = ("queue", "ttfb", "transfer")
+
+CONNECTING = local() # New connection made by this thread's current request (thread engine)
+
+
+class RequestTrace():
+    """The phases of a single request, each phase ends where the next one starts"""
+
+    __slots__ = ("tracer", "url", "chapter", "last", "phases", "spans")
+
+    def __init__(self, tracer : "Tracer", url : str, chapter : str):
+
+        self.tracer = tracer
+        self.url = url
+        self.chapter = chapter
+        self.last = time.perf_counter()
+        self.phases = [] # (phase, start, end)
+        self.spans = []  # (name, start, end) inside a phase, new connections and dns lookups
+
+        CONNECTING.span = None
+
+
+    def phase(self, name : str) -> NoReturn:
+        """End the current phase"""
+
+        now = time.perf_counter()
+        self.phases.append((name, self.last, now))
+        self.last = now
+
+
+    def span(self, name : str, start : float, end : float) -> NoReturn:
+        self.spans.append((name, start, end))
+
+
+    def connected(self) -> NoReturn:
+        """Take the connection this thread opened for the request (if it needed one)"""
+
+        span = CONNECTING.span
+        if span:
+            self.spans.append(("connect", *span))
+            CONNECTING.span = None
+
+
+    def done(self, status : int, size : int) -> NoReturn:
+        """The request finished (or failed), ends the phase it was in"""
+
+        if len(self.phases) < len(PHASES):
+            self.phase(PHASES[len(self.phases)])
+        self.tracer.finish(self, status, size)
+
+
+class Tracer():
+    """Threadsafe collection of trace events with per host and per chapter totals"""
+
+    def __init__(self):
+
+        self.origin = time.perf_counter()
+        self.events = [] # (name, category, lane, start, end, args)
+        self.lanes = []  # End of the last event on each lane (a lane's events never overlap)
+
+        self.hosts = {}    # Host -> totals of its requests
+        self.chapters = {} # Chapter -> totals of its requests and page writes
+        self.mutex = Lock()
+
+
+    def request(self, url : str, chapter : str = None) -> RequestTrace:
+        return RequestTrace(self, url, chapter)
+
+
+    def lane(self, start : float, end : float) -> int:
+        """Returns a lane that is free from start on (called with the mutex held)"""
+
+        for lane, free in enumerate(self.lanes):
+            if free <= start:
+                self.lanes[lane] = end
+                return lane
+
+        self.lanes.append(end)
+        return len(self.lanes) - 1
+
+
+    def finish(self, trace : RequestTrace, status : int, size : int) -> NoReturn:
+
+        start = trace.phases[0][1]
+        end = trace.phases[-1][2]
+        host = urlparse(trace.url).netloc
+        times = {name:phase_end - phase_start for name, phase_start, phase_end in trace.phases}
+        connect = sum(span_end - span_start for name, span_start, span_end in trace.spans if name == "connect")
+
+        with self.mutex:
+            lane = self.lane(start, end)
+
+            args = {"url":trace.url, "chapter":trace.chapter, "status":status, "bytes":size}
+            self.events.append((f"GET {host}", "request", lane, start, end, args))
+            for name, phase_start, phase_end in trace.phases:
+                self.events.append((name, "phase", lane, phase_start, phase_end, None))
+            for name, span_start, span_end in trace.spans:
+                self.events.append((name, "connection", lane, span_start, span_end, None))
+
+            totals = self.hosts.setdefault(host, {
+                                                  "requests":0, "failures":0, "bytes":0, "seconds":0.0,
+                                                  "slowest":0.0, "connect":0.0, **{name:0.0 for name in PHASES}})
+            totals["requests"] += 1
+            totals["failures"] += status != 200
+            totals["bytes"] += size
+            totals["seconds"] += end - start
+            totals["slowest"] = max(totals["slowest"], end - start)
+            totals["connect"] += connect
+            for name, seconds in times.items():
+                totals[name] += seconds
+
+            if trace.chapter:
+                totals = self.chapter_totals(trace.chapter)
+                totals["requests"] += 1
+                totals["bytes"] += size
+                totals["seconds"] += end - start
+
+
+    def write(self, chapter : str, start : float, image_file : str) -> NoReturn:
+        """A page was moved into its file or archive entry (started at start)"""
+
+        end = time.perf_counter()
+
+        with self.mutex:
+            self.events.append(("write", "disk", self.lane(start, end), start, end, {"chapter":chapter, "file":image_file}))
+
+            totals = self.chapter_totals(chapter)
+            totals["writes"] += 1
+            totals["write"] += end - start
+
+
+    def chapter_totals(self, chapter : str) -> dict:
+        """Returns a chapter's totals (called with the mutex held)"""
+
+        if chapter not in self.chapters:
+            self.chapters[chapter] = {"requests":0, "bytes":0, "seconds":0.0, "writes":0, "write":0.0}
+        return self.chapters[chapter]
+
+
+    def export(self, trace_file : str) -> int:
+        """Write the events as a Chrome trace (json), returns the number of events"""
+
+        with self.mutex:
+            events = list(self.events)
+            lanes = len(self.lanes)
+
+        trace_events = [{"name":"thread_name", "ph":"M", "pid":1, "tid":lane, "args":{"name":f"lane {lane}"}}
+                        for lane in range(lanes)]
+
+        for name, category, lane, start, end, args in events:
+            event = {
+                     "name":name,
+                     "cat":category,
+                     "ph":"X",
+                     "pid":1,
+                     "tid":lane,
+                     "ts":(start - self.origin) * 1e6, # Microseconds
+                     "dur":(end - start) * 1e6,
+                    }
+            if args:
+                event["args"] = args
+            trace_events.append(event)
+
+        with open(trace_file, "w") as output:
+            json.dump({"traceEvents":trace_events, "displayTimeUnit":"ms"}, output)
+
+        return len(events)
+
+
+    def summary(self, top : int) -> dict:
+        """Returns the hosts and chapters that took the most time (top of each)"""
+
+        with self.mutex:
+            hosts = sorted(self.hosts.items(), key=lambda item: item[1]["seconds"], reverse=True)
+            chapters = sorted(self.chapters.items(), key=lambda item: item[1]["seconds"] + item[1]["write"], reverse=True)
+
+            return {
+                    "hosts":[dict(totals, host=host) for host, totals in hosts[:top]],
+                    "chapters":[dict(totals, chapter=chapter) for chapter, totals in chapters[:top]],
+                    }
+
+
+TRACER = None
+m_tracer = Lock()
+
+
+def tracer() -> Tracer:
+    """Returns the shared tracer (None if tracing is disabled)"""
+
+    global TRACER
+
+    if config.TRACE and TRACER is None:
+        with m_tracer:
+            if TRACER is None:
+                TRACER = Tracer()
+
+    return TRACER
+
+
+def request_trace(url : str, chapter : str = None) -> RequestTrace:
+    """Start tracing a request (None if tracing is disabled)"""
+
+    current = tracer()
+    return current.request(url, chapter) if current else None
+
+
+def traced_pool(pool_class : type) -> type:
+    """Returns a urllib3 connection pool class whose new connections are timed
+
+    urllib3 resolves and connects in a single call, so the dns lookup is part of the
+    connect span in the thread engine (the async engine records it separately)
+    """
+    class TracedConnection(pool_class.ConnectionCls):
+
+        def connect(self) -> NoReturn:
+            start = time.perf_counter()
+            try:
+                super().connect()
+            finally:
+                if TRACER is not None:
+                    CONNECTING.span = (start, time.perf_counter())
+
+    return type(pool_class.__name__, (pool_class,), {"ConnectionCls":TracedConnection})
+
+
+def instrument(adapter) -> NoReturn:
+    """Time the new connections of a requests HTTPAdapter (only recorded while tracing)"""
+
+    manager = adapter.poolmanager
+    manager.pool_classes_by_scheme = {scheme:traced_pool(pool_class)
+                                      for scheme, pool_class in manager.pool_classes_by_scheme.items()}
+
+
+def print_trace_summary() -> NoReturn:
+    """Export the trace and display the slowest hosts and chapters"""
+
+    if TRACER is None:
+        return
+
+    events = TRACER.export(config.TRACE_FILE)
+    summary = TRACER.summary(config.TRACE_TOP)
+    print(f"Trace: {events} events saved to '{config.TRACE_FILE}' (open in ui.perfetto.dev or chrome://tracing)")
+
+    print(f"{'Slowest hosts':<30}{'requests':>9}{'failed':>8}{'queue':>9}{'connect':>9}"
+          f"{'ttfb':>9}{'transfer':>10}{'slowest':>9}{'MB':>8}")
+    for host in summary["hosts"]:
+        average = lambda name: f"{host[name] / host['requests'] * 1000:.1f}"
+        print(f"{host['host']:<30}{host['requests']:>9}{host['failures']:>8}{average('queue'):>9}"
+              f"{average('connect'):>9}{average('ttfb'):>9}{average('transfer'):>10}"
+              f"{host['slowest'] * 1000:>9.0f}{host['bytes'] / 1024 / 1024:>8.1f}")
+
+    print(f"{'Slowest chapters':<30}{'requests':>9}{'seconds':>9}{'writes':>8}{'write s':>9}{'MB':>8}")
+    for chapter in summary["chapters"]:
+        print(f"{chapter['chapter'][:29]:<30}{chapter['requests']:>9}{chapter['seconds']:>9.2f}"
+              f"{chapter['writes']:>8}{chapter['write']:>9.2f}{chapter['bytes'] / 1024 / 1024:>8.1f}")
+
+    print("(host times are ms per request, ttfb includes connect, chapter seconds are summed over requests)")
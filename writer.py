@@ -0,0 +1,184 @@
+"""Writer module that contains:
+                                 A write-behind stage between the network workers and the disk
+
+                                 Finished pages are handed to a few writer threads through a queue
+                                 bounded by bytes (downloads pause while it is full), so a slow disk
+                                 never holds a connection or host slot. Folders are created once."""
+from collections import deque
+from os import makedirs
+from threading import (Condition, Lock, Thread)
+from typing import NoReturn
+
+import config
+
+from archive import BUFFER_MEMORY
+
+
+class WriteGroup():
+    """Writes of a chapter that are queued or running, waited for before the chapter is finished"""
+
+    def __init__(self):
+
+        self.pending = 0
+        self.errors = [] # Exceptions raised by the writes that failed
+        self.condition = Condition(Lock())
+
+
+    def add(self) -> NoReturn:
+        with self.condition:
+            self.pending += 1
+
+
+    def done(self, error : Exception = None) -> NoReturn:
+        with self.condition:
+            if error is not None:
+                self.errors.append(error)
+            self.pending -= 1
+            if not self.pending:
+                self.condition.notify_all()
+
+
+    def wait(self) -> list:
+        """Wait until every write of the group finished, returns the exceptions of the writes that failed"""
+
+        with self.condition:
+            while self.pending:
+                self.condition.wait()
+            return list(self.errors)
+
+
+class DiskWriter():
+    """Writer threads fed by a queue that holds at most max_bytes of pages"""
+
+    def __init__(self, threads : int, max_bytes : int):
+
+        self.threads = threads
+        self.max_bytes = max_bytes
+
+        self.writes = deque() # (group, size, function, args)
+        self.queued_bytes = 0
+        self.condition = Condition(Lock())
+        self.workers = []
+
+        self.folders = set() # Folders already created
+        self.m_folders = Lock()
+
+        self.written = 0
+        self.bytes_written = 0
+        self.peak_bytes = 0
+        self.stalls = 0 # Pages that waited for room in the queue
+        self.errors = 0
+
+
+    def submit(self, group : WriteGroup, size : int, function, *args, block : bool = True) -> bool:
+        """Queue a write of size bytes, waits while the queue is full
+
+        Returns False instead of waiting if block is False (the write isn't queued)
+        """
+        with self.condition:
+            # A page larger than the whole queue still goes in once the queue is empty
+            if self.queued_bytes and self.queued_bytes + size > self.max_bytes:
+                if not block:
+                    return False
+
+                self.stalls += 1
+                while self.queued_bytes and self.queued_bytes + size > self.max_bytes:
+                    self.condition.wait()
+
+            self.writes.append((group, size, function, args))
+            self.queued_bytes += size
+            self.peak_bytes = max(self.peak_bytes, self.queued_bytes)
+            group.add()
+
+            # Writers are only started when there is work for them
+            if len(self.workers) < self.threads:
+                worker = Thread(target=self.run, daemon=True)
+                worker.start()
+                self.workers.append(worker)
+
+            self.condition.notify_all()
+
+        return True
+
+
+    def run(self) -> NoReturn:
+        """Writer loop"""
+
+        while True:
+            with self.condition:
+                while not self.writes:
+                    self.condition.wait()
+                group, size, function, args = self.writes.popleft()
+
+            try:
+                function(*args)
+                error = None
+            except Exception as exc: # Recorded on the group, the writer keeps going
+                error = exc
+
+            with self.condition:
+                self.queued_bytes -= size
+                if error is not None:
+                    self.errors += 1
+                else:
+                    self.written += 1
+                    self.bytes_written += size
+                self.condition.notify_all()
+            group.done(error)
+
+
+    def make_folder(self, folder : str) -> NoReturn:
+        """Create a folder (and its parents) unless this run already did"""
+
+        with self.m_folders:
+            if folder in self.folders:
+                return
+
+        makedirs(folder, exist_ok=True)
+
+        with self.m_folders:
+            self.folders.add(folder)
+
+
+    def stats(self) -> dict:
+        """Returns the pages written and how full the queue got"""
+
+        with self.condition:
+            return {
+                    "written":self.written,
+                    "bytes_written":self.bytes_written,
+                    "queued_bytes":self.queued_bytes,
+                    "peak_bytes":self.peak_bytes,
+                    "stalls":self.stalls,
+                    "errors":self.errors,
+                    }
+
+
+WRITER = None
+m_writer = Lock()
+
+
+def disk_writer() -> DiskWriter:
+    """Returns the shared disk writer"""
+
+    global WRITER
+
+    if WRITER is None:
+        with m_writer:
+            if WRITER is None:
+                WRITER = DiskWriter(config.WRITER_THREADS, config.WRITE_QUEUE_BYTES)
+
+    return WRITER
+
+
+def print_writer_stats() -> NoReturn:
+    """Display how many pages the writers saved and how often downloads waited on them"""
+
+    if WRITER is None:
+        return
+
+    stats = WRITER.stats()
+    memory = BUFFER_MEMORY.stats()
+    print(f"Writer: {stats['written']} pages ({stats['bytes_written']} bytes) written, "
+          f"{stats['peak_bytes']} bytes queued at most, {stats['stalls']} pages waited for the disk, "
+          f"{memory['peak_bytes']} bytes of pages in memory at most ({memory['spilled']} spilled to disk)")